@@ -0,0 +1,93 @@
+#!/usr/bin/env python3.8
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Compares the size, scoring latency and ranking quality of each activation
+storage format for a built-in image set, against float32.
+
+Queries are synthetic CAVs - the normalized difference between the mean
+activations of two random groups of images in the set.
+
+Usage: bin/benchmark_activation_formats.py <image set name> [--model-layer googlenet_4d]
+'''
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+# set settings for django to work
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cavstudio_backend.settings")
+
+# ensure that cavstudio_backend can be imported
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(BACKEND_DIR))
+
+import numpy as np
+from cavlib.quantization import ACTIVATION_FORMATS, QuantizedActivations
+from cavlib.utils import top_k_indices
+from cavstudio_backend.image_reference import load_activations
+from cavstudio_backend.image_set import BuiltInImageSet
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_set')
+    parser.add_argument('--model-layer', default='googlenet_4d')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=100)
+    args = parser.parse_args()
+
+    image_set = BuiltInImageSet(args.image_set)
+    # load at full precision, regardless of ACTIVATION_STORAGE_FORMAT
+    activations = np.array(load_activations(image_set.image_refs, model_layer=args.model_layer, normalize=True))
+    print(f'{len(activations)} images, {activations.shape[1]} dimensions')
+
+    rng = np.random.RandomState(0)
+    queries = []
+    for _ in range(args.queries):
+        positive = activations[rng.choice(len(activations), size=10, replace=False)].mean(axis=0)
+        negative = activations[rng.choice(len(activations), size=10, replace=False)].mean(axis=0)
+        query = positive - negative
+        queries.append(query / np.linalg.norm(query))
+
+    exact_scores = [activations.dot(query) for query in queries]
+    exact_top = [set(top_k_indices(scores, args.k)) for scores in exact_scores]
+
+    print(f'{"format":>8} {"size":>10} {"latency":>10} {"recall@" + str(args.k):>10} {"max score err":>14}')
+
+    for format in ACTIVATION_FORMATS:
+        quantized = QuantizedActivations.quantize(activations, format)
+
+        recalls = []
+        errors = []
+        latencies = []
+        for query, expected_scores, expected_top in zip(queries, exact_scores, exact_top):
+            start = time.perf_counter()
+            scores = quantized.dot(query)
+            latencies.append(time.perf_counter() - start)
+
+            recalls.append(len(expected_top.intersection(top_k_indices(scores, args.k))) / args.k)
+            errors.append(np.max(np.abs(scores - expected_scores)))
+
+        print(
+            f'{format:>8} {quantized.nbytes / 1e6:>8.1f}MB {np.mean(latencies) * 1000:>8.1f}ms '
+            f'{np.mean(recalls):>10.3f} {np.max(errors):>14.5f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3.8
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Compares the latency and quality of fast heatmaps against crop heatmaps, for
+images from a built-in image set.
+
+Queries are synthetic CAVs - the normalized difference between the mean
+activations of two random groups of images in the set. Each CAV is tested on
+its top-scoring images. Quality is measured against the crop heatmap, as the
+correlation of the heatmap values, and the overlap (IoU) of the hottest 20%
+of pixels.
+
+Usage: bin/benchmark_heatmaps.py <image set name> [--model-layer googlenet_4d]
+'''
+
+import argparse
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+# set settings for django to work
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cavstudio_backend.settings")
+
+# ensure that cavstudio_backend can be imported
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(BACKEND_DIR))
+
+import numpy as np
+from cavlib.utils import top_k_indices
+from cavstudio_backend.cav import CAV
+from cavstudio_backend.image_set import BuiltInImageSet
+from cavstudio_backend.ml_image import MLImage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_set')
+    parser.add_argument('--model-layer', default='googlenet_4d')
+    parser.add_argument('--queries', type=int, default=10)
+    parser.add_argument('--images-per-query', type=int, default=3)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2])
+    args = parser.parse_args()
+
+    image_set = BuiltInImageSet(args.image_set)
+    activations = image_set.normalized_activations(args.model_layer)
+
+    rng = np.random.RandomState(0)
+    cases = []
+    for _ in range(args.queries):
+        positive = np.asarray(activations[np.sort(rng.choice(len(activations), size=10, replace=False))]).mean(axis=0)
+        negative = np.asarray(activations[np.sort(rng.choice(len(activations), size=10, replace=False))]).mean(axis=0)
+        vector = positive - negative
+        cav = CAV(id=uuid.uuid4(), vector=vector / np.linalg.norm(vector), model_layer=args.model_layer)
+
+        for index in top_k_indices(activations.dot(cav.vector), args.images_per_query):
+            cases.append((cav, image_set.image_refs[index]))
+
+    # warm up the model
+    MLImage.load(cases[0][1].image_224_path).fast_heatmap_values(cases[0][0])
+
+    times = {'crops': []}
+    correlations = {}
+    overlaps = {}
+
+    for cav, image_ref in cases:
+        # use a new MLImage each time, so no crops are reused
+        start = time.perf_counter()
+        crop_heatmap = MLImage.load(image_ref.image_224_path).crop_heatmap_values(cav)
+        times['crops'].append(time.perf_counter() - start)
+
+        for scale in args.scales:
+            name = f'fast x{scale}'
+            start = time.perf_counter()
+            fast_heatmap = MLImage.load(image_ref.image_224_path).fast_heatmap_values(cav, scale=scale)
+            times.setdefault(name, []).append(time.perf_counter() - start)
+
+            correlations.setdefault(name, []).append(np.corrcoef(crop_heatmap.ravel(), fast_heatmap.ravel())[0, 1])
+            overlaps.setdefault(name, []).append(hot_region_iou(crop_heatmap, fast_heatmap))
+
+    print(f'{len(cases)} heatmaps')
+    print(f'{"method":>10} {"latency":>10} {"correlation":>12} {"top 20% IoU":>12}')
+    for name, method_times in times.items():
+        latency = f'{np.mean(method_times) * 1000:.0f}ms'
+        if name == 'crops':
+            print(f'{name:>10} {latency:>10} {1.0:>12.3f} {1.0:>12.3f}')
+        else:
+            print(f'{name:>10} {latency:>10} {np.mean(correlations[name]):>12.3f} {np.mean(overlaps[name]):>12.3f}')
+
+
+def hot_region_iou(a, b, fraction=0.2):
+    a_hot = a >= np.quantile(a, 1 - fraction)
+    b_hot = b >= np.quantile(b, 1 - fraction)
+    return np.sum(a_hot & b_hot) / np.sum(a_hot | b_hot)
+
+
+if __name__ == '__main__':
+    main()
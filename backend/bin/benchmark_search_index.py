@@ -0,0 +1,98 @@
+#!/usr/bin/env python3.8
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Measures the recall and latency of the approximate search index for a
+built-in image set, compared to exact (brute force) search.
+
+Queries are synthetic CAVs - the normalized difference between the mean
+activations of two random groups of images in the set.
+
+Usage: bin/benchmark_search_index.py <image set name> [--model-layer googlenet_4d]
+'''
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+# set settings for django to work
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cavstudio_backend.settings")
+
+# ensure that cavstudio_backend can be imported
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(BACKEND_DIR))
+
+import numpy as np
+from cavlib.utils import top_k_indices
+from cavstudio_backend.image_set import BuiltInImageSet
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_set')
+    parser.add_argument('--model-layer', default='googlenet_4d')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the index before benchmarking')
+    args = parser.parse_args()
+
+    image_set = BuiltInImageSet(args.image_set)
+    activations = image_set.search_activations(args.model_layer)
+
+    if args.rebuild or image_set.load_search_index(args.model_layer) is None:
+        print('building index...')
+        start = time.perf_counter()
+        image_set.build_search_index(args.model_layer)
+        print(f'built in {time.perf_counter() - start:.1f}s')
+
+    index = image_set.load_search_index(args.model_layer)
+    print(f'{len(activations)} images, {activations.shape[1]} dimensions, {index.num_lists} lists')
+
+    rng = np.random.RandomState(0)
+    queries = []
+    for _ in range(args.queries):
+        positive = activations[np.sort(rng.choice(len(activations), size=10, replace=False))].mean(axis=0)
+        negative = activations[np.sort(rng.choice(len(activations), size=10, replace=False))].mean(axis=0)
+        query = positive - negative
+        queries.append(query / np.linalg.norm(query))
+
+    exact_results = []
+    start = time.perf_counter()
+    for query in queries:
+        exact_results.append(set(top_k_indices(np.dot(activations, query), args.k)))
+    exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+
+    print(f'{"method":>12} {"recall@" + str(args.k):>10} {"latency":>10}')
+    print(f'{"exact":>12} {1.0:>10.3f} {exact_ms:>8.1f}ms')
+
+    for nprobe in args.nprobe:
+        if nprobe > index.num_lists:
+            break
+
+        recalls = []
+        start = time.perf_counter()
+        for query, expected in zip(queries, exact_results):
+            indexes, _ = index.search(activations, query, k=args.k, nprobe=nprobe)
+            recalls.append(len(expected.intersection(indexes)) / len(expected))
+        ms = (time.perf_counter() - start) / len(queries) * 1000
+
+        print(f'{"nprobe=" + str(nprobe):>12} {np.mean(recalls):>10.3f} {ms:>8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
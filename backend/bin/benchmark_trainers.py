@@ -0,0 +1,97 @@
+#!/usr/bin/env python3.8
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Compares the fit time of each CAV trainer, and how closely its rankings agree
+with the SGD baseline, on images from a built-in image set.
+
+Queries are synthetic - the positive images are the nearest neighbours of a
+random image, and the negatives are random images. Agreement is measured as
+the overlap of each trainer's top-k results with the SGD top-k, and the
+cosine similarity of the CAV vectors.
+
+Usage: bin/benchmark_trainers.py <image set name> [--model-layer googlenet_4d]
+'''
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+# set settings for django to work
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cavstudio_backend.settings")
+
+# ensure that cavstudio_backend can be imported
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(BACKEND_DIR))
+
+import numpy as np
+from cavlib.trainers import get_trainer, trainer_names
+from cavlib.utils import top_k_indices
+from cavstudio_backend.image_set import BuiltInImageSet
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_set')
+    parser.add_argument('--model-layer', default='googlenet_4d')
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--positives', type=int, default=10)
+    parser.add_argument('--negatives', type=int, default=20)
+    parser.add_argument('-k', type=int, default=100)
+    args = parser.parse_args()
+
+    image_set = BuiltInImageSet(args.image_set)
+    activations = np.asarray(image_set.normalized_activations(args.model_layer))
+
+    rng = np.random.RandomState(0)
+    names = trainer_names()
+    times = {name: [] for name in names}
+    overlaps = {name: [] for name in names}
+    similarities = {name: [] for name in names}
+
+    for _ in range(args.queries):
+        seed = activations[rng.randint(len(activations))]
+        positive_indexes = top_k_indices(activations.dot(seed), args.positives)
+        negative_indexes = rng.choice(len(activations), size=args.negatives, replace=False)
+
+        x = activations[np.concatenate([positive_indexes, negative_indexes])]
+        is_positive = np.arange(len(x)) < len(positive_indexes)
+        weights = np.ones(len(x))
+
+        vectors = {}
+        for name in names:
+            start = time.perf_counter()
+            model = get_trainer(name)(x, is_positive, weights, random_state=np.random.RandomState(0))
+            times[name].append(time.perf_counter() - start)
+            vectors[name] = model.coef / np.linalg.norm(model.coef)
+
+        baseline_top = set(top_k_indices(activations.dot(vectors['sgd']), args.k))
+        for name in names:
+            top = set(top_k_indices(activations.dot(vectors[name]), args.k))
+            overlaps[name].append(len(top & baseline_top) / args.k)
+            similarities[name].append(np.dot(vectors[name], vectors['sgd']))
+
+    print(f'{args.queries} queries, {args.positives} positives, {args.negatives} negatives, '
+          f'{activations.shape[1]} dimensions')
+    print(f'{"trainer":>16} {"fit time":>10} {f"top {args.k} overlap":>16} {"cosine":>8}')
+    for name in names:
+        fit_time = f'{np.mean(times[name]) * 1000:.2f}ms'
+        print(f'{name:>16} {fit_time:>10} {np.mean(overlaps[name]):>16.3f} {np.mean(similarities[name]):>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
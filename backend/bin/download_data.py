@@ -34,7 +34,12 @@ import shutil
 import json
 from tqdm import tqdm
 import textwrap
-from cavstudio_backend.image_reference import precalculate_activations, ImageReference
+from cavstudio_backend.image_reference import ImageReference
+from cavstudio_backend.image_set import BuiltInImageSet
+from cavstudio_backend.ml_engine import MODEL_LAYERS
+from cavstudio_backend.precompute import precalculate_activations
+from cavstudio_backend.projections import build_projection
+from django.conf import settings as django_settings
 from django.core.management import call_command as django_call_command
 
 FEATURE_CONCEPTS_URL = 'https://services.google.com/fh/files/misc/featured_concepts_v2.zip'
@@ -54,8 +59,8 @@ def main():
         your concepts to search, and our featured concepts.
 
         It will download ~1.1GB of data, and then will preprocess the images
-        to create activations. The whole process should take around 10-15
-        minutes.
+        to create activations, using all available CPU cores. The whole
+        process should take around 10-15 minutes.
 
         Please note: the images inside the featured concepts are made publicly
         available for use in CAVstudio only. Copyright is retained by the
@@ -133,9 +138,22 @@ def main():
 
         print('------> 7/8 Precomputing activations...')
         image_refs = [ImageReference(id=id, user_generated=False) for id in image_ids]
-        # this function shows its own progress bar
+        # this function shows its own progress bar. Images that already have
+        # activations are skipped, so an interrupted run picks up where it
+        # left off.
         precalculate_activations(image_refs=image_refs)
 
+        if django_settings.ACTIVATION_PROJECTION_DIMENSIONS:
+            print('fitting activation projections...')
+            for model_layer in MODEL_LAYERS:
+                build_projection(model_layer, image_refs)
+
+        print('packing activations for each image bank...')
+        for manifest_file in sorted((STATIC_CAV_CONTENT_DIR / 'manifests').glob('*.json')):
+            image_set = BuiltInImageSet(manifest_file.stem)
+            for model_layer in MODEL_LAYERS:
+                image_set.build(model_layer)
+
         print('------> 8/8 Done!')
 
 
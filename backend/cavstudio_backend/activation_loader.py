@@ -0,0 +1,63 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Loads activations from disk on one shared, bounded pool of I/O threads.
+
+Reads are grouped into batches, so a large image set is a few hundred tasks
+rather than thousands, and each call has at most
+ACTIVATION_IO_REQUEST_CONCURRENCY batches in flight, so one large request
+can't starve the others.
+'''
+
+import concurrent.futures
+
+from django.conf import settings
+
+io_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.ACTIVATION_IO_THREADS,
+    thread_name_prefix='activation-io',
+)
+
+
+def batches(items, batch_size):
+    return [items[start:start+batch_size] for start in range(0, len(items), batch_size)]
+
+
+def run_batch(fn, batch):
+    return [fn(*args) for args in batch]
+
+
+def map_batched(fn, items, batch_size=None, max_concurrency=None):
+    '''
+    Returns [fn(*args) for args in items], calling fn on io_executor.
+    '''
+    batch_size = batch_size or settings.ACTIVATION_IO_BATCH_SIZE
+    max_concurrency = max_concurrency or settings.ACTIVATION_IO_REQUEST_CONCURRENCY
+
+    pending_batches = list(enumerate(batches(list(items), batch_size)))
+    results = [None] * len(pending_batches)
+    in_flight = {}
+
+    while pending_batches or in_flight:
+        while pending_batches and len(in_flight) < max_concurrency:
+            index, batch = pending_batches.pop(0)
+            in_flight[io_executor.submit(run_batch, fn, batch)] = index
+
+        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            results[in_flight.pop(future)] = future.result()
+
+    return [result for batch_results in results for result in batch_results]
+
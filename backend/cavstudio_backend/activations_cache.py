@@ -12,22 +12,236 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import multiprocessing
-from functools import lru_cache
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
 from typing import List
 
-from .image_reference import ImageReference, load_and_normalize_activation
+import numpy as np
+from cavlib.quantization import QuantizedActivations
+from django.conf import settings
 
-activations_get_pool = multiprocessing.pool.ThreadPool(12)
+from .activation_loader import map_batched
+from .image_reference import (ImageReference, activation_file_values, load_and_normalize_activation,
+                              quantized_activation_from_file_values)
+from .projections import get_projection
+from .utils import evict_least_recently_used
 
 
-# Each activation is 100-400kB each, so 8000 caches would be somewhere between
-# 0.8 - 3.2GB in RAM.
-@lru_cache(typed=False, maxsize=8000)
-def get_normalized_activation(activation_path):
-    return load_and_normalize_activation(activation_path)
+def owned_nbytes(value):
+    '''
+    The number of bytes of value held in this process's own memory.
+    Memory-mapped arrays, like those from the SharedActivationStore, are
+    backed by the page cache shared between processes, so they don't count.
+    '''
+    if isinstance(value, QuantizedActivations):
+        return owned_nbytes(value.values) + owned_nbytes(value.scales)
+    if not isinstance(value, np.ndarray) or isinstance(value, np.memmap):
+        return 0
+    return value.nbytes
+
+
+class ActivationCache:
+    '''
+    An in-memory LRU cache of activations, bounded by the total size of the
+    cached arrays rather than their number, so the memory used doesn't
+    depend on which model layers are being used. Memory-mapped arrays are
+    counted as free, since they're shared with other processes. Keeps hit,
+    miss and eviction counts per model layer.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # key -> (model_layer, value, owned bytes)
+            self.entries = OrderedDict()
+            self.resident_bytes = 0
+            self.layer_stats = {}
+
+    def get(self, key, model_layer, load):
+        '''
+        Returns the cached value for key, calling load() to create it on a
+        miss. Values are arrays or QuantizedActivations.
+        '''
+        with self.lock:
+            stats = self.stats_for_layer(model_layer)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                stats['hits'] += 1
+                return self.entries[key][1]
+            stats['misses'] += 1
+
+        # load outside the lock, so other threads aren't held up. Two threads
+        # might load the same value, which is harmless.
+        value = load()
+
+        nbytes = owned_nbytes(value)
+
+        with self.lock:
+            if key not in self.entries and nbytes <= self.max_bytes:
+                self.entries[key] = (model_layer, value, nbytes)
+                self.resident_bytes += nbytes
+                stats['resident_bytes'] += nbytes
+                stats['entries'] += 1
+
+                while self.resident_bytes > self.max_bytes:
+                    _, (evicted_model_layer, _, evicted_nbytes) = self.entries.popitem(last=False)
+                    self.resident_bytes -= evicted_nbytes
+                    evicted_stats = self.stats_for_layer(evicted_model_layer)
+                    evicted_stats['resident_bytes'] -= evicted_nbytes
+                    evicted_stats['entries'] -= 1
+                    evicted_stats['evictions'] += 1
+
+        return value
+
+    def stats_for_layer(self, model_layer):
+        if model_layer not in self.layer_stats:
+            self.layer_stats[model_layer] = {
+                'hits': 0, 'misses': 0, 'evictions': 0, 'entries': 0, 'resident_bytes': 0,
+            }
+        return self.layer_stats[model_layer]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_bytes': self.max_bytes,
+                'resident_bytes': self.resident_bytes,
+                'layers': {model_layer: dict(stats) for model_layer, stats in self.layer_stats.items()},
+            }
+
+
+class SharedActivationStore:
+    '''
+    Normalized activations stored as .npy files in a directory shared by all
+    the server's worker processes, and memory-mapped when read. When the
+    directory is on a tmpfs like /dev/shm, every worker maps the same pages,
+    so running more workers doesn't multiply the memory used by activations.
+    The least recently used files are deleted to stay under max_bytes.
+    '''
+    def __init__(self, directory, max_bytes, format='float32'):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.format = format
+        self.lock = threading.Lock()
+        # running estimate of the size of the directory, None until scanned
+        self.total_bytes = None
+
+    def path(self, activation_path):
+        key = hashlib.sha1(str(activation_path).encode('utf8')).hexdigest()
+        return self.directory / f'{key}.{self.format}.npy'
+
+    def get(self, activation_path):
+        '''
+        Returns the stored activation as a memory-mapped
+        QuantizedActivations, or None if it's not stored.
+        '''
+        try:
+            values = np.load(self.path(activation_path), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+        return quantized_activation_from_file_values(values)
+
+    def put(self, activation_path, quantized):
+        values = activation_file_values(quantized)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(activation_path)
+        temp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(temp_path, 'wb') as f:
+            np.save(f, values)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += path.stat().st_size
+
+            if self.total_bytes is None or self.total_bytes > self.max_bytes:
+                self.total_bytes = evict_least_recently_used(self.directory, '*.npy', self.max_bytes * 0.9)
+
+    def stats(self):
+        return {'max_bytes': self.max_bytes, 'total_bytes': self.total_bytes}
+
+
+normalized_activation_cache = ActivationCache(max_bytes=settings.ACTIVATION_CACHE_BYTES)
+projected_activation_cache = ActivationCache(max_bytes=settings.PROJECTED_ACTIVATION_CACHE_BYTES)
+
+shared_activation_store = None
+if settings.ACTIVATION_CACHE_SHARED_DIR:
+    shared_activation_store = SharedActivationStore(
+        directory=settings.ACTIVATION_CACHE_SHARED_DIR,
+        max_bytes=settings.ACTIVATION_CACHE_SHARED_BYTES,
+        format=settings.ACTIVATION_STORAGE_FORMAT,
+    )
+
+
+def load_stored_normalized_activation(activation_path):
+    if shared_activation_store is not None:
+        stored = shared_activation_store.get(activation_path)
+        if stored is not None:
+            return stored
+
+    activation = load_and_normalize_activation(activation_path)
+    stored = QuantizedActivations.quantize(activation, settings.ACTIVATION_STORAGE_FORMAT)
+
+    if shared_activation_store is not None:
+        shared_activation_store.put(activation_path, stored)
+        # use the mapped copy, so this process doesn't keep a private one.
+        # It might already have been evicted by another process.
+        mapped = shared_activation_store.get(activation_path)
+        if mapped is not None:
+            return mapped
+
+    return stored
+
+
+def get_stored_normalized_activation(activation_path, model_layer):
+    '''
+    Returns the normalized activation as a QuantizedActivations in
+    ACTIVATION_STORAGE_FORMAT.
+    '''
+    return normalized_activation_cache.get(
+        str(activation_path), model_layer, lambda: load_stored_normalized_activation(activation_path),
+    )
+
+
+def get_normalized_activation(activation_path, model_layer):
+    return get_stored_normalized_activation(activation_path, model_layer).dequantize()
 
 
 def get_normalized_activations(image_refs: List[ImageReference], model_layer: str):
-    activation_paths = [i.activations_path(model_layer=model_layer) for i in image_refs]
-    return activations_get_pool.map(get_normalized_activation, activation_paths)
+    return map_batched(get_normalized_activation, activation_args(image_refs, model_layer))
+
+
+def get_projected_activation(activation_path, model_layer):
+    def load():
+        projection = get_projection(model_layer)
+        return projection.project(load_and_normalize_activation(activation_path))
+
+    return projected_activation_cache.get(str(activation_path), model_layer, load)
+
+
+def get_projected_activations(image_refs: List[ImageReference], model_layer: str):
+    '''
+    Returns the normalized activations of image_refs, projected with the
+    model layer's projection. Only call this if get_projection returns a
+    projection.
+    '''
+    return map_batched(get_projected_activation, activation_args(image_refs, model_layer))
+
+
+def activation_args(image_refs, model_layer):
+    return [(i.activations_path(model_layer=model_layer), model_layer) for i in image_refs]
+
+
+def cache_stats():
+    return {
+        'normalized': normalized_activation_cache.stats(),
+        'projected': projected_activation_cache.stats(),
+        'shared': shared_activation_store.stats() if shared_activation_store is not None else None,
+    }
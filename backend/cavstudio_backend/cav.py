@@ -13,62 +13,117 @@
 # limitations under the License.
 
 import uuid
+from functools import lru_cache
 from pathlib import Path
 from typing import List
 
 import msgpack
 import numpy as np
+from cavlib.trainers import LinearModel, get_trainer, trainer_uses_gram
+from cavlib.utils import top_k_indices
 from django.conf import settings
-from sklearn import linear_model
 
 from . import activations_cache
+from .gram_cache import get_gram
 from .image_reference import ImageReference
+from .projections import get_projection
 
 CAV_FOLDER = Path(settings.MEDIA_ROOT) / 'cavs'
 
 
 class CAV:
     @classmethod
-    def learn_from(cls, positive_image_refs, negative_image_refs, model_layer):
+    def learn_from(
+        cls, positive_image_refs, negative_image_refs, model_layer,
+        parent_cav=None, incremental=False, trainer=None,
+    ):
+        '''
+        Trains a new CAV. If parent_cav is given, training starts from its
+        coefficients, which converges faster when the training images have
+        only changed a little. If incremental is also set, training only makes
+        a few passes over the images, instead of running to convergence.
+
+        trainer is the name of a cavlib trainer, defaulting to
+        settings.CAV_TRAINER. Warm-starting only affects the 'sgd' trainer.
+        '''
+        trainer = trainer or settings.CAV_TRAINER
+
+        if incremental and parent_cav is None:
+            raise ValueError('incremental training requires a parent_cav')
+        if parent_cav is not None and parent_cav.model_layer != model_layer:
+            raise ValueError(f'parent_cav uses {parent_cav.model_layer}, not {model_layer}')
+
+        # if there's a projection, train in the projected space and map the
+        # result back to the full activation space
+        projection = get_projection(model_layer)
+
         positive_activations, negative_activations = load_image_sets_normalized_activations(
             [positive_image_refs, negative_image_refs],
-            model_layer=model_layer
+            model_layer=model_layer,
+            projected=projection is not None,
         )
 
         x = np.concatenate([
             positive_activations,
             negative_activations,
         ])
-        labels = np.concatenate([
-            np.repeat(0, len(positive_activations)),
-            np.repeat(1, len(negative_activations)),
+        is_positive = np.concatenate([
+            np.repeat(True, len(positive_activations)),
+            np.repeat(False, len(negative_activations)),
         ])
         weights = np.concatenate([
             [i.weight for i in positive_image_refs],
             [i.weight for i in negative_image_refs],
         ])
 
-        lm = linear_model.SGDClassifier(alpha=0.01, max_iter=1000, tol=1e-3, verbose=True)
+        initial = None
+        if parent_cav is not None:
+            initial = parent_cav.initial_model()
+            if projection is not None:
+                initial = initial._replace(coef=projection.project(initial.coef))
+
+        gram = None
+        if trainer_uses_gram(trainer):
+            gram = get_gram(
+                positive_image_refs + negative_image_refs, x,
+                model_layer=model_layer, projected=projection is not None,
+            )
+
+        model = get_trainer(trainer)(
+            x, is_positive, weights, gram=gram,
+            initial=initial, incremental=incremental,
+        )
 
-        lm.fit(x, labels, sample_weight=weights)
+        cav_vector = model.coef
+        if projection is not None:
+            cav_vector = projection.unproject(cav_vector)
+        coef_norm = np.linalg.norm(cav_vector)
+        cav_vector = cav_vector / coef_norm
 
-        cav_vector = -1 * lm.coef_[0]
-        cav_vector /= np.linalg.norm(cav_vector)
+        training_state = {
+            **model.training_state,
+            'coef_norm': float(coef_norm),
+            'intercept': model.intercept,
+        }
 
-        return cls(id=uuid.uuid4(), vector=cav_vector, model_layer=model_layer)
+        return cls(id=uuid.uuid4(), vector=cav_vector, model_layer=model_layer, training_state=training_state)
 
-    def __init__(self, id, vector, model_layer, stats=None):
+    def __init__(self, id, vector, model_layer, stats=None, training_state=None):
         self.vector = vector
         self.model_layer = model_layer
         self.id = id
         self.stats = stats
+        # the vector is normalized, so this keeps the coefficient norm and
+        # intercept of the linear model, for warm-starting from this CAV
+        self.training_state = training_state
 
     def to_dict(self):
         return {
             'vector': self.vector.tolist(),
             'id': str(self.id),
             'model_layer': self.model_layer,
-            'stats': self.stats.to_dict() if self.stats else None
+            'stats': self.stats.to_dict() if self.stats else None,
+            'training_state': self.training_state,
         }
 
     @classmethod
@@ -77,9 +132,21 @@ class CAV:
             id=uuid.UUID(dict['id']),
             vector=np.array(dict['vector']),
             model_layer=dict['model_layer'],
-            stats=CAVStats.from_dict(dict['stats']) if dict.get('stats') else None
+            stats=CAVStats.from_dict(dict['stats']) if dict.get('stats') else None,
+            training_state=dict.get('training_state'),
         )
 
+    def initial_model(self):
+        '''
+        Returns the linear model to warm-start training from this CAV.
+        '''
+        training_state = dict(self.training_state or {})
+        coef_norm = training_state.pop('coef_norm', 1.0)
+        intercept = training_state.pop('intercept', 0.0)
+
+        coef = self.vector / np.linalg.norm(self.vector) * coef_norm
+        return LinearModel(coef=coef, intercept=intercept, training_state=training_state)
+
     @classmethod
     def load(cls, id):
         file_path = CAV_FOLDER / f'{id}.cav'
@@ -108,13 +175,17 @@ class CAV:
         return ''.join(digits)
 
     def update_stats_from_scores(self, scores: np.ndarray):
-        self.stats = CAVStats.from_scores(scores)
+        # there are no stats for an empty search set
+        self.stats = CAVStats.from_scores(scores) if len(scores) else None
+
+    def update_stats_from_sample(self, sample_scores: np.ndarray, top_scores: np.ndarray):
+        self.stats = CAVStats.from_sample(sample_scores, top_scores)
 
 
 class CAVStats:
     @classmethod
     def from_scores(cls, scores: np.ndarray):
-        top_5_idx = (-scores).argsort()[:5]
+        top_5_idx = top_k_indices(scores, 5)
         return cls(
             mean=np.mean(scores),
             stddev=np.std(scores),
@@ -123,12 +194,29 @@ class CAVStats:
             top_5_mean=np.mean(scores[top_5_idx]),
         )
 
+    @classmethod
+    def from_sample(cls, sample_scores: np.ndarray, top_scores: np.ndarray):
+        '''
+        Estimates stats when only part of the search set was scored, from
+        the scores of a random sample of the set, and the (sorted) scores of
+        the best results.
+        '''
+        return cls(
+            mean=np.mean(sample_scores),
+            stddev=np.std(sample_scores),
+            max=max(np.max(sample_scores), top_scores[0]),
+            min=np.min(sample_scores),
+            top_5_mean=np.mean(top_scores[:5]),
+        )
+
     def __init__(self, mean, stddev, max, min, top_5_mean):
-        self.mean = mean
-        self.stddev = stddev
-        self.max = max
-        self.min = min
-        self.top_5_mean = top_5_mean
+        # stored as Python floats, since scores can be numpy scalars of any
+        # precision, which msgpack can't serialize
+        self.mean = float(mean)
+        self.stddev = float(stddev)
+        self.max = float(max)
+        self.min = float(min)
+        self.top_5_mean = float(top_5_mean)
 
     @classmethod
     def from_dict(cls, dict):
@@ -150,12 +238,63 @@ class CAVStats:
         }
 
 
-def load_image_sets_normalized_activations(image_sets: List[ImageReference], model_layer):
+def score_progressively(activations, vector, k, partition_size, scores_out, first_pass_indexes=None):
+    '''
+    Scores the rows of activations against vector one partition at a time,
+    yielding (top_indexes, top_scores, fraction_done) after each partition,
+    so that results can be shown before the whole set is scored.
+
+    If first_pass_indexes is given, those rows are scored first, for a quick
+    initial estimate. Every score is written to scores_out, which is complete
+    when the generator is exhausted. Closing the generator stops the work.
+    '''
+    num_rows = len(activations)
+
+    if first_pass_indexes is not None and len(first_pass_indexes) < num_rows:
+        first_pass_scores = score_rows(activations, first_pass_indexes, vector)
+        top = top_k_indices(first_pass_scores, k)
+        yield first_pass_indexes[top], first_pass_scores[top], 0.0
+
+    top_indexes = np.zeros(0, dtype=np.intp)
+    top_scores = np.zeros(0, dtype=np.float32)
+
+    for start in range(0, num_rows, partition_size):
+        end = min(start + partition_size, num_rows)
+        scores_out[start:end] = activations[start:end].dot(vector)
+
+        candidate_indexes = np.concatenate([top_indexes, np.arange(start, end)])
+        candidate_scores = np.concatenate([top_scores, scores_out[start:end]])
+        top = top_k_indices(candidate_scores, k)
+        top_indexes, top_scores = candidate_indexes[top], candidate_scores[top]
+
+        yield top_indexes, top_scores, end / num_rows
+
+
+def score_rows(activations, indexes, vector, chunk_size=512):
+    '''
+    Returns activations[indexes].dot(vector), without copying every indexed
+    row at once - with a memory-mapped bank of large activations, that copy
+    would be gigabytes. indexes should be sorted, so each chunk reads nearby
+    rows.
+    '''
+    scores = np.empty(len(indexes), dtype=np.result_type(activations.dtype, vector.dtype, np.float32))
+
+    for start in range(0, len(indexes), chunk_size):
+        chunk_indexes = indexes[start:start+chunk_size]
+        scores[start:start+len(chunk_indexes)] = activations[chunk_indexes].dot(vector)
+
+    return scores
+
+
+def load_image_sets_normalized_activations(image_sets: List[ImageReference], model_layer, projected=False):
     image_refs = []
     for image_set in image_sets:
         image_refs.extend(image_set)
 
-    activations = activations_cache.get_normalized_activations(image_refs, model_layer=model_layer)
+    if projected:
+        activations = activations_cache.get_projected_activations(image_refs, model_layer=model_layer)
+    else:
+        activations = activations_cache.get_normalized_activations(image_refs, model_layer=model_layer)
 
     start_i = 0
     activations_sets = []
@@ -165,3 +304,11 @@ def load_image_sets_normalized_activations(image_sets: List[ImageReference], mod
         start_i += count
 
     return activations_sets
+
+
+@lru_cache(maxsize=256)
+def get_cav(id):
+    '''
+    Returns CAV.load(id), cached in memory. CAVs aren't changed once saved.
+    '''
+    return CAV.load(id)
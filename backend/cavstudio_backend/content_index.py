@@ -0,0 +1,194 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+A persistent index of the files in a cav content directory.
+
+For each image id, the index records which of its artifacts - 'image_224',
+'image_1200', and an activation file per model layer - have been written,
+so checking whether an image was already ingested is one SQLite lookup
+rather than a stat of every file. It also stores aliases from content
+digests to image ids, so images ingested with an older hash algorithm keep
+their ids (see image_reference.image_id_for_pixels).
+
+The index only records files that exist. Anything it doesn't know about is
+checked on the filesystem, and recorded if found, so an empty or deleted
+index is always safe - it just fills up again as images are used. To fill
+it in one pass over the directory listing, or to forget files deleted
+outside of CAVstudio, run `manage.py rebuild_content_index`.
+'''
+
+import sqlite3
+import threading
+from pathlib import Path
+
+from django.conf import settings
+
+ARTIFACT_IMAGE_224 = 'image_224'
+ARTIFACT_IMAGE_1200 = 'image_1200'
+
+# SQLite limits the number of parameters in a query
+QUERY_CHUNK_SIZE = 500
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artifacts (
+    image_id TEXT NOT NULL,
+    artifact TEXT NOT NULL,
+    PRIMARY KEY (image_id, artifact)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS hash_aliases (
+    digest TEXT PRIMARY KEY,
+    image_id TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+class ContentIndex:
+    def __init__(self, path):
+        self.path = Path(path)
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(
+                str(self.path), timeout=30, isolation_level=None, check_same_thread=False
+            )
+            # WAL lets worker processes read while another writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def present_artifacts(self, image_ids):
+        '''
+        Returns a dict mapping each of image_ids to the set of its artifacts
+        that the index knows exist.
+        '''
+        image_ids = list(dict.fromkeys(image_ids))
+        result = {image_id: set() for image_id in image_ids}
+
+        with self._lock:
+            connection = self._connect()
+            for start in range(0, len(image_ids), QUERY_CHUNK_SIZE):
+                chunk = image_ids[start:start+QUERY_CHUNK_SIZE]
+                rows = connection.execute(
+                    'SELECT image_id, artifact FROM artifacts WHERE image_id IN ({})'.format(
+                        ','.join('?' * len(chunk))
+                    ),
+                    chunk,
+                )
+                for image_id, artifact in rows:
+                    result[image_id].add(artifact)
+
+        return result
+
+    def add_artifacts(self, image_artifacts):
+        '''
+        Records that files exist. image_artifacts is an iterable of
+        (image_id, artifact) pairs.
+        '''
+        image_artifacts = list(image_artifacts)
+        if not image_artifacts:
+            return
+
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN')
+                connection.executemany(
+                    'INSERT OR IGNORE INTO artifacts (image_id, artifact) VALUES (?, ?)',
+                    image_artifacts,
+                )
+
+    def replace_artifacts(self, image_artifacts):
+        '''
+        Replaces everything the index knows about artifacts with
+        image_artifacts, in one transaction. Hash aliases are kept.
+        '''
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN')
+                connection.execute('DELETE FROM artifacts')
+                connection.executemany(
+                    'INSERT OR IGNORE INTO artifacts (image_id, artifact) VALUES (?, ?)',
+                    image_artifacts,
+                )
+
+    def lookup_alias(self, digest):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT image_id FROM hash_aliases WHERE digest = ?', (digest,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def add_aliases(self, digest_image_ids):
+        '''
+        Records that content with each digest has the given image id.
+        digest_image_ids is an iterable of (digest, image_id) pairs.
+        '''
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN')
+                connection.executemany(
+                    'INSERT OR REPLACE INTO hash_aliases (digest, image_id) VALUES (?, ?)',
+                    digest_image_ids,
+                )
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+_content_indexes = {}
+_content_indexes_lock = threading.Lock()
+
+
+def content_index_path(content_dir):
+    '''
+    The index lives in the content directory it describes, unless
+    settings.CONTENT_INDEX_DIR is set.
+    '''
+    content_dir = Path(content_dir)
+
+    if settings.CONTENT_INDEX_DIR:
+        # name the index after its content dir, so the static and user
+        # content indexes don't collide
+        name = '-'.join(content_dir.resolve().parts[1:]) or 'root'
+        return Path(settings.CONTENT_INDEX_DIR) / f'{name}.sqlite3'
+    else:
+        return content_dir / '.content-index.sqlite3'
+
+
+def get_content_index(content_dir):
+    '''
+    Returns the ContentIndex for content_dir, or None if
+    settings.CONTENT_INDEX_ENABLED is off.
+    '''
+    if not settings.CONTENT_INDEX_ENABLED:
+        return None
+
+    path = content_index_path(content_dir)
+
+    with _content_indexes_lock:
+        if path not in _content_indexes:
+            _content_indexes[path] = ContentIndex(path)
+        return _content_indexes[path]
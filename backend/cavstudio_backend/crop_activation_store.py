@@ -0,0 +1,121 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from cavlib.quantization import QuantizedActivations
+from django.conf import settings
+
+from .utils import evict_least_recently_used
+
+
+class CropActivationStore:
+    '''
+    An on-disk cache of crop activations, keyed by (image_id, center,
+    zoom_level, model_layer). Image ids are content hashes, so entries never
+    go stale.
+
+    The crops for each image and model layer are stored together in one
+    file. When the files add up to more than max_bytes, the least recently
+    used are deleted.
+    '''
+    def __init__(self, directory, max_bytes, format='float32'):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.format = format
+        self.lock = threading.Lock()
+        # running estimate of the size of the directory, None until scanned
+        self.total_bytes = None
+
+    def path(self, image_id, model_layer):
+        assert '/' not in image_id
+        return self.directory / f'{image_id}.{model_layer}.npz'
+
+    def get(self, image_id, model_layer):
+        '''
+        Returns a dict of {(center, zoom_level): activation}, which is empty
+        if nothing is stored for this image.
+        '''
+        path = self.path(image_id, model_layer)
+
+        try:
+            with np.load(path) as data:
+                specs = data['specs']
+                activations = QuantizedActivations(
+                    data['values'], data['scales'] if 'scales' in data else None,
+                ).dequantize()
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return {}
+
+        return {
+            ((float(center_x), float(center_y)), float(zoom_level)): activation
+            for (center_x, center_y, zoom_level), activation in zip(specs, activations)
+        }
+
+    def put(self, image_id, model_layer, activations_by_spec):
+        '''
+        Stores activations_by_spec, a dict like the one returned by get,
+        replacing anything already stored for this image and model layer.
+        '''
+        specs = np.array(
+            [(center[0], center[1], zoom_level) for center, zoom_level in activations_by_spec],
+            dtype=np.float64,
+        )
+        quantized = QuantizedActivations.quantize(
+            np.stack(list(activations_by_spec.values())), self.format
+        )
+        arrays = {'specs': specs, 'values': quantized.values}
+        if quantized.scales is not None:
+            arrays['scales'] = quantized.scales
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(image_id, model_layer)
+        temp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += path.stat().st_size
+
+            if self.total_bytes is None or self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        '''
+        Deletes the least recently used files until the store is comfortably
+        under max_bytes. Other processes may share the directory, so this
+        rescans it rather than trusting the running total.
+        '''
+        self.total_bytes = evict_least_recently_used(self.directory, '*.npz', self.max_bytes * 0.9)
+
+
+def get_crop_activation_store():
+    if not settings.CROP_ACTIVATION_CACHE_BYTES:
+        return None
+
+    return crop_activation_store
+
+
+crop_activation_store = CropActivationStore(
+    directory=settings.CROP_ACTIVATION_CACHE_DIR,
+    max_bytes=settings.CROP_ACTIVATION_CACHE_BYTES,
+    format=settings.ACTIVATION_STORAGE_FORMAT,
+)
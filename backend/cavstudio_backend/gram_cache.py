@@ -0,0 +1,148 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+import numpy as np
+from django.conf import settings
+
+
+class GramCache:
+    '''
+    An in-memory cache of the inner products between the normalized
+    activations of training images, keyed by image id, for one model layer.
+
+    Training sets change a few images at a time, so when a CAV is retrained,
+    only the rows of the Gram matrix for newly added images are computed -
+    O(new * N * D) rather than O(N * N * D). When the cache is full, the
+    least recently used images are dropped.
+    '''
+    def __init__(self, max_images):
+        self.max_images = max_images
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.slots = {}  # image id -> row/column of self.matrix
+        self.last_used = np.zeros(self.max_images, dtype=np.int64)
+        self.clock = 0
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        # which entries of self.matrix have been computed
+        self.known = np.zeros((0, 0), dtype=bool)
+
+    def gram(self, image_ids, activations):
+        '''
+        Returns the Gram matrix of activations, a (N, D) matrix whose rows
+        are the normalized activations of image_ids, using cached inner
+        products where possible.
+        '''
+        unique_ids = list(dict.fromkeys(image_ids))
+        if len(unique_ids) > self.max_images:
+            return np.dot(activations, activations.T)
+
+        with self.lock:
+            self.clock += 1
+            slots = self.assign_slots(unique_ids)
+            request_slots = np.array([slots[image_id] for image_id in image_ids])
+
+            # compute the rows for any image with unknown products, against
+            # every image in this request
+            known = self.known[np.ix_(request_slots, request_slots)]
+            missing_rows = np.flatnonzero(~known.all(axis=1))
+            if len(missing_rows):
+                products = np.dot(activations[missing_rows], activations.T)
+                rows = request_slots[missing_rows]
+                self.matrix[np.ix_(rows, request_slots)] = products
+                self.matrix[np.ix_(request_slots, rows)] = products.T
+                self.known[np.ix_(rows, request_slots)] = True
+                self.known[np.ix_(request_slots, rows)] = True
+
+            return self.matrix[np.ix_(request_slots, request_slots)].copy()
+
+    def assign_slots(self, image_ids):
+        '''
+        Returns {image id: slot} for image_ids, giving new ids the slots of
+        the least recently used ids not in image_ids. Must hold self.lock.
+        '''
+        new_ids = [image_id for image_id in image_ids if image_id not in self.slots]
+        self.grow(len(self.slots) + len(new_ids))
+
+        used_slots = set(self.slots.values())
+        free_slots = sorted(set(range(len(self.matrix))) - used_slots)
+        if len(free_slots) < len(new_ids):
+            requested = {self.slots[image_id] for image_id in image_ids if image_id in self.slots}
+            evictable = [
+                slot for slot in np.argsort(self.last_used[:len(self.matrix)]).tolist()
+                if slot in used_slots and slot not in requested
+            ]
+            evicted = set(evictable[:len(new_ids) - len(free_slots)])
+            self.slots = {image_id: slot for image_id, slot in self.slots.items() if slot not in evicted}
+            free_slots.extend(evicted)
+
+        for image_id, slot in zip(new_ids, free_slots):
+            self.slots[image_id] = slot
+            self.known[slot, :] = False
+            self.known[:, slot] = False
+
+        for image_id in image_ids:
+            self.last_used[self.slots[image_id]] = self.clock
+
+        return self.slots
+
+    def grow(self, size):
+        '''
+        Grows the matrix to fit size images, up to max_images, doubling to
+        keep the number of copies down. Must hold self.lock.
+        '''
+        old_size = len(self.matrix)
+        if size <= old_size or old_size >= self.max_images:
+            return
+        new_size = min(max(size, old_size * 2), self.max_images)
+
+        matrix = np.zeros((new_size, new_size), dtype=np.float32)
+        matrix[:old_size, :old_size] = self.matrix
+        known = np.zeros((new_size, new_size), dtype=bool)
+        known[:old_size, :old_size] = self.known
+        self.matrix, self.known = matrix, known
+
+
+gram_caches = {}
+gram_caches_lock = threading.Lock()
+
+
+def get_gram(image_refs, activations, model_layer, projected=False):
+    '''
+    Returns the Gram matrix of activations, the normalized (and, if
+    projected, projected) activations of image_refs.
+    '''
+    if not settings.GRAM_CACHE_MAX_IMAGES:
+        return np.dot(activations, activations.T)
+
+    with gram_caches_lock:
+        key = (model_layer, projected)
+        if key not in gram_caches:
+            gram_caches[key] = GramCache(max_images=settings.GRAM_CACHE_MAX_IMAGES)
+        gram_cache = gram_caches[key]
+
+    return gram_cache.gram([i.id for i in image_refs], activations)
+
+
+def clear_gram_caches(model_layer):
+    '''
+    Drops cached inner products for model_layer, e.g. when its projection
+    changes.
+    '''
+    with gram_caches_lock:
+        for projected in (False, True):
+            gram_caches.pop((model_layer, projected), None)
@@ -14,60 +14,224 @@
 
 import hashlib
 import io
-import multiprocessing.pool
+import os
+import shutil
+import threading
 from pathlib import Path
 from typing import List
 
 import numpy as np
 import PIL
 import PIL.Image
+import xxhash
+from cavlib.quantization import QuantizedActivations
 from django.conf import settings
-from tqdm import tqdm
 
+from .activation_loader import map_batched
+from .content_index import ARTIFACT_IMAGE_224, ARTIFACT_IMAGE_1200, get_content_index
 from .ml_engine import MODEL_LAYERS, ml_engine
-from .utils import assert_shape, split_into_chunks
+from .utils import ArrayShapeError
 
+# the files stored for each image, named as in the content index
+ARTIFACTS = (ARTIFACT_IMAGE_224, ARTIFACT_IMAGE_1200, *MODEL_LAYERS)
 
-def image_hash(pil_image):
+
+def image_hash(pil_image, algorithm='md5'):
+    '''
+    Hashes the pixels of an RGB image. 'md5' is the original algorithm, that
+    existing image ids were made with. 'xxh3_128' is a non-cryptographic
+    hash that's much faster.
+    '''
     assert pil_image.mode == 'RGB'
 
-    pixels = np.array(pil_image, dtype='<u1')
-    pixel_buffer = pixels.tobytes(order='C')
+    # the packed pixels - the same bytes as the C-order uint8 array that was
+    # hashed before. PIL stores RGB pixels padded to four bytes, so packing
+    # them is one copy whichever way it's done; tobytes makes it without also
+    # building a numpy array.
+    pixel_bytes = pil_image.tobytes()
 
-    return hashlib.md5(pixel_buffer).hexdigest()
+    if algorithm == 'md5':
+        return hashlib.md5(pixel_bytes).hexdigest()
+    elif algorithm == 'xxh3_128':
+        return xxhash.xxh3_128_hexdigest(pixel_bytes)
+    else:
+        raise ValueError(f'unknown image hash algorithm: {algorithm}')
+
+
+def image_id_for_pixels(image224, user_generated=False):
+    '''
+    Returns the id for an image, a hash of its pixels with
+    settings.IMAGE_HASH_ALGORITHM. With settings.IMAGE_HASH_MD5_COMPAT,
+    images that were ingested under an MD5 id before switching algorithm
+    keep it, if their digest was recorded as an alias by add_hash_aliases.
+    That's one index lookup - new images are only hashed once.
+    '''
+    algorithm = settings.IMAGE_HASH_ALGORITHM
+    digest = image_hash(image224, algorithm)
+
+    if algorithm == 'md5' or not settings.IMAGE_HASH_MD5_COMPAT:
+        return digest
+
+    index = get_content_index(cav_content_dir(user_generated))
+    image_id = index.lookup_alias(digest) if index is not None else None
+    return image_id or digest
 
 
 def injest_image(image_data_224, image_data_1200, user_generated=False):
+    image224 = open_image_224(image_data_224)
+    image = ImageReference(id=image_id_for_pixels(image224, user_generated), user_generated=user_generated)
+
+    write_image_files(image, image224, image_data_1200)
+    calculate_missing_activations([(image, image224)])
+
+    return image
+
+
+def injest_images(images, user_generated=False, batch_size=32, defer_activations=False):
+    '''
+    Ingests many images at once. images is a list of (image_data_224,
+    image_data_1200) pairs, where image_data_1200 can be bytes or a
+    file-like object (see write_image_1200). Images are deduplicated by content hash, and
+    activations are calculated in batches of batch_size.
+
+    Returns a list with a (image_ref, status) tuple for each input, where
+    status is 'created', 'existing' (already ingested), 'duplicate' (of an
+    earlier image in this batch), or 'invalid' (not a 224x224 image, in
+    which case image_ref is None). If defer_activations is set, activations
+    aren't calculated, and new images have the status 'pending' instead of
+    'created' - the caller should queue a job to calculate them.
+    '''
+    results = []
+    unique_images = []
+    seen_ids = set()
+
+    for image_data_224, image_data_1200 in images:
+        try:
+            image224 = open_image_224(image_data_224)
+        except (OSError, ArrayShapeError):
+            # OSError includes PIL.UnidentifiedImageError and truncated files
+            results.append((None, 'invalid'))
+            continue
+
+        image = ImageReference(id=image_id_for_pixels(image224, user_generated), user_generated=user_generated)
+
+        if image.id in seen_ids:
+            results.append((image, 'duplicate'))
+            continue
+        seen_ids.add(image.id)
+
+        # the status is filled in below, once we know what exists
+        results.append((image, None))
+        unique_images.append((image, image224, image_data_1200, len(results) - 1))
+
+    # one index lookup for the whole batch, rather than a stat per file
+    presents = present_artifacts([image for image, _, _, _ in unique_images], ARTIFACTS)
+    new_images = []
+
+    for (image, image224, image_data_1200, result_index), present in zip(unique_images, presents):
+        is_new = not all(ml in present for ml in MODEL_LAYERS)
+        if not is_new:
+            status = 'existing'
+        elif defer_activations:
+            status = 'pending'
+        else:
+            status = 'created'
+        results[result_index] = (image, status)
+
+        write_image_files(image, image224, image_data_1200, present=present)
+        if is_new and not defer_activations:
+            new_images.append((image, image224))
+
+    for start in range(0, len(new_images), batch_size):
+        calculate_missing_activations(new_images[start:start+batch_size])
+
+    return results
+
+
+def open_image_224(image_data_224):
     image224 = PIL.Image.open(io.BytesIO(image_data_224))
+    # decode now, so a truncated file raises OSError here
+    image224.load()
 
     if image224.mode != 'RGB':
         image224 = image224.convert('RGB')
 
-    id = image_hash(image224)
+    # check the size without copying the pixels into an array
+    if image224.size != (224, 224):
+        raise ArrayShapeError(f'Expected a 224x224 image, received {image224.width}x{image224.height}.')
+    return image224
 
-    image = ImageReference(id=id, user_generated=user_generated)
 
-    content_dir = cav_content_dir(user_generated=user_generated)
+def write_image_files(image, image224, image_data_1200, present=None):
+    '''
+    Writes the image files that don't exist yet. present is the set of
+    image's artifacts that are known to exist, if the caller has already
+    looked them up.
+    '''
+    if present is None:
+        [present] = present_artifacts([image], [ARTIFACT_IMAGE_224, ARTIFACT_IMAGE_1200])
+
+    if ARTIFACT_IMAGE_224 in present and ARTIFACT_IMAGE_1200 in present:
+        return
+
+    content_dir = cav_content_dir(user_generated=image.user_generated)
 
     if not content_dir.exists():
-        content_dir.mkdir(parents=True)
+        content_dir.mkdir(parents=True, exist_ok=True)
 
-    if not image.image_224_path.exists():
+    if ARTIFACT_IMAGE_224 not in present:
         image224.save(str(image.image_224_path))
 
-    if not image.image_1200_path.exists():
-        image.image_1200_path.write_bytes(image_data_1200)
+    if ARTIFACT_IMAGE_1200 not in present:
+        write_image_1200(image, image_data_1200)
 
-    activations_needed = [ml for ml in MODEL_LAYERS if not image.activations_path(ml).exists()]
-    if len(activations_needed) > 0:
-        pixels = np.array(image224)
-        assert_shape(pixels, (224, 224, 3))
-        activations = ml_engine.calculate_activations(activations_needed, [pixels])[0]
+    record_artifacts([(image, ARTIFACT_IMAGE_224), (image, ARTIFACT_IMAGE_1200)])
 
-        for model_layer, activation_array in activations.items():
-            np.save(image.activations_path(model_layer), activation_array)
 
-    return image
+def write_image_1200(image, image_data_1200):
+    '''
+    Writes the 1200px image atomically. image_data_1200 is bytes, or a
+    file-like object such as an uploaded file, which is streamed to disk a
+    chunk at a time rather than read into memory.
+    '''
+    path = image.image_1200_path
+    temp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+    with open(temp_path, 'wb') as f:
+        if isinstance(image_data_1200, (bytes, bytearray, memoryview)):
+            f.write(image_data_1200)
+        else:
+            shutil.copyfileobj(image_data_1200, f)
+
+    os.replace(temp_path, path)
+
+
+def calculate_missing_activations(images):
+    '''
+    Calculates and saves the activations that don't exist yet for images, a
+    list of (image_ref, image224) tuples, in one batch per model layer set.
+    '''
+    presents = present_artifacts([image for image, _ in images], MODEL_LAYERS)
+
+    images_by_layers_needed = {}
+    for (image, image224), present in zip(images, presents):
+        activations_needed = tuple(ml for ml in MODEL_LAYERS if ml not in present)
+        if len(activations_needed) > 0:
+            images_by_layers_needed.setdefault(activations_needed, []).append((image, image224))
+
+    to_save = []
+    saved_artifacts = []
+    for activations_needed, images_needing in images_by_layers_needed.items():
+        pixels = [np.array(image224) for _, image224 in images_needing]
+        activations = ml_engine.calculate_activations(list(activations_needed), pixels)
+
+        for (image, _), image_activations in zip(images_needing, activations):
+            for model_layer, activation_array in image_activations.items():
+                to_save.append((image.activations_path(model_layer), activation_array))
+                saved_artifacts.append((image, model_layer))
+
+    map_batched(save_activation, to_save)
+    record_artifacts(saved_artifacts)
 
 
 class ImageReference:
@@ -91,6 +255,14 @@ class ImageReference:
         filename = '{}.1x.{}.npy'.format(self.id, model_layer)
         return cav_content_dir(self.user_generated) / filename
 
+    def artifact_path(self, artifact):
+        if artifact == ARTIFACT_IMAGE_224:
+            return self.image_224_path
+        elif artifact == ARTIFACT_IMAGE_1200:
+            return self.image_1200_path
+        else:
+            return self.activations_path(artifact)
+
     @classmethod
     def from_json(cls, json: dict):
         return cls(id=json['id'], user_generated=json['user_generated'])
@@ -119,22 +291,130 @@ class TrainingImageReference(ImageReference):
         return result
 
 
-activations_load_pool = multiprocessing.pool.ThreadPool(12)
-
-
 def load_activations(image_refs: List[ImageReference], model_layer: str, normalize=False):
-    activations_paths = [i.activations_path(model_layer) for i in image_refs]
+    activations_paths = [(i.activations_path(model_layer),) for i in image_refs]
 
     if normalize:
         load_fn = load_and_normalize_activation
     else:
-        load_fn = np.load
+        load_fn = load_activation
+
+    return map_batched(load_fn, activations_paths)
+
+
+def pack_normalized_activations(image_refs: List[ImageReference], model_layer: str, path, chunk_size=1000,
+                                format='float32'):
+    '''
+    Writes the normalized activations of image_refs into a single (N, D)
+    .npy file at `path`, row-aligned with image_refs, in the given storage
+    format. For int8, the per-row scales are written to a second file, at
+    scales_path_for_packed_activations(path). The files are written
+    atomically.
+    '''
+    path = Path(path)
+    scales_path = scales_path_for_packed_activations(path)
+    temp_suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+    temp_path = path.with_name(f'.{path.name}{temp_suffix}')
+    temp_scales_path = scales_path.with_name(f'.{scales_path.name}{temp_suffix}')
+
+    first_activation = load_activation(image_refs[0].activations_path(model_layer)) if image_refs else np.zeros(0)
+    shape = (len(image_refs), first_activation.shape[0])
+
+    packed = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.dtype(format), shape=shape)
+    packed_scales = np.zeros(len(image_refs), dtype=np.float32)
+
+    for start in range(0, len(image_refs), chunk_size):
+        chunk = image_refs[start:start+chunk_size]
+        activations = load_activations(chunk, model_layer=model_layer, normalize=True)
+        quantized = QuantizedActivations.quantize(activations, format)
+
+        packed[start:start+len(chunk)] = quantized.values
+        if quantized.scales is not None:
+            packed_scales[start:start+len(chunk)] = quantized.scales
+
+    packed.flush()
+    del packed
+
+    if format == 'int8':
+        with open(temp_scales_path, 'wb') as f:
+            np.save(f, packed_scales)
+        os.replace(temp_scales_path, scales_path)
+
+    os.replace(temp_path, path)
+
+
+def load_packed_activations(path):
+    '''
+    Memory-maps a file written by pack_normalized_activations. float32 files
+    are returned as a plain array; reduced-precision files as a
+    QuantizedActivations, which scores them a chunk at a time.
+    '''
+    values = np.load(path, mmap_mode='r')
+
+    if values.dtype == np.float32:
+        return values
+    elif values.dtype == np.int8:
+        return QuantizedActivations(values, np.load(scales_path_for_packed_activations(path)))
+    else:
+        return QuantizedActivations(values)
+
+
+def scales_path_for_packed_activations(path):
+    path = Path(path)
+    return path.with_name(path.stem + '.scales.npy')
+
+
+def save_activation(activation_path, activation):
+    '''
+    Writes an activation file atomically, so a reader (or a resumed
+    precompute run) never sees a partially-written file.
+
+    The activation is stored in settings.ACTIVATION_STORAGE_FORMAT, as
+    returned by activation_file_values.
+    '''
+    quantized = QuantizedActivations.quantize(activation, settings.ACTIVATION_STORAGE_FORMAT)
+    activation_path = Path(activation_path)
+    temp_path = activation_path.with_name(
+        f'.{activation_path.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+    )
+
+    with open(temp_path, 'wb') as f:
+        np.save(f, activation_file_values(quantized))
+
+    os.replace(temp_path, activation_path)
 
-    return activations_load_pool.map(load_fn, activations_paths)
+
+def load_activation(activation_path):
+    # activations may be stored in reduced precision, see save_activation
+    values = np.load(activation_path)
+    if values.dtype == np.float32:
+        return values
+    return quantized_activation_from_file_values(values).dequantize()
+
+
+def activation_file_values(quantized):
+    '''
+    Returns the array to store for a single quantized activation. int8
+    activations have their float32 scale appended, as four more int8 values.
+    '''
+    if quantized.format == 'int8':
+        scale = np.asarray(quantized.scales, dtype=np.float32).reshape(1).view(np.int8)
+        return np.concatenate([quantized.values, scale])
+    return quantized.values
+
+
+def quantized_activation_from_file_values(values):
+    '''
+    The inverse of activation_file_values. values may be memory-mapped, in
+    which case the result is too.
+    '''
+    if values.dtype == np.int8:
+        return QuantizedActivations(values[:-4], values[-4:].view(np.float32)[0])
+    return QuantizedActivations(values)
 
 
 def load_and_normalize_activation(activation_path):
-    activation = np.load(activation_path)
+    activation = load_activation(activation_path)
     activation /= np.linalg.norm(activation)
     return activation
 
@@ -148,6 +428,53 @@ def cav_content_dir(user_generated):
     return content_dir
 
 
+def present_artifacts(image_refs: List[ImageReference], artifacts):
+    '''
+    Returns a list with the set of artifacts that exist for each image ref.
+    The content index is asked first, in one query per content dir, and only
+    the files it doesn't know about are checked on the filesystem.
+    '''
+    artifacts = set(artifacts)
+    result = [None] * len(image_refs)
+
+    for user_generated in {i.user_generated for i in image_refs}:
+        positions = [n for n, i in enumerate(image_refs) if i.user_generated == user_generated]
+        index = get_content_index(cav_content_dir(user_generated))
+        indexed = index.present_artifacts(image_refs[n].id for n in positions) if index is not None else {}
+        found = []
+
+        for n in positions:
+            image_ref = image_refs[n]
+            present = indexed.get(image_ref.id, set()) & artifacts
+
+            for artifact in artifacts - present:
+                if image_ref.artifact_path(artifact).exists():
+                    present.add(artifact)
+                    found.append((image_ref.id, artifact))
+
+            result[n] = present
+
+        if index is not None:
+            index.add_artifacts(found)
+
+    return result
+
+
+def record_artifacts(image_artifacts):
+    '''
+    Records in the content index that files have been written.
+    image_artifacts is a list of (image_ref, artifact) pairs.
+    '''
+    for user_generated in {image_ref.user_generated for image_ref, _ in image_artifacts}:
+        index = get_content_index(cav_content_dir(user_generated))
+        if index is not None:
+            index.add_artifacts(
+                (image_ref.id, artifact)
+                for image_ref, artifact in image_artifacts
+                if image_ref.user_generated == user_generated
+            )
+
+
 def image_refs_that_need_activations(image_refs: List[ImageReference]):
     '''
     Returns the image refs that are missing activations
@@ -155,29 +482,80 @@ def image_refs_that_need_activations(image_refs: List[ImageReference]):
     # remove duplicate images from image_refs
     image_refs = list({i.id: i for i in image_refs}.values())
 
-    result = []
+    presents = present_artifacts(image_refs, MODEL_LAYERS)
 
-    for image_ref in image_refs:
-        needs_activations = any(not image_ref.activations_path(ml).exists() for ml in MODEL_LAYERS)
-        if needs_activations:
-            result.append(image_ref)
+    return [
+        image_ref
+        for image_ref, present in zip(image_refs, presents)
+        if not all(ml in present for ml in MODEL_LAYERS)
+    ]
 
-    return result
+
+def scan_content_dir(user_generated):
+    '''
+    Yields an (image_id, artifact) pair for each file in a content dir. This
+    reads the directory listing only, without a stat per file, so it's the
+    fastest way to fill an empty content index.
+    '''
+    content_dir = cav_content_dir(user_generated)
+    if not content_dir.exists():
+        return
+
+    suffix_artifacts = {
+        '1x.224x224.png': ARTIFACT_IMAGE_224,
+        '1x.1200x1200.jpg': ARTIFACT_IMAGE_1200,
+        **{f'1x.{ml}.npy': ml for ml in MODEL_LAYERS},
+    }
+
+    with os.scandir(content_dir) as entries:
+        for entry in entries:
+            # skip the index itself, and temp files from atomic writes
+            if entry.name.startswith('.'):
+                continue
+
+            image_id, _, suffix = entry.name.partition('.')
+            artifact = suffix_artifacts.get(suffix)
+            if artifact is not None:
+                yield image_id, artifact
 
 
-def precalculate_activations(image_refs: List[ImageReference]):
+def add_hash_aliases(user_generated, algorithm):
     '''
-    Calculate and store activations for each image ref
+    Hashes every image in a content dir with algorithm, and records each
+    digest as an alias of the image's id in the content index. Run this
+    once after changing settings.IMAGE_HASH_ALGORITHM, so that images
+    ingested again keep their old ids. Returns the number of images hashed.
     '''
-    image_refs = image_refs_that_need_activations(image_refs=image_refs)
+    index = get_content_index(cav_content_dir(user_generated))
+    if index is None:
+        return 0
 
-    # calculate and save activations
-    for image_ref in tqdm(image_refs, unit='image'):
-        image = PIL.Image.open(image_ref.image_224_path)
-        image_pixels = np.array(image)
+    aliases = []
+    for image_id, artifact in scan_content_dir(user_generated):
+        if artifact != ARTIFACT_IMAGE_224:
+            continue
 
-        activations_dict = ml_engine.calculate_activations(MODEL_LAYERS, [image_pixels])[0]
+        image_ref = ImageReference(id=image_id, user_generated=user_generated)
+        with PIL.Image.open(image_ref.image_224_path) as image:
+            digest = image_hash(image.convert('RGB'), algorithm)
+
+        if digest != image_id:
+            aliases.append((digest, image_id))
+
+    index.add_aliases(aliases)
+    return len(aliases)
+
+
+def rebuild_content_index(user_generated):
+    '''
+    Replaces the content index of a content dir with what's on disk, e.g.
+    after files were deleted or copied in outside of CAVstudio. Returns the
+    number of files indexed.
+    '''
+    index = get_content_index(cav_content_dir(user_generated))
+    if index is None:
+        return 0
 
-        for model_layer in MODEL_LAYERS:
-            activations_path = image_ref.activations_path(model_layer)
-            np.save(activations_path, activations_dict[model_layer])
+    image_artifacts = list(scan_content_dir(user_generated))
+    index.replace_artifacts(image_artifacts)
+    return len(image_artifacts)
@@ -13,15 +13,23 @@
 # limitations under the License.
 
 import json
+import logging
+import os
+import threading
 from functools import lru_cache
 from pathlib import Path
 
+import numpy as np
 from cached_property import threaded_cached_property as cached_property
+from cavlib.index import IVFIndex
 from django.conf import settings
 
 from . import activations_cache
-from .image_reference import ImageReference, load_activations
+from .image_reference import ImageReference, load_packed_activations, pack_normalized_activations
 from .ml_engine import MODEL_LAYERS
+from .projections import get_projection, projection_path
+
+logger = logging.getLogger(__name__)
 
 
 class BuiltInImageSet:
@@ -34,24 +42,203 @@ class BuiltInImageSet:
         with open(manifest_file) as f:
             manifest_contents = json.load(f)
 
+        self.version_name = version_name
+        self.manifest_file = manifest_file
+        # model_layer -> memory-mapped bank. Like search indexes, only banks
+        # that were found are kept, so ones built later are picked up.
+        self.activation_banks = {}
+        self.projected_banks = {}
+        self.search_indexes = {}
+        self.warned_model_layers = set()
         self.image_refs = [ImageReference(id=image_dict['id'], user_generated=False)
                            for image_dict in manifest_contents['images']]
 
-    @cached_property
-    def all_normalized_activations(self):
-        results = {}
-
-        for model_layer in MODEL_LAYERS:
-            results[model_layer] = load_activations(
-                self.image_refs,
-                model_layer=model_layer,
-                normalize=True
-            )
+    def activation_bank_path(self, model_layer):
+        '''
+        The activation bank is a single .npy matrix of the normalized
+        activations of every image in the manifest, row-aligned with
+        image_refs. It's memory-mapped when used, so it's shared between
+        worker processes via the page cache.
+        '''
+        format = settings.ACTIVATION_STORAGE_FORMAT
+        return (Path(settings.STATIC_CAV_CONTENT_ROOT) / 'activation-banks'
+                / f'{self.version_name}.{model_layer}.{format}.npy')
+
+    def activation_bank_is_current(self, model_layer):
+        bank_path = self.activation_bank_path(model_layer)
+        return bank_path.exists() and bank_path.stat().st_mtime >= self.manifest_file.stat().st_mtime
+
+    def build(self, model_layer):
+        '''
+        Builds the activation bank, projected bank and search index for
+        model_layer. This is done by bin/download_data.py and the
+        build_image_set_indexes job - requests never build them, see
+        normalized_activations.
+        '''
+        self.build_activation_bank(model_layer)
+        if get_projection(model_layer) is not None:
+            self.build_projected_bank(model_layer)
+        if len(self.image_refs) >= settings.SEARCH_INDEX_MIN_IMAGES:
+            self.build_search_index(model_layer)
 
-        return results
+    def build_activation_bank(self, model_layer):
+        bank_path = self.activation_bank_path(model_layer)
+        bank_path.parent.mkdir(parents=True, exist_ok=True)
+        pack_normalized_activations(
+            self.image_refs,
+            model_layer=model_layer,
+            path=bank_path,
+            format=settings.ACTIVATION_STORAGE_FORMAT,
+        )
+        self.activation_banks.pop(model_layer, None)
+
+    def load_activation_bank(self, model_layer):
+        '''
+        Returns the memory-mapped activation bank, or None if it hasn't been
+        built since the manifest last changed.
+        '''
+        bank = self.activation_banks.get(model_layer)
+        if bank is None and self.activation_bank_is_current(model_layer):
+            bank = load_packed_activations(self.activation_bank_path(model_layer))
+            if bank.shape[0] != len(self.image_refs):
+                # e.g. the manifest was replaced by an older file
+                return None
+            self.activation_banks[model_layer] = bank
+        return bank
 
     def normalized_activations(self, model_layer):
-        return self.all_normalized_activations[model_layer]
+        '''
+        Returns the normalized activations of image_refs, from the activation
+        bank. If the bank needs building, they're loaded from each image's
+        activation file instead, which is much slower for large sets.
+        '''
+        bank = self.load_activation_bank(model_layer)
+        if bank is not None:
+            return bank
+
+        self.warn_bank_not_built(model_layer)
+        return np.array(activations_cache.get_normalized_activations(self.image_refs, model_layer=model_layer))
+
+    def warn_bank_not_built(self, model_layer):
+        if model_layer not in self.warned_model_layers:
+            self.warned_model_layers.add(model_layer)
+            logger.warning(
+                'activation banks for %s %s are missing or out of date, so activations are loaded one file at a '
+                'time. Queue a build_image_set_indexes job, or run bin/download_data.py, to build them.',
+                self.version_name, model_layer,
+            )
+
+    def projected_bank_path(self, model_layer):
+        kind = settings.ACTIVATION_PROJECTION_KIND
+        dimensions = settings.ACTIVATION_PROJECTION_DIMENSIONS
+        return self.activation_bank_path(model_layer).with_name(
+            f'{self.version_name}.{model_layer}.{kind}{dimensions}.npy'
+        )
+
+    def projected_bank_is_current(self, model_layer):
+        bank_path = self.projected_bank_path(model_layer)
+        return bank_path.exists() and self.activation_bank_is_current(model_layer) and all(
+            bank_path.stat().st_mtime >= p.stat().st_mtime
+            for p in [self.activation_bank_path(model_layer), projection_path(model_layer)]
+        )
+
+    def build_projected_bank(self, model_layer):
+        projection = get_projection(model_layer)
+        projected = projection.project(self.normalized_activations(model_layer))
+
+        bank_path = self.projected_bank_path(model_layer)
+        temp_path = bank_path.with_name(f'.{bank_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(temp_path, 'wb') as f:
+            np.save(f, projected)
+        os.replace(temp_path, bank_path)
+        self.projected_banks.pop(model_layer, None)
+
+    def search_activations_path(self, model_layer):
+        if get_projection(model_layer) is None:
+            return self.activation_bank_path(model_layer)
+        else:
+            return self.projected_bank_path(model_layer)
+
+    def load_search_bank(self, model_layer):
+        '''
+        Returns the memory-mapped bank of the activations that CAVs are scored
+        against - the projected bank if the model layer has a projection,
+        otherwise the activation bank - or None if it needs building.
+        '''
+        if get_projection(model_layer) is None:
+            return self.load_activation_bank(model_layer)
+
+        bank = self.projected_banks.get(model_layer)
+        if bank is None and self.projected_bank_is_current(model_layer):
+            bank = np.load(self.projected_bank_path(model_layer), mmap_mode='r')
+            if bank.shape[0] != len(self.image_refs):
+                return None
+            self.projected_banks[model_layer] = bank
+        return bank
+
+    def search_activations(self, model_layer):
+        bank = self.load_search_bank(model_layer)
+        if bank is not None:
+            return bank
+
+        if get_projection(model_layer) is None:
+            return self.normalized_activations(model_layer)
+
+        self.warn_bank_not_built(model_layer)
+        return np.array(activations_cache.get_projected_activations(self.image_refs, model_layer=model_layer))
+
+    def search_index_path(self, model_layer):
+        return self.search_activations_path(model_layer).with_suffix('.ivf.npz')
+
+    def build_search_index(self, model_layer, num_lists=None):
+        index = IVFIndex.build(self.search_activations(model_layer), num_lists=num_lists)
+
+        index_path = self.search_index_path(model_layer)
+        temp_path = index_path.with_name(f'.{index_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        index.save(temp_path)
+        os.replace(temp_path, index_path)
+
+    def load_search_index(self, model_layer):
+        index_path = self.search_index_path(model_layer)
+        bank_path = self.search_activations_path(model_layer)
+
+        if index_path.exists() and index_path.stat().st_mtime >= bank_path.stat().st_mtime:
+            return IVFIndex.load(index_path)
+        else:
+            return None
+
+    def search_index(self, model_layer):
+        '''
+        Returns the approximate search index for this set, or None if the set
+        is small enough for exact search, or no index has been built.
+        '''
+        if len(self.image_refs) < settings.SEARCH_INDEX_MIN_IMAGES:
+            return None
+
+        # an index is only used with the bank it was built from
+        if self.load_search_bank(model_layer) is None:
+            return None
+
+        # only found indexes are kept, so an index built while the server is
+        # running is picked up by the next request
+        index = self.search_indexes.get(model_layer)
+        if index is None:
+            index = self.load_search_index(model_layer)
+            if index is not None:
+                self.search_indexes[model_layer] = index
+
+        return index
+
+    @cached_property
+    def stats_sample_indexes(self):
+        '''
+        A fixed random sample of rows, used to estimate score statistics when
+        only part of the set is scored.
+        '''
+        sample_size = min(len(self.image_refs), 10000)
+        sample = np.random.RandomState(0).choice(len(self.image_refs), size=sample_size, replace=False)
+        sample.sort()
+        return sample
 
     def to_json(self):
         return {
@@ -63,11 +250,25 @@ class BuiltInImageSet:
 
 
 class CustomImageSet:
+    # custom sets are small enough to always score in full
+    stats_sample_indexes = None
+
     def __init__(self, image_refs):
         self.image_refs = image_refs
 
     def normalized_activations(self, *, model_layer):
-        return activations_cache.get_normalized_activations(self.image_refs, model_layer=model_layer)
+        activations = activations_cache.get_normalized_activations(self.image_refs, model_layer=model_layer)
+        return np.array(activations)
+
+    def search_activations(self, model_layer):
+        if get_projection(model_layer) is None:
+            return self.normalized_activations(model_layer=model_layer)
+
+        activations = activations_cache.get_projected_activations(self.image_refs, model_layer=model_layer)
+        return np.array(activations)
+
+    def search_index(self, model_layer):
+        return None
 
 
 @lru_cache(maxsize=128)
@@ -0,0 +1,287 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+A background job queue, stored in the Django database.
+
+Slow work - calculating activations, filling the crop activation cache,
+building image set indexes - is enqueued with enqueue_job, and run by one or
+more `manage.py run_job_worker` processes. Clients poll api/jobs/<id> for
+progress. Failed jobs are retried with exponential backoff, up to their
+max_attempts.
+'''
+
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from cavstudio_db.models import Job
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from .image_reference import ImageReference, calculate_missing_activations, open_image_224
+from .image_set import BuiltInImageSet
+from .ml_engine import MODEL_LAYERS
+from .ml_image import get_ml_image
+from .precompute import precalculate_activations
+
+logger = logging.getLogger(__name__)
+
+JOB_HANDLERS = {}
+
+
+def job_handler(kind):
+    '''
+    Decorator that registers a function to run jobs of this kind. It's
+    called as handler(payload, report_progress), where report_progress
+    takes a fraction from 0 to 1, and its return value (which must be
+    JSON-serializable) is stored as the job's result.
+    '''
+    def decorator(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return decorator
+
+
+def enqueue_job(kind, payload, priority=0, max_attempts=3):
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'unknown job kind: {kind}')
+
+    now = time.time()
+    return Job.objects.create(
+        id=uuid.uuid4().hex,
+        kind=kind,
+        payload=payload,
+        priority=priority,
+        max_attempts=max_attempts,
+        created_at=now,
+        run_after=now,
+    )
+
+
+def job_to_json(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'attempts': job.attempts,
+        'result': job.result,
+        'error': job.error,
+    }
+
+
+def claim_next_job(worker_name, kinds=None):
+    '''
+    Marks the highest-priority runnable job as running, and returns it, or
+    None if there isn't one. Safe to call from several worker processes.
+    '''
+    now = time.time()
+
+    while True:
+        candidates = Job.objects.filter(
+            status=Job.STATUS_PENDING, run_after__lte=now, attempts__lt=F('max_attempts'),
+        )
+        if kinds:
+            candidates = candidates.filter(kind__in=kinds)
+        job = candidates.order_by('-priority', 'created_at').first()
+
+        if job is None:
+            return None
+
+        # only one worker can make this update, others will retry with the
+        # next job
+        with transaction.atomic():
+            claimed = Job.objects.filter(id=job.id, status=Job.STATUS_PENDING).update(
+                status=Job.STATUS_RUNNING,
+                worker=worker_name,
+                attempts=job.attempts + 1,
+                heartbeat_at=now,
+            )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def requeue_stale_jobs(stale_seconds):
+    '''
+    Returns running jobs to the queue if their worker hasn't reported in for
+    stale_seconds, e.g. because it was killed. Jobs that have used all
+    their attempts are failed instead, so a job that kills its worker isn't
+    retried forever.
+    '''
+    now = time.time()
+    stale = Job.objects.filter(status=Job.STATUS_RUNNING, heartbeat_at__lt=now - stale_seconds)
+
+    stale.filter(attempts__gte=F('max_attempts')).update(
+        status=Job.STATUS_FAILED, worker='', finished_at=now, error='the worker stopped responding',
+    )
+    return stale.filter(attempts__lt=F('max_attempts')).update(
+        status=Job.STATUS_PENDING, worker='',
+    )
+
+
+def run_job(job):
+    handler = JOB_HANDLERS.get(job.kind)
+
+    def report_progress(fraction):
+        Job.objects.filter(id=job.id).update(progress=float(fraction), heartbeat_at=time.time())
+
+    # handlers can go a long time between progress reports, so keep the job
+    # from looking stale while it runs
+    stop_heartbeat = threading.Event()
+    heartbeat_thread = threading.Thread(
+        target=send_heartbeats, args=(job.id, stop_heartbeat, settings.JOB_HEARTBEAT_SECONDS), daemon=True,
+    )
+    heartbeat_thread.start()
+
+    try:
+        if handler is None:
+            raise ValueError(f'unknown job kind: {job.kind}')
+        result = handler(job.payload, report_progress)
+    except Exception:
+        logger.exception('job %s (%s) failed', job.id, job.kind)
+        job.error = traceback.format_exc()
+
+        if job.attempts < job.max_attempts:
+            job.status = Job.STATUS_PENDING
+            job.run_after = time.time() + settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+        else:
+            job.status = Job.STATUS_FAILED
+            job.finished_at = time.time()
+    else:
+        job.status = Job.STATUS_DONE
+        job.progress = 1.0
+        job.result = result
+        job.finished_at = time.time()
+    finally:
+        stop_heartbeat.set()
+        heartbeat_thread.join()
+
+    job.worker = ''
+    job.save(update_fields=['status', 'progress', 'result', 'error', 'worker', 'run_after', 'finished_at'])
+    return job
+
+
+def send_heartbeats(job_id, stop, interval):
+    '''
+    Updates the job's heartbeat every interval seconds until stop is set.
+    Runs on its own thread, while the job runs.
+    '''
+    try:
+        while not stop.wait(interval):
+            try:
+                Job.objects.filter(id=job_id, status=Job.STATUS_RUNNING).update(heartbeat_at=time.time())
+            except Exception:
+                logger.exception('failed to update the heartbeat of job %s', job_id)
+    finally:
+        # each thread has its own database connection
+        connection.close()
+
+
+def run_worker(kinds=None, poll_interval=1.0, once=False):
+    '''
+    Runs jobs until interrupted. If once is set, returns when the queue is
+    empty.
+    '''
+    worker_name = f'{socket.gethostname()}:{os.getpid()}'
+    requeue_stale_jobs(settings.JOB_STALE_SECONDS)
+
+    while True:
+        job = claim_next_job(worker_name, kinds=kinds)
+
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            requeue_stale_jobs(settings.JOB_STALE_SECONDS)
+            continue
+
+        logger.info('running job %s (%s)', job.id, job.kind)
+        run_job(job)
+
+
+@job_handler('calculate_activations')
+def calculate_activations_job(payload, report_progress):
+    '''
+    Calculates the missing activations of payload['images'], a list of image
+    reference JSON dicts, such as images uploaded with background=true.
+    '''
+    image_refs = [ImageReference.from_json(i) for i in payload['images']]
+    batch_size = settings.UPLOAD_IMAGES_BATCH_SIZE
+
+    for start in range(0, len(image_refs), batch_size):
+        batch = image_refs[start:start+batch_size]
+        calculate_missing_activations([
+            (image_ref, open_image_224(image_ref.image_224_path.read_bytes()))
+            for image_ref in batch
+        ])
+        report_progress((start + len(batch)) / len(image_refs))
+
+    return {'count': len(image_refs)}
+
+
+@job_handler('precalculate_activations')
+def precalculate_activations_job(payload, report_progress):
+    '''
+    Calculates the missing activations of every image in the built-in image
+    set payload['image_set'].
+    '''
+    image_refs = BuiltInImageSet(payload['image_set']).image_refs
+    done = 0
+
+    def on_progress(count):
+        nonlocal done
+        done += count
+        report_progress(done / max(1, len(image_refs)))
+
+    precalculate_activations(image_refs, processes=payload.get('processes'), on_progress=on_progress)
+    return {'count': len(image_refs)}
+
+
+@job_handler('precalculate_crops')
+def precalculate_crops_job(payload, report_progress):
+    '''
+    Fills the crop activation cache for payload['images'], so that heatmaps
+    and top crops of those images don't need inference.
+    '''
+    image_refs = [ImageReference.from_json(i) for i in payload['images']]
+
+    for i, image_ref in enumerate(image_refs):
+        ml_image = get_ml_image(image_ref.image_224_path, image_id=image_ref.id)
+        ml_image.precalculate_crops(payload['model_layer'])
+        report_progress((i + 1) / len(image_refs))
+
+    return {'count': len(image_refs)}
+
+
+@job_handler('build_image_set_indexes')
+def build_image_set_indexes_job(payload, report_progress):
+    '''
+    Builds the activation banks, projected banks and search indexes for the
+    built-in image set payload['image_set'].
+    '''
+    image_set = BuiltInImageSet(payload['image_set'])
+    model_layers = payload.get('model_layers', MODEL_LAYERS)
+
+    for i, model_layer in enumerate(model_layers):
+        image_set.build(model_layer)
+        report_progress((i + 1) / len(model_layers))
+
+    return {'model_layers': model_layers}
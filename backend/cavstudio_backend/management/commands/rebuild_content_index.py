@@ -0,0 +1,45 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cavstudio_backend.image_reference import add_hash_aliases, cav_content_dir, rebuild_content_index
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the index of which image files and activations exist, from the '
+            'content directory listings. Run after adding or deleting content files by hand.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', choices=['static', 'user'],
+                            help='only rebuild the index of built-in (static) or user-generated content')
+        parser.add_argument('--hash-aliases', action='store_true',
+                            help='also hash every image with IMAGE_HASH_ALGORITHM, so images keep their '
+                                 'ids when ingested again. Run once after changing IMAGE_HASH_ALGORITHM.')
+
+    def handle(self, *args, only=None, hash_aliases=False, **options):
+        if not settings.CONTENT_INDEX_ENABLED:
+            raise CommandError('the content index is disabled by CONTENT_INDEX_ENABLED')
+
+        for user_generated in [False, True]:
+            if only == ('static' if user_generated else 'user'):
+                continue
+
+            count = rebuild_content_index(user_generated)
+            self.stdout.write(f'{cav_content_dir(user_generated)}: indexed {count} files')
+
+            if hash_aliases:
+                count = add_hash_aliases(user_generated, settings.IMAGE_HASH_ALGORITHM)
+                self.stdout.write(f'{cav_content_dir(user_generated)}: added {count} hash aliases')
@@ -0,0 +1,39 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from cavstudio_backend.jobs import JOB_HANDLERS, run_worker
+
+
+class Command(BaseCommand):
+    help = 'Runs background jobs from the job queue. Run several to process jobs in parallel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kinds', nargs='+', choices=sorted(JOB_HANDLERS),
+                            help='only run jobs of these kinds')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='seconds to wait between checks when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='exit when the queue is empty')
+
+    def handle(self, *args, kinds=None, poll_interval=1.0, once=False, **options):
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+        try:
+            run_worker(kinds=kinds, poll_interval=poll_interval, once=once)
+        except KeyboardInterrupt:
+            pass
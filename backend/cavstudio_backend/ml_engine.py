@@ -18,6 +18,7 @@ import warnings
 warnings.filterwarnings('ignore', category=FutureWarning)
 
 from cached_property import threaded_cached_property as cached_property
+from django.conf import settings
 
 from .utils import assert_shape
 from cavlib.models import GooglenetModel, MobilenetModel, Model
@@ -36,16 +37,17 @@ MODEL_LAYERS = [
 
 
 class MLEngine(object):
-    def __init__(self):
-        pass
+    def __init__(self, num_interpreters=None, num_threads=None):
+        self.num_interpreters = num_interpreters or settings.ML_INTERPRETERS_PER_MODEL
+        self.num_threads = num_threads or settings.ML_THREADS_PER_INTERPRETER
 
     @cached_property
     def mobilenet_model(self) -> Model:
-        return MobilenetModel()
+        return MobilenetModel(num_interpreters=self.num_interpreters, num_threads=self.num_threads)
 
     @cached_property
     def googlenet_model(self) -> Model:
-        return GooglenetModel()
+        return GooglenetModel(num_interpreters=self.num_interpreters, num_threads=self.num_threads)
 
     def model_for_model_layer(self, model_layer: str) -> Model:
         if model_layer.startswith('mobilenet_'):
@@ -62,16 +64,25 @@ class MLEngine(object):
         if model_layer == MODEL_LAYER_GOOGLENET_5B:
             return 'mixed5b'
 
+    def activation_shape(self, model_layer):
+        '''
+        The (height, width, channels) shape of the feature map that
+        model_layer activations are flattened from.
+        '''
+        model = self.model_for_model_layer(model_layer)
+        return model.activation_shape(self.layer_name_for_model_layer(model_layer))
+
     def calculate_activations(self, model_layers, images) -> list:
         '''
             Args:
                 model_layers (list): List of model layer identifiers
-                images (list): List of numpy arrays of shape (224, 244, 3)
+                images (list): List of numpy arrays of shape (224, 224, 3)
 
             Returns:
                 List of dicts, containing {model_layer: numpy.ndarray}
 
-            Avoid calling with a lot of images. If many are needed, chunk input into 20 and call with each in turn.
+            Images are run through each model in batches, so passing many
+            images at once is much faster than calling this for each image.
         '''
         if len(images) == 0:
             return []
@@ -89,12 +100,12 @@ class MLEngine(object):
 
             layer_names = [self.layer_name_for_model_layer(m) for m in model_layers_for_this_model]
 
-            for i, image in enumerate(images):
-                activations = model.get_multiple_activations_for_image(image=image, layer_names=layer_names)
+            activations = model.get_activations_for_batch(images=images, layer_names=layer_names)
 
-                for model_layer in model_layers_for_this_model:
-                    layer_name = self.layer_name_for_model_layer(model_layer)
-                    results[i][model_layer] = activations[layer_name].reshape(-1)
+            for model_layer in model_layers_for_this_model:
+                layer_name = self.layer_name_for_model_layer(model_layer)
+                for i, activation in enumerate(activations[layer_name]):
+                    results[i][model_layer] = activation
 
         return results
 
@@ -12,17 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import namedtuple
-from methodtools import lru_cache
+import functools
+import threading
+from collections import OrderedDict, defaultdict
 
 import numpy as np
 import PIL.Image
-import skimage.transform
 import sklearn.preprocessing
+from cavlib.utils import top_k_indices
+from django.conf import settings
 
 from cavstudio_backend.utils import assert_shape, parse_hex_color
 from cavstudio_backend.ml_engine import ml_engine
 from cavstudio_backend.cav import CAV
+from cavstudio_backend.crop_activation_store import get_crop_activation_store
 
 heatmap_colormap = np.array([
     # format is:
@@ -38,9 +41,35 @@ heatmap_colormap = np.array([
     [1.50] + parse_hex_color('#FFFFFF'),  # extra element for overshoots
 ])
 
+HEATMAP_ZOOM_LEVELS = [3, 4, 5, 6]
+
+# the number of tiles along each side of the image for fast heatmaps. 2 reuses
+# the top crop tiles, and gives a feature map twice the model's resolution.
+FAST_HEATMAP_SCALE = 2
+
+# (center, zoom_level) of each crop considered for the top crop
+TOP_CROP_SPECS = [
+    ((1/2, 1/2), 1),
+
+    ((3/8, 3/8), 4/3),
+    ((5/8, 3/8), 4/3),
+    ((5/8, 5/8), 4/3),
+    ((3/8, 5/8), 4/3),
+
+    ((1/4, 1/4), 2),
+    ((2/4, 1/4), 2),
+    ((3/4, 1/4), 2),
+    ((1/4, 2/4), 2),
+    ((2/4, 2/4), 2),
+    ((3/4, 2/4), 2),
+    ((1/4, 3/4), 2),
+    ((2/4, 3/4), 2),
+    ((3/4, 3/4), 2),
+]
+
 
 class MLImageCrop:
-    def __init__(self, center, zoom_level, pixels, activations_dict=None):
+    def __init__(self, center, zoom_level, pixels=None, activations_dict=None):
         self.center = center
         self.zoom_level = zoom_level
         self.pixels = pixels
@@ -50,19 +79,6 @@ class MLImageCrop:
     def dimension(self):
         return 1 / self.zoom_level
 
-    @staticmethod
-    def calculate_activations(crops, model_layer):
-        crops_needing_activations = [c for c in crops if model_layer not in c.activations_dict]
-
-        activations_dicts = ml_engine.calculate_activations(
-            model_layers=[model_layer],
-            images=[c.pixels for c in crops_needing_activations]
-        )
-
-        # store the activations on the image so they can be used later
-        for crop, activations_dict in zip(crops_needing_activations, activations_dicts):
-            crop.activations_dict = activations_dict
-
     def to_crop_spec_json(self):
         return {
             'x': self.center[0] - self.dimension/2,
@@ -77,11 +93,17 @@ class MLImage:
     image: PIL.Image.Image
 
     @classmethod
-    def load(cls, image_224_path):
-        return cls(PIL.Image.open(image_224_path))
-
-    def __init__(self, image):
+    def load(cls, image_224_path, image_id=None):
+        return cls(PIL.Image.open(image_224_path), image_id=image_id)
+
+    def __init__(self, image, image_id=None):
+        '''
+        If image_id is given, crop activations are also kept in the crop
+        activation store, so they're shared with other processes and survive
+        restarts.
+        '''
         self.image = image
+        self.image_id = image_id
 
         assert self.image.size[0] == 224 and self.image.size[1] == 224
         assert self.image.mode == 'RGB'
@@ -89,6 +111,37 @@ class MLImage:
         self.pixels = np.array(image)
         assert_shape(self.pixels, (224, 224, 3))
 
+        # crop activations, keyed by (center, zoom_level, model_layer)
+        self.crop_activations = {}
+        self.crop_activations_lock = threading.Lock()
+        self.stored_model_layers = set()
+        self.crop_activations_nbytes = 0
+        # serializes writes to the crop activation store, so a slow write
+        # can't replace a newer one. Held without crop_activations_lock.
+        self.store_lock = threading.Lock()
+        # model_layer -> the number of crops last written to the store
+        self.stored_counts = {}
+        # called with the number of bytes added, when crops are added
+        self.on_grow = None
+
+    @property
+    def nbytes(self):
+        '''
+        The memory used by the pixels and crop activations. It grows as crops
+        are calculated.
+        '''
+        return self.pixels.nbytes + self.crop_activations_nbytes
+
+    def add_crop_activation(self, key, activation):
+        '''
+        Must hold self.crop_activations_lock.
+        '''
+        if key not in self.crop_activations:
+            self.crop_activations[key] = activation
+            self.crop_activations_nbytes += activation.nbytes
+            if self.on_grow is not None:
+                self.on_grow(activation.nbytes)
+
     @property
     def width(self):
         return self.pixels.shape[0]
@@ -97,22 +150,101 @@ class MLImage:
     def height(self):
         return self.pixels.shape[1]
 
-    def get_crop_heatmap(self, cav: CAV):
-        crops = []
-        zoom_levels = [3, 4, 5, 6]
+    def heatmap_crop_specs(self):
+        return [
+            (center, zoom_level)
+            for zoom_level in HEATMAP_ZOOM_LEVELS
+            for center in self.square_checkerboard_centers(zoom_level)
+        ]
 
-        for zoom_level in zoom_levels:
-            for center in self.square_checkerboard_centers(zoom_level):
-                crops.append(self.cropped_image(
-                    center=center,
-                    zoom_level=zoom_level,
-                ))
+    def crops(self, crop_specs, model_layer):
+        '''
+        Returns an MLImageCrop with model_layer activations for each (center,
+        zoom_level) in crop_specs. Crops that haven't been calculated before
+        are resized and run through the model together, in one batch.
+
+        The lock is only held to look up and add activations, so concurrent
+        requests for the same image don't wait for each other's inference.
+        They might calculate the same crop twice, which is harmless.
+        '''
+        store = get_crop_activation_store() if self.image_id is not None else None
+
+        if store is not None and model_layer not in self.stored_model_layers:
+            stored = store.get(self.image_id, model_layer)
+            with self.crop_activations_lock:
+                for (center, zoom_level), activation in stored.items():
+                    self.add_crop_activation((center, zoom_level, model_layer), activation)
+                self.stored_model_layers.add(model_layer)
+                self.stored_counts.setdefault(model_layer, len(stored))
+
+        with self.crop_activations_lock:
+            missing_specs = [
+                (center, zoom_level) for center, zoom_level in dict.fromkeys(crop_specs)
+                if (center, zoom_level, model_layer) not in self.crop_activations
+            ]
+
+        if missing_specs:
+            pixels = resize_crops(self.pixels, [self.bbox(center, zoom) for center, zoom in missing_specs])
+            activations_dicts = ml_engine.calculate_activations(model_layers=[model_layer], images=pixels)
+
+            with self.crop_activations_lock:
+                for (center, zoom_level), activations_dict in zip(missing_specs, activations_dicts):
+                    self.add_crop_activation((center, zoom_level, model_layer), activations_dict[model_layer])
+
+            if store is not None:
+                self.store_crop_activations(store, model_layer)
+
+        with self.crop_activations_lock:
+            crop_activations = {
+                (center, zoom_level): self.crop_activations[center, zoom_level, model_layer]
+                for center, zoom_level in crop_specs
+            }
+
+        return [
+            MLImageCrop(
+                center=center,
+                zoom_level=zoom_level,
+                activations_dict={model_layer: crop_activations[center, zoom_level]},
+            )
+            for center, zoom_level in crop_specs
+        ]
 
-        MLImageCrop.calculate_activations(crops, model_layer=cav.model_layer)
+    def store_crop_activations(self, store, model_layer):
+        '''
+        Writes every crop activation for model_layer to the store, unless a
+        write that already included them all has happened.
+        '''
+        with self.store_lock:
+            with self.crop_activations_lock:
+                activations_by_spec = {
+                    (center, zoom_level): activation
+                    for (center, zoom_level, layer), activation in self.crop_activations.items()
+                    if layer == model_layer
+                }
+
+            if len(activations_by_spec) > self.stored_counts.get(model_layer, 0):
+                store.put(self.image_id, model_layer, activations_by_spec)
+                self.stored_counts[model_layer] = len(activations_by_spec)
+
+    def precalculate_crops(self, model_layer):
+        '''
+        Calculates the crops for both the heatmap and the top crop in a
+        single batch.
+        '''
+        self.crops(self.heatmap_crop_specs() + TOP_CROP_SPECS, model_layer=model_layer)
+
+    def crop_scores(self, crops, cav: CAV):
         activations = [c.activations_dict[cav.model_layer] for c in crops]
-
         activations = sklearn.preprocessing.normalize(activations, copy=False)
-        scores = np.dot(activations, cav.vector)
+        return np.dot(activations, cav.vector)
+
+    def crop_heatmap_values(self, cav: CAV):
+        '''
+        Returns a (224, 224) array, where each pixel is the mean CAV score of
+        the crops that contain it.
+        '''
+        crops = self.crops(self.heatmap_crop_specs(), model_layer=cav.model_layer)
+        scores = self.crop_scores(crops, cav)
 
         heatmap = np.zeros((224, 224), dtype=np.float32)
 
@@ -120,8 +252,46 @@ class MLImage:
             bbox = self.bbox(crop.center, crop.zoom_level)
             heatmap[bbox[2]:bbox[3], bbox[0]:bbox[1]] += score
 
-        heatmap /= len(zoom_levels)
+        heatmap /= len(HEATMAP_ZOOM_LEVELS)
+        return heatmap
+
+    def fast_heatmap_values(self, cav: CAV, scale=FAST_HEATMAP_SCALE):
+        '''
+        A much faster approximation of crop_heatmap_values. The image is
+        split into scale x scale tiles, which are run through the model in
+        one batch. The CAV score of each tile is the sum of a contribution
+        from each cell of its feature map, so those contributions are used as
+        the heatmap, scaled so that their mean over a tile is the tile's
+        score.
+        '''
+        rows, columns, channels = ml_engine.activation_shape(cav.model_layer)
+        cav_vector = (cav.vector / np.linalg.norm(cav.vector)).reshape((rows, columns, channels))
+
+        tile_specs = [(center, scale) for center in self.square_checkerboard_centers(scale)]
+        tiles = self.crops(tile_specs, model_layer=cav.model_layer)
 
+        cells = np.zeros((rows * scale, columns * scale), dtype=np.float32)
+
+        for tile in tiles:
+            activation = tile.activations_dict[cav.model_layer]
+            contributions = np.einsum(
+                'ijk,ijk->ij', activation.reshape((rows, columns, channels)), cav_vector
+            ) * (rows * columns / np.linalg.norm(activation))
+
+            x = int(tile.center[0] * scale)
+            y = int(tile.center[1] * scale)
+            cells[y*rows:(y+1)*rows, x*columns:(x+1)*columns] = contributions
+
+        # upsample the cells to the image size
+        return cubic_resize_matrix(cells.shape[0], 224) @ cells @ cubic_resize_matrix(cells.shape[1], 224).T
+
+    def get_crop_heatmap(self, cav: CAV):
+        return self.render_heatmap(self.crop_heatmap_values(cav), cav)
+
+    def get_fast_heatmap(self, cav: CAV, scale=FAST_HEATMAP_SCALE):
+        return self.render_heatmap(self.fast_heatmap_values(cav, scale=scale), cav)
+
+    def render_heatmap(self, heatmap, cav: CAV):
         if cav.stats is None:
             raise Exception('cav stats required to render heatmap')
 
@@ -145,34 +315,12 @@ class MLImage:
         return PIL.Image.fromarray(np.uint8(image_array * 255), 'RGB')
 
     def top_crops_and_scores(self, cav):
-        crop_specs = [
-            ((1/2, 1/2), 1),
-
-            ((3/8, 3/8), 4/3),
-            ((5/8, 3/8), 4/3),
-            ((5/8, 5/8), 4/3),
-            ((3/8, 5/8), 4/3),
-
-            ((1/4, 1/4), 2),
-            ((2/4, 1/4), 2),
-            ((3/4, 1/4), 2),
-            ((1/4, 2/4), 2),
-            ((2/4, 2/4), 2),
-            ((3/4, 2/4), 2),
-            ((1/4, 3/4), 2),
-            ((2/4, 3/4), 2),
-            ((3/4, 3/4), 2),
-        ]
-        crops = [self.cropped_image(center, zoom) for center, zoom in crop_specs]
-        MLImageCrop.calculate_activations(crops, model_layer=cav.model_layer)
-        activations = [c.activations_dict[cav.model_layer] for c in crops]
-
-        activations = sklearn.preprocessing.normalize(activations, copy=False)
-        scores = np.dot(activations, cav.vector)
-        sorting_indexes = (-scores).argsort()
+        crops = self.crops(TOP_CROP_SPECS, model_layer=cav.model_layer)
+        scores = self.crop_scores(crops, cav)
+        sorting_indexes = top_k_indices(scores, len(crops))
 
         sorted_crops = [crops[i] for i in sorting_indexes]
-        sorted_scores = [scores[i] for i in sorting_indexes]
+        sorted_scores = scores[sorting_indexes].tolist()
 
         return sorted_crops, sorted_scores
 
@@ -191,15 +339,6 @@ class MLImage:
                     y*dimension + dimension/2,
                 )
 
-    @lru_cache(128)
-    def cropped_image(self, center: tuple, zoom_level) -> MLImageCrop:
-        bbox = self.bbox(center, zoom_level)
-
-        small_cropped_image = self.pixels[bbox[2]:bbox[3], bbox[0]:bbox[1], :]
-        pixels = skimage.transform.resize(small_cropped_image, (224, 224), order=3)
-
-        return MLImageCrop(center=center, zoom_level=zoom_level, pixels=pixels)
-
     def bbox(self, center, zoom_level):
         src_width = self.width / float(zoom_level)
         src_height = self.height / float(zoom_level)
@@ -213,3 +352,143 @@ class MLImage:
         bottom = int(round(src_center_y + src_height/2))
 
         return (left, right, top, bottom)
+
+
+class MLImageCache:
+    '''
+    An LRU cache of MLImages, bounded by the memory used by their pixels and
+    crop activations. An MLImage grows as its crops are calculated, and
+    reports that to the cache, which keeps a running total.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # key -> [ml_image, bytes counted for it]
+            self.entries = OrderedDict()
+            self.total_bytes = 0
+
+    def get(self, image_224_path, image_id=None):
+        key = (str(image_224_path), image_id)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[0]
+
+        # load outside the lock, so other threads aren't held up by the disk
+        ml_image = MLImage.load(image_224_path, image_id=image_id)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                # another thread loaded it first
+                self.entries.move_to_end(key)
+                return entry[0]
+
+            entry = [ml_image, ml_image.nbytes]
+            self.entries[key] = entry
+            self.total_bytes += entry[1]
+            ml_image.on_grow = functools.partial(self.grew, key, entry)
+            self.evict()
+
+        return ml_image
+
+    def grew(self, key, entry, nbytes):
+        with self.lock:
+            if self.entries.get(key) is entry:
+                entry[1] += nbytes
+                self.total_bytes += nbytes
+                self.evict()
+
+    def evict(self):
+        '''
+        Evicts the least recently used images until the cache fits, but never
+        the most recently used. Must hold self.lock.
+        '''
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, nbytes) = self.entries.popitem(last=False)
+            self.total_bytes -= nbytes
+
+
+ml_image_cache = MLImageCache(max_bytes=settings.ML_IMAGE_CACHE_BYTES)
+
+
+def get_ml_image(image_224_path, image_id=None):
+    '''
+    Returns a shared MLImage, so that crops calculated for one request (e.g.
+    the heatmap) are reused by the next (e.g. the crops).
+    '''
+    return ml_image_cache.get(image_224_path, image_id=image_id)
+
+
+def resize_crops(pixels, bboxes, size=224):
+    '''
+    Cuts each (left, right, top, bottom) bbox out of pixels and resizes it to
+    size x size with cubic convolution (see cubic_resize_matrix). Crops with
+    the same source size are resized together, as two batched matrix
+    products.
+
+    Returns a float32 array of shape (len(bboxes), size, size, channels),
+    with values from 0 to 1.
+    '''
+    image = pixels.astype(np.float32) / 255
+    result = np.empty((len(bboxes), size, size, image.shape[2]), dtype=np.float32)
+
+    indexes_by_shape = defaultdict(list)
+    for i, (left, right, top, bottom) in enumerate(bboxes):
+        indexes_by_shape[bottom - top, right - left].append(i)
+
+    for (height, width), indexes in indexes_by_shape.items():
+        crops = np.stack([
+            image[top:bottom, left:right]
+            for left, right, top, bottom in [bboxes[i] for i in indexes]
+        ])
+
+        # resize the rows, then the columns
+        resized = np.matmul(cubic_resize_matrix(height, size), crops.reshape(len(indexes), height, -1))
+        resized = np.matmul(cubic_resize_matrix(width, size), resized.reshape(len(indexes), size, width, -1))
+        result[indexes] = resized
+
+    # cubic convolution can overshoot
+    return np.clip(result, 0, 1, out=result)
+
+
+@functools.lru_cache(maxsize=None)
+def cubic_resize_matrix(input_size, output_size):
+    '''
+    Returns an (output_size, input_size) matrix that resizes a signal with
+    Keys cubic convolution (a = -0.5), sampling at pixel centers.
+
+    This isn't the cubic spline that skimage.transform.resize(order=3) uses,
+    which crops were resized with before. On photos, pixel values differ
+    from skimage's by about 0.004 on average and by up to about 0.08 at
+    sharp edges, on a 0-1 scale, so crop activations and scores change a
+    little.
+    '''
+    a = -0.5
+    positions = (np.arange(output_size) + 0.5) * (input_size / output_size) - 0.5
+    base = np.floor(positions).astype(int)
+
+    matrix = np.zeros((output_size, input_size), dtype=np.float32)
+    rows = np.arange(output_size)
+
+    for offset in range(-1, 3):
+        t = np.abs(positions - (base + offset))
+        weights = np.where(
+            t <= 1,
+            (a + 2) * t**3 - (a + 3) * t**2 + 1,
+            a * t**3 - 5*a * t**2 + 8*a * t - 4*a,
+        )
+        weights[t >= 2] = 0
+
+        # samples past the edges are mirrored, like skimage's 'reflect' mode
+        columns = np.abs(base + offset)
+        columns = np.where(columns > input_size - 1, 2 * (input_size - 1) - columns, columns)
+        np.add.at(matrix, (rows, columns), weights)
+
+    return matrix
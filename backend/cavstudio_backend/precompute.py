@@ -0,0 +1,170 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Bulk precomputation of activations for image banks.
+
+The work is split into chunks, which are handed out to a pool of worker
+processes. Each worker loads its own copy of the models, and pipelines its
+chunk through three stages - decode, inference and write - connected by
+bounded queues, so disk I/O overlaps with inference without buffering the
+whole chunk in memory.
+
+Activation files are written atomically, so a killed run can be resumed by
+running it again - images that already have all their activations are
+skipped. Finished images are recorded in the content index, so finding them
+again is one query per chunk of ids rather than a stat per file.
+'''
+
+import multiprocessing
+import os
+import queue
+import threading
+from typing import List
+
+import numpy as np
+import PIL.Image
+from django.conf import settings
+from tqdm import tqdm
+
+from .image_reference import ImageReference, image_refs_that_need_activations, record_artifacts, save_activation
+from .ml_engine import MODEL_LAYERS, MLEngine, ml_engine
+from .utils import split_into_chunks
+
+# the number of images that each inference call processes
+BATCH_SIZE = 32
+# the number of images handed to a worker process at a time
+CHUNK_SIZE = 256
+# the number of batches that can wait between each pipeline stage
+QUEUE_SIZE = 2
+
+_END = object()
+
+# each worker process has its own engine, created by _init_worker
+_worker_ml_engine = None
+
+
+def precalculate_activations(image_refs: List[ImageReference], processes=None, on_progress=None):
+    '''
+    Calculate and store activations for each image ref.
+
+    :param processes: the number of worker processes to use. Defaults to one
+        per ML_THREADS_PER_INTERPRETER cores. If 1, everything runs in this
+        process.
+    :param on_progress: called with the number of images done, as each
+        chunk finishes. Images that already had activations count as done
+        at the start.
+    '''
+    total_count = len(image_refs)
+    image_refs = image_refs_that_need_activations(image_refs=image_refs)
+    if on_progress is not None:
+        on_progress(total_count - len(image_refs))
+
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 1) // settings.ML_THREADS_PER_INTERPRETER)
+
+    chunks = list(split_into_chunks(image_refs, CHUNK_SIZE))
+
+    with tqdm(total=len(image_refs), unit='image') as progress:
+        if processes == 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                count = _precalculate_chunk(chunk, engine=ml_engine)
+                progress.update(count)
+                if on_progress is not None:
+                    on_progress(count)
+            return
+
+        # use spawn rather than fork, since the interpreters' threads don't
+        # survive a fork
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=processes, initializer=_init_worker) as pool:
+            for count in pool.imap_unordered(_precalculate_chunk, chunks):
+                progress.update(count)
+                if on_progress is not None:
+                    on_progress(count)
+
+
+def _init_worker():
+    global _worker_ml_engine
+    # one inference thread per worker, so a single interpreter is enough
+    _worker_ml_engine = MLEngine(num_interpreters=1)
+
+
+def _precalculate_chunk(image_refs: List[ImageReference], engine=None):
+    engine = engine or _worker_ml_engine
+    batches = list(split_into_chunks(image_refs, BATCH_SIZE))
+
+    decoded_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    write_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    errors = []
+
+    def decode():
+        try:
+            for batch in batches:
+                pixels = [np.array(PIL.Image.open(image_ref.image_224_path)) for image_ref in batch]
+                decoded_queue.put((batch, pixels))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            decoded_queue.put(_END)
+
+    def write():
+        while True:
+            item = write_queue.get()
+            if item is _END:
+                return
+            if errors:
+                # keep draining, so the inference stage doesn't block
+                continue
+
+            batch, activations_dicts = item
+            try:
+                for image_ref, activations_dict in zip(batch, activations_dicts):
+                    for model_layer in MODEL_LAYERS:
+                        save_activation(image_ref.activations_path(model_layer), activations_dict[model_layer])
+                # one index transaction per batch
+                record_artifacts([(image_ref, ml) for image_ref in batch for ml in MODEL_LAYERS])
+            except Exception as e:
+                errors.append(e)
+
+    decode_thread = threading.Thread(target=decode, daemon=True)
+    write_thread = threading.Thread(target=write, daemon=True)
+    decode_thread.start()
+    write_thread.start()
+
+    while True:
+        item = decoded_queue.get()
+        if item is _END:
+            break
+        if errors:
+            # keep draining, so the decode stage doesn't block
+            continue
+
+        batch, pixels = item
+        try:
+            activations_dicts = engine.calculate_activations(MODEL_LAYERS, pixels)
+        except Exception as e:
+            errors.append(e)
+            continue
+
+        write_queue.put((batch, activations_dicts))
+
+    write_queue.put(_END)
+    decode_thread.join()
+    write_thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return len(image_refs)
@@ -0,0 +1,96 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from cavlib.projection import Projection
+from django.conf import settings
+
+from .gram_cache import clear_gram_caches
+from .image_reference import load_activation, load_activations
+
+PROJECTIONS_DIR = Path(settings.STATIC_CAV_CONTENT_ROOT) / 'projections'
+
+
+def projection_path(model_layer):
+    kind = settings.ACTIVATION_PROJECTION_KIND
+    dimensions = settings.ACTIVATION_PROJECTION_DIMENSIONS
+    return PROJECTIONS_DIR / f'{model_layer}.{kind}{dimensions}.npz'
+
+
+@lru_cache(maxsize=None)
+def get_projection(model_layer):
+    '''
+    Returns the projection for model_layer, or None if projections are
+    disabled or it hasn't been built yet.
+    '''
+    if not settings.ACTIVATION_PROJECTION_DIMENSIONS:
+        return None
+
+    path = projection_path(model_layer)
+    if not path.exists():
+        return None
+
+    return Projection.load(path)
+
+
+def project_vector(vector, model_layer):
+    '''
+    Projects a CAV vector to match the image sets' search_activations.
+    '''
+    projection = get_projection(model_layer)
+    return vector if projection is None else projection.project(vector)
+
+
+def build_projection(model_layer, image_refs, sample_size=20000, max_sample_bytes=1024**3):
+    '''
+    Fits a projection to a random sample of image_refs, and saves it for
+    get_projection. The sample is limited to max_sample_bytes of
+    activations, so for large model layers it's smaller than sample_size.
+    '''
+    rng = np.random.RandomState(0)
+    dimensions = settings.ACTIVATION_PROJECTION_DIMENSIONS
+    input_dimensions = len(load_activation(image_refs[0].activations_path(model_layer)))
+
+    if settings.ACTIVATION_PROJECTION_KIND == 'pca':
+        row_bytes = input_dimensions * np.dtype(np.float32).itemsize
+        sample_size = min(sample_size, len(image_refs), max(dimensions * 2, max_sample_bytes // row_bytes))
+        sample = [image_refs[i] for i in sorted(rng.choice(len(image_refs), size=sample_size, replace=False))]
+
+        # load into one preallocated array, rather than a list of arrays
+        # and a copy of them
+        activations = np.empty((len(sample), input_dimensions), dtype=np.float32)
+        for start in range(0, len(sample), 1000):
+            chunk = sample[start:start+1000]
+            activations[start:start+len(chunk)] = load_activations(chunk, model_layer=model_layer, normalize=True)
+
+        projection = Projection.fit_pca(activations, dimensions, model_layer=model_layer, random_state=rng)
+    elif settings.ACTIVATION_PROJECTION_KIND == 'random':
+        projection = Projection.random(input_dimensions, dimensions, model_layer=model_layer, random_state=rng)
+    else:
+        raise ValueError(f'unknown ACTIVATION_PROJECTION_KIND: {settings.ACTIVATION_PROJECTION_KIND}')
+
+    path = projection_path(model_layer)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    projection.save(temp_path)
+    os.replace(temp_path, path)
+
+    get_projection.cache_clear()
+    clear_gram_caches(model_layer)
+    return projection
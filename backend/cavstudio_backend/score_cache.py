@@ -0,0 +1,56 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+SCORE_CACHE_DIR = Path(settings.USER_DATA_DIR) / 'cav-scores'
+
+
+def ranked_scores_path(cav_id, image_set):
+    return SCORE_CACHE_DIR / f'{cav_id}.{image_set.version_name}.npz'
+
+
+def save_ranked_scores(cav_id, image_set, indexes, scores):
+    '''
+    Stores the top results of a CAV on a built-in image set, sorted by
+    descending score, so they can be paged through later without scoring
+    the set again.
+    '''
+    path = ranked_scores_path(cav_id, image_set)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(temp_path, 'wb') as f:
+        np.savez(f, indexes=np.asarray(indexes, dtype=np.int64), scores=np.asarray(scores, dtype=np.float32))
+    os.replace(temp_path, path)
+
+
+def load_ranked_scores(cav_id, image_set):
+    '''
+    Returns (indexes, scores) saved by save_ranked_scores, or None if
+    nothing is saved, or the image set's manifest has changed since.
+    '''
+    path = ranked_scores_path(cav_id, image_set)
+
+    try:
+        if path.stat().st_mtime < image_set.manifest_file.stat().st_mtime:
+            return None
+        with np.load(path) as data:
+            return data['indexes'], data['scores']
+    except FileNotFoundError:
+        return None
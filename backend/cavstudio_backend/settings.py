@@ -87,6 +87,126 @@ DATABASES = {
     }
 }
 
+# Each model keeps a pool of interpreters so that concurrent requests can run
+# inference in parallel. By default, use roughly one interpreter per
+# ML_THREADS_PER_INTERPRETER cores.
+ML_THREADS_PER_INTERPRETER = int(os.environ.get('ML_THREADS_PER_INTERPRETER', '4'))
+ML_INTERPRETERS_PER_MODEL = int(os.environ.get(
+    'ML_INTERPRETERS_PER_MODEL',
+    max(1, (os.cpu_count() or 1) // ML_THREADS_PER_INTERPRETER)
+))
+
+# The precision that activations are stored in, on disk and in memory. One
+# of 'float32', 'float16' or 'int8'. Reduced precision makes activations 2x
+# or 4x smaller, at a small cost to ranking quality - use
+# bin/benchmark_activation_formats.py to measure it.
+ACTIVATION_STORAGE_FORMAT = os.environ.get('ACTIVATION_STORAGE_FORMAT', 'float32')
+
+# The api/upload_images endpoint accepts up to UPLOAD_IMAGES_MAX_COUNT images
+# per request, and calculates their activations UPLOAD_IMAGES_BATCH_SIZE at
+# a time.
+UPLOAD_IMAGES_MAX_COUNT = int(os.environ.get('UPLOAD_IMAGES_MAX_COUNT', '1000'))
+UPLOAD_IMAGES_BATCH_SIZE = int(os.environ.get('UPLOAD_IMAGES_BATCH_SIZE', '32'))
+# each image is uploaded as two files
+DATA_UPLOAD_MAX_NUMBER_FILES = 2 * UPLOAD_IMAGES_MAX_COUNT
+
+# Image ids are hashes of their pixels. IMAGE_HASH_ALGORITHM is 'md5', the
+# original, or 'xxh3_128', which is over 10x faster. After switching, run
+# `manage.py rebuild_content_index --hash-aliases` once; then, with
+# IMAGE_HASH_MD5_COMPAT, images that were already ingested keep their MD5
+# ids when they're uploaded again.
+IMAGE_HASH_ALGORITHM = os.environ.get('IMAGE_HASH_ALGORITHM', 'md5')
+IMAGE_HASH_MD5_COMPAT = (os.environ.get('IMAGE_HASH_MD5_COMPAT', 'True') == 'True')
+
+# The files that exist for each image are recorded in a SQLite index in each
+# content directory, so checking for them doesn't stat every file. On a
+# network filesystem, where SQLite locking is unreliable, set
+# CONTENT_INDEX_DIR to a local directory to keep the indexes there instead.
+# The indexes are rebuilt as needed, so they can be deleted at any time.
+CONTENT_INDEX_ENABLED = (os.environ.get('CONTENT_INDEX_ENABLED', 'True') == 'True')
+CONTENT_INDEX_DIR = os.environ.get('CONTENT_INDEX_DIR', '')
+
+# Background jobs are run by `manage.py run_job_worker`. Failed jobs are
+# retried after JOB_RETRY_DELAY seconds, doubling on each attempt. Workers
+# update a heartbeat on each running job every JOB_HEARTBEAT_SECONDS; jobs
+# whose heartbeat is older than JOB_STALE_SECONDS are assumed to have lost
+# their worker, and are queued again, or failed if they have no attempts
+# left.
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', '10'))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get('JOB_HEARTBEAT_SECONDS', '30'))
+JOB_STALE_SECONDS = float(os.environ.get('JOB_STALE_SECONDS', '600'))
+
+# Activations loaded for training and custom image sets are cached in memory,
+# up to ACTIVATION_CACHE_BYTES per worker process (and a separate
+# PROJECTED_ACTIVATION_CACHE_BYTES for projected activations). If
+# ACTIVATION_CACHE_SHARED_DIR is set, ideally to a directory on a tmpfs like
+# /dev/shm/cavstudio-activations, activations are also stored there and
+# memory-mapped, so all the workers share one copy, of up to
+# ACTIVATION_CACHE_SHARED_BYTES.
+ACTIVATION_CACHE_BYTES = int(os.environ.get('ACTIVATION_CACHE_BYTES', str(2 * 1024**3)))
+PROJECTED_ACTIVATION_CACHE_BYTES = int(os.environ.get('PROJECTED_ACTIVATION_CACHE_BYTES', str(256 * 1024**2)))
+ACTIVATION_CACHE_SHARED_DIR = os.environ.get('ACTIVATION_CACHE_SHARED_DIR', '')
+ACTIVATION_CACHE_SHARED_BYTES = int(os.environ.get('ACTIVATION_CACHE_SHARED_BYTES', str(8 * 1024**3)))
+
+# Activations are read from disk by one pool of ACTIVATION_IO_THREADS threads,
+# shared by all requests. Reads are made ACTIVATION_IO_BATCH_SIZE at a time,
+# and each request has at most ACTIVATION_IO_REQUEST_CONCURRENCY batches in
+# flight, so a large custom image set can't hold up other requests.
+ACTIVATION_IO_THREADS = int(os.environ.get('ACTIVATION_IO_THREADS', '16'))
+ACTIVATION_IO_BATCH_SIZE = int(os.environ.get('ACTIVATION_IO_BATCH_SIZE', '32'))
+ACTIVATION_IO_REQUEST_CONCURRENCY = int(os.environ.get('ACTIVATION_IO_REQUEST_CONCURRENCY', '8'))
+
+# Built-in image sets with at least this many images are searched with an
+# approximate nearest-neighbour index, if one has been built. Higher
+# SEARCH_INDEX_NPROBE gives better recall, at the cost of latency.
+SEARCH_INDEX_MIN_IMAGES = int(os.environ.get('SEARCH_INDEX_MIN_IMAGES', '100000'))
+SEARCH_INDEX_NPROBE = int(os.environ.get('SEARCH_INDEX_NPROBE', '16'))
+
+# The default linear model trainer for CAVs, the name of a cavlib trainer:
+# 'sgd', 'ridge', 'lda' or 'mean_difference'. Requests to generate_cav can
+# choose a different one with the 'trainer' field.
+CAV_TRAINER = os.environ.get('CAV_TRAINER', 'sgd')
+
+# The number of training images per model layer whose inner products are
+# cached for the 'ridge' and 'lda' trainers, so retraining only computes
+# products for newly added images. The cache takes 4 * N^2 bytes, so the
+# default is 64MB per model layer. Set to 0 to disable.
+GRAM_CACHE_MAX_IMAGES = int(os.environ.get('GRAM_CACHE_MAX_IMAGES', '4096'))
+
+# When a CAV is generated on a built-in image set, this many of its top
+# results are saved, so the api/ranked_results endpoint can page through
+# them without scoring the set again.
+RANKED_SCORES_CACHE_SIZE = int(os.environ.get('RANKED_SCORES_CACHE_SIZE', '10000'))
+
+# The number of images scored between each update from the streaming
+# generate_cav endpoint.
+GENERATE_CAV_STREAM_PARTITION_SIZE = int(os.environ.get('GENERATE_CAV_STREAM_PARTITION_SIZE', '50000'))
+
+# Set ACTIVATION_PROJECTION_DIMENSIONS (e.g. to 256) to train and score CAVs
+# on activations projected down to that many dimensions, which is much
+# faster and lets far more activations fit in the cache. CAVs are still saved
+# in the full activation space. ACTIVATION_PROJECTION_KIND is 'pca' or
+# 'random'. Projections are built by bin/download_data.py; until then, full
+# activations are used.
+ACTIVATION_PROJECTION_DIMENSIONS = int(os.environ.get('ACTIVATION_PROJECTION_DIMENSIONS', '0'))
+ACTIVATION_PROJECTION_KIND = os.environ.get('ACTIVATION_PROJECTION_KIND', 'pca')
+
+# Crop activations for heatmaps are cached on disk, so inspecting an image
+# again with a different CAV doesn't need any inference. The least recently
+# used are deleted to keep the cache under CROP_ACTIVATION_CACHE_BYTES. Set
+# it to 0 to disable the cache.
+CROP_ACTIVATION_CACHE_DIR = os.environ.get(
+    'CROP_ACTIVATION_CACHE_DIR',
+    os.path.join(USER_DATA_DIR, 'crop-activations')
+)
+CROP_ACTIVATION_CACHE_BYTES = int(os.environ.get('CROP_ACTIVATION_CACHE_BYTES', str(4 * 1024**3)))
+
+# Images being inspected are kept in memory with their crop activations, so
+# the heatmap and crops requests for an image share them. Each image takes
+# up to about 40MB per model layer; the least recently used are dropped to
+# keep the total under ML_IMAGE_CACHE_BYTES per worker process.
+ML_IMAGE_CACHE_BYTES = int(os.environ.get('ML_IMAGE_CACHE_BYTES', str(512 * 1024**2)))
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'cavstudio_backend.auth.LocalhostAuthentication',
@@ -0,0 +1,75 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from cavlib.quantization import QuantizedActivations
+from django.test import SimpleTestCase
+
+from cavstudio_backend import activations_cache
+from cavstudio_backend.activations_cache import ActivationCache, SharedActivationStore, owned_nbytes
+
+
+class ActivationCacheTest(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.store = SharedActivationStore(Path(temp_dir.name), max_bytes=1024**3)
+
+    def mapped(self, name):
+        self.store.put(name, QuantizedActivations(np.ones(1000, dtype=np.float32)))
+        return self.store.get(name)
+
+    def test_mapped_activations_are_not_counted(self):
+        mapped = self.mapped('a')
+        self.assertIsInstance(mapped.values, np.memmap)
+        self.assertEqual(owned_nbytes(mapped), 0)
+        self.assertEqual(owned_nbytes(np.ones(1000, dtype=np.float32)), 4000)
+
+    def test_mapped_activations_do_not_evict_owned_ones(self):
+        cache = ActivationCache(max_bytes=5000)
+        cache.get('owned', 'layer', lambda: QuantizedActivations(np.ones(1000, dtype=np.float32)))
+        for i in range(10):
+            cache.get(f'mapped{i}', 'layer', lambda: self.mapped(f'mapped{i}'))
+
+        self.assertIn('owned', cache.entries)
+        self.assertEqual(len(cache.entries), 11)
+        self.assertEqual(cache.stats()['resident_bytes'], 4000)
+
+    def test_owned_activations_are_bounded(self):
+        cache = ActivationCache(max_bytes=5000)
+        for i in range(3):
+            cache.get(i, 'layer', lambda: np.ones(1000, dtype=np.float32))
+
+        self.assertEqual(list(cache.entries), [2])
+        self.assertEqual(cache.stats()['layers']['layer']['evictions'], 2)
+
+    def test_loads_use_the_mapped_copy(self):
+        activation = np.ones(1000, dtype=np.float32)
+
+        with mock.patch.object(activations_cache, 'shared_activation_store', self.store), \
+                mock.patch.object(activations_cache, 'load_and_normalize_activation', return_value=activation):
+            loaded = activations_cache.load_stored_normalized_activation('a')
+
+            self.assertIsInstance(loaded.values, np.memmap)
+            np.testing.assert_array_equal(loaded.dequantize(), activation)
+
+            # if another process evicted it straight away, the private copy is used
+            with mock.patch.object(self.store, 'get', return_value=None):
+                loaded = activations_cache.load_stored_normalized_activation('b')
+            self.assertNotIsInstance(loaded.values, np.memmap)
+            np.testing.assert_array_equal(loaded.dequantize(), activation)
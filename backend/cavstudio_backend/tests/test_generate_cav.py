@@ -0,0 +1,151 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from unittest import mock
+
+from cavlib.trainers import trainer_names
+
+from cavstudio_backend import views
+from cavstudio_backend.cav import CAV
+from cavstudio_backend.ml_engine import MODEL_LAYERS
+
+from .utils import CAVContentTestCase
+
+
+def parse_server_sent_events(content):
+    events = []
+    for message in content.decode('utf8').strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in message.split('\n'))
+        events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+class GenerateCAVTest(CAVContentTestCase):
+    def test_generate_cav(self):
+        response = self.post(views.generate_cav, self.generate_cav_request())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['result_images']), 100)
+
+        cav = CAV.load(response.data['cav_id'])
+        self.assertEqual(cav.stats.to_dict(), response.data['cav_score_stats'])
+
+    def test_generate_cav_with_each_trainer(self):
+        for trainer in trainer_names():
+            with self.subTest(trainer=trainer):
+                response = self.post(views.generate_cav, self.generate_cav_request(trainer=trainer))
+
+                self.assertEqual(response.status_code, 200)
+                cav = CAV.load(response.data['cav_id'])
+                # the CAV should rank its positive images highly
+                top_ids = [image['id'] for image in response.data['result_images'][:20]]
+                self.assertGreater(len(set(top_ids) & set(self.image_ids[:10])), 5)
+                self.assertEqual(cav.stats.to_dict(), response.data['cav_score_stats'])
+
+    def test_generate_cav_unknown_trainer(self):
+        response = self.post(views.generate_cav, self.generate_cav_request(trainer='nope'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_generate_cav_requires_both_classes(self):
+        for trainer in trainer_names():
+            with self.subTest(trainer=trainer):
+                response = self.post(views.generate_cav, self.generate_cav_request(trainer=trainer, negative_images=[]))
+                self.assertEqual(response.status_code, 400)
+
+                zero_weight = [{**image, 'weight': 0} for image in self.training_images(self.image_ids[:10])]
+                response = self.post(views.generate_cav, self.generate_cav_request(
+                    trainer=trainer, positive_images=zero_weight,
+                ))
+                self.assertEqual(response.status_code, 400)
+
+    def test_generate_cav_with_quantized_bank(self):
+        # ridge is deterministic, so the CAVs only differ by the bank format
+        response = self.post(views.generate_cav, self.generate_cav_request(trainer='ridge'))
+        float32_ids = [image['id'] for image in response.data['result_images'][:10]]
+
+        for format in ['float16', 'int8']:
+            with self.subTest(format=format):
+                self.override_settings(ACTIVATION_STORAGE_FORMAT=format)
+                self.build_image_set()
+                response = self.post(views.generate_cav, self.generate_cav_request(trainer='ridge'))
+
+                self.assertEqual(response.status_code, 200)
+                CAV.load(response.data['cav_id'])
+                top_ids = [image['id'] for image in response.data['result_images'][:10]]
+                self.assertGreater(len(set(top_ids) & set(float32_ids)), 7)
+
+    def test_generate_cav_incremental(self):
+        parent_cav_id = self.post(views.generate_cav, self.generate_cav_request()).data['cav_id']
+
+        for value, expected in [(True, True), ('true', True), ('false', False), (False, False)]:
+            with self.subTest(incremental=value):
+                with mock.patch.object(CAV, 'learn_from', wraps=CAV.learn_from) as learn_from:
+                    response = self.post(views.generate_cav, self.generate_cav_request(
+                        parent_cav_id=str(parent_cav_id), incremental=value,
+                    ))
+
+                self.assertEqual(response.status_code, 200)
+                self.assertIs(learn_from.call_args.kwargs['incremental'], expected)
+
+    def test_generate_cav_incremental_requires_parent(self):
+        response = self.post(views.generate_cav, self.generate_cav_request(incremental=True))
+        self.assertEqual(response.status_code, 400)
+
+        parent_cav_id = str(self.post(views.generate_cav, self.generate_cav_request()).data['cav_id'])
+        other_layer = [model_layer for model_layer in MODEL_LAYERS if model_layer != 'googlenet_4d'][0]
+
+        response = self.post(views.generate_cav, self.generate_cav_request(
+            model_layer=other_layer, parent_cav_id=parent_cav_id, incremental=True,
+        ))
+        self.assertEqual(response.status_code, 400)
+
+        # without incremental, a parent on another layer is just not used
+        response = self.post(views.generate_cav, self.generate_cav_request(
+            model_layer=other_layer, parent_cav_id=parent_cav_id,
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    def test_generate_cav_stream(self):
+        self.override_settings(GENERATE_CAV_STREAM_PARTITION_SIZE=100)
+
+        response = self.post(views.generate_cav_stream, self.generate_cav_request())
+        self.assertEqual(response.status_code, 200)
+        events = parse_server_sent_events(b''.join(response.streaming_content))
+
+        # the stats sample is the whole set, so there's no first pass
+        self.assertEqual([name for name, _ in events], ['results'] * 3 + ['done'])
+        self.assertEqual([data['progress'] for _, data in events[:-1]], [1/3, 2/3, 1.0])
+
+        done = events[-1][1]
+        cav = CAV.load(done['cav_id'])
+        self.assertEqual(cav.stats.to_dict(), done['cav_score_stats'])
+        self.assertEqual(done['result_scores'], events[-2][1]['result_scores'])
+
+    def test_generate_cav_empty_custom_set(self):
+        request = self.generate_cav_request(search_set='custom', search_images=[])
+
+        response = self.post(views.generate_cav, request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['result_images'], [])
+        self.assertIsNone(response.data['cav_score_stats'])
+
+        response = self.post(views.generate_cav_stream, request)
+        self.assertEqual(response.status_code, 200)
+        events = parse_server_sent_events(b''.join(response.streaming_content))
+
+        self.assertEqual([name for name, _ in events], ['done'])
+        self.assertEqual(events[0][1]['result_images'], [])
+        self.assertIsNone(events[0][1]['cav_score_stats'])
+        self.assertIsNone(CAV.load(events[0][1]['cav_id']).stats)
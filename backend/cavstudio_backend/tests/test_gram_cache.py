@@ -0,0 +1,46 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from cavstudio_backend.gram_cache import GramCache
+
+
+class GramCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.activations = np.random.RandomState(0).rand(100, 16).astype(np.float32)
+
+    def gram(self, cache, indexes):
+        x = self.activations[indexes]
+        return cache.gram([f'img{i}' for i in indexes], x), x
+
+    def test_matches_full_product_with_eviction(self):
+        cache = GramCache(max_images=40)
+        rng = np.random.RandomState(1)
+
+        for _ in range(20):
+            indexes = rng.choice(100, size=30, replace=False)
+            gram, x = self.gram(cache, indexes)
+            np.testing.assert_allclose(gram, x @ x.T, rtol=1e-5)
+
+        self.assertLessEqual(len(cache.slots), 40)
+
+    def test_full_cache_is_not_copied(self):
+        cache = GramCache(max_images=40)
+        self.gram(cache, np.arange(40))
+        matrix = cache.matrix
+
+        self.gram(cache, np.arange(40, 50))
+        self.assertIs(cache.matrix, matrix)
@@ -0,0 +1,108 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+from unittest import mock
+
+import numpy as np
+import PIL.Image
+
+from cavstudio_backend import image_reference
+from cavstudio_backend.image_reference import (ImageReference, add_hash_aliases, image_hash, injest_image,
+                                               injest_images, load_activation, load_activations, open_image_224,
+                                               save_activation)
+
+from .utils import CAVContentTestCase
+
+
+def fake_calculate_activations(model_layers, images):
+    return [{model_layer: np.random.rand(64).astype(np.float32) for model_layer in model_layers} for _ in images]
+
+
+def png_data(seed):
+    pixels = np.random.RandomState(seed).randint(0, 255, (224, 224, 3), dtype=np.uint8)
+    data = io.BytesIO()
+    PIL.Image.fromarray(pixels).save(data, format='png')
+    return data.getvalue()
+
+
+class InjestImagesTest(CAVContentTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(
+            image_reference.ml_engine, 'calculate_activations', side_effect=fake_calculate_activations,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_md5_ids_are_unchanged(self):
+        image224 = open_image_224(png_data(1))
+        expected = hashlib.md5(np.array(image224, dtype='<u1').tobytes(order='C')).hexdigest()
+
+        self.assertEqual(image_hash(image224), expected)
+        self.assertEqual(injest_image(png_data(1), b'jpg', user_generated=True).id, expected)
+
+    def test_statuses(self):
+        results = injest_images(
+            [(png_data(1), b'jpg'), (png_data(1), b'jpg'), (b'not an image', b'jpg')], user_generated=True,
+        )
+        self.assertEqual([status for _, status in results], ['created', 'duplicate', 'invalid'])
+
+        [(_, status)] = injest_images([(png_data(1), b'jpg')], user_generated=True)
+        self.assertEqual(status, 'existing')
+
+    def test_new_images_are_hashed_once(self):
+        self.override_settings(IMAGE_HASH_ALGORITHM='xxh3_128')
+
+        with mock.patch.object(image_reference, 'image_hash', wraps=image_hash) as image_hash_mock:
+            image = injest_image(png_data(1), b'jpg', user_generated=True)
+
+        self.assertEqual([c.args[1] for c in image_hash_mock.call_args_list], ['xxh3_128'])
+        self.assertEqual(image.id, image_hash(open_image_224(png_data(1)), 'xxh3_128'))
+
+    def test_existing_images_keep_md5_ids(self):
+        md5_image = injest_image(png_data(1), b'jpg', user_generated=True)
+
+        self.override_settings(IMAGE_HASH_ALGORITHM='xxh3_128')
+        self.assertEqual(add_hash_aliases(user_generated=True, algorithm='xxh3_128'), 1)
+
+        [(image, status)] = injest_images([(png_data(1), b'jpg')], user_generated=True)
+        self.assertEqual((image.id, status), (md5_image.id, 'existing'))
+
+
+class ActivationFileTest(CAVContentTestCase):
+    def test_formats_keep_magnitude(self):
+        activation = np.random.RandomState(0).rand(64).astype(np.float32) * 20
+        path = self.root / 'activation.npy'
+
+        for format, tolerance in [('float32', 0), ('float16', 1e-2), ('int8', 1e-1)]:
+            with self.subTest(format=format):
+                self.override_settings(ACTIVATION_STORAGE_FORMAT=format)
+                save_activation(path, activation)
+
+                loaded = load_activation(path)
+                self.assertEqual(loaded.dtype, np.float32)
+                np.testing.assert_allclose(loaded, activation, atol=tolerance)
+
+    def test_unnormalized_int8_activations(self):
+        image_ref = ImageReference(id=self.image_ids[0])
+        activation_path = image_ref.activations_path('googlenet_4d')
+        activation = np.load(activation_path)
+
+        self.override_settings(ACTIVATION_STORAGE_FORMAT='int8')
+        save_activation(activation_path, activation)
+
+        [loaded] = load_activations([image_ref], model_layer='googlenet_4d')
+        np.testing.assert_allclose(loaded, activation, rtol=2e-2, atol=np.abs(activation).max() / 127)
@@ -0,0 +1,69 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import numpy as np
+
+from cavstudio_backend import views
+from cavstudio_backend.image_reference import load_activations
+from cavstudio_backend.image_set import BuiltInImageSet
+
+from .utils import CAVContentTestCase
+
+
+class BuiltInImageSetTest(CAVContentTestCase):
+    def expected_activations(self, image_set):
+        return np.array(load_activations(image_set.image_refs, model_layer='googlenet_4d', normalize=True))
+
+    def test_missing_bank_falls_back_to_activation_files(self):
+        image_set = BuiltInImageSet('v1')
+        bank_path = image_set.activation_bank_path('googlenet_4d')
+        bank_path.unlink()
+
+        with self.assertLogs('cavstudio_backend.image_set', level='WARNING'):
+            activations = image_set.search_activations('googlenet_4d')
+
+        np.testing.assert_allclose(activations, self.expected_activations(image_set), rtol=1e-6)
+        # requests don't build banks
+        self.assertFalse(bank_path.exists())
+
+        image_set.build('googlenet_4d')
+        self.assertIsInstance(image_set.search_activations('googlenet_4d'), np.memmap)
+
+    def test_bank_that_does_not_match_manifest_is_not_used(self):
+        # the manifest gains images, but keeps an older mtime than the bank
+        image_set = BuiltInImageSet('v1')
+        manifest_stat = image_set.manifest_file.stat()
+        self.write_activations(['extra'])
+        with open(image_set.manifest_file, 'w') as f:
+            json.dump({'images': [{'id': image_id} for image_id in self.image_ids + ['extra']]}, f)
+        os.utime(image_set.manifest_file, (manifest_stat.st_atime, manifest_stat.st_mtime))
+
+        image_set = BuiltInImageSet('v1')
+        with self.assertLogs('cavstudio_backend.image_set', level='WARNING'):
+            activations = image_set.normalized_activations('googlenet_4d')
+
+        self.assertEqual(len(activations), self.NUM_IMAGES + 1)
+        self.assertIsNone(image_set.search_index('googlenet_4d'))
+
+    def test_generate_cav_without_banks(self):
+        for bank_path in BuiltInImageSet('v1').activation_bank_path('googlenet_4d').parent.iterdir():
+            bank_path.unlink()
+
+        with self.assertLogs('cavstudio_backend.image_set', level='WARNING'):
+            response = self.post(views.generate_cav, self.generate_cav_request())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['result_images']), 100)
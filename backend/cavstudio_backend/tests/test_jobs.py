@@ -0,0 +1,99 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from unittest import mock
+
+from cavstudio_db.models import Job
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIRequestFactory
+
+from cavstudio_backend import views
+
+from cavstudio_backend.jobs import JOB_HANDLERS, claim_next_job, enqueue_job, requeue_stale_jobs, run_job
+
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(JOB_HANDLERS, {'test': lambda payload, report_progress: payload})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run_job(self):
+        enqueue_job('test', {'a': 1})
+
+        job = run_job(claim_next_job('worker'))
+
+        self.assertEqual(job.status, Job.STATUS_DONE)
+        self.assertEqual(job.result, {'a': 1})
+        self.assertIsNone(claim_next_job('worker'))
+
+    def test_create_job_priority(self):
+        def create_job(data):
+            return views.create_job(APIRequestFactory().post('/', data, format='json', REMOTE_ADDR='127.0.0.1'))
+
+        response = create_job({'kind': 'test', 'priority': '5'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Job.objects.get(id=response.data['id']).priority, 5)
+
+        for priority in ['high', 1.5, None]:
+            with self.subTest(priority=priority):
+                self.assertEqual(create_job({'kind': 'test', 'priority': priority}).status_code, 400)
+
+    def test_stale_job_is_requeued(self):
+        job = enqueue_job('test', {}, max_attempts=2)
+        claim_next_job('worker')
+        Job.objects.filter(id=job.id).update(heartbeat_at=time.time() - 100)
+
+        self.assertEqual(requeue_stale_jobs(stale_seconds=10), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_PENDING)
+        self.assertEqual(claim_next_job('worker').id, job.id)
+
+    def test_stale_job_with_no_attempts_left_fails(self):
+        job = enqueue_job('test', {}, max_attempts=1)
+        claim_next_job('worker')
+        Job.objects.filter(id=job.id).update(heartbeat_at=time.time() - 100)
+
+        self.assertEqual(requeue_stale_jobs(stale_seconds=10), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_FAILED)
+        self.assertIsNone(claim_next_job('worker'))
+
+    def test_job_with_no_attempts_left_is_not_claimed(self):
+        enqueue_job('test', {}, max_attempts=1)
+        Job.objects.update(attempts=1)
+
+        self.assertIsNone(claim_next_job('worker'))
+
+
+# the heartbeat is sent from another thread, which needs to see the job
+# outside of the test's transaction
+class JobHeartbeatTest(TransactionTestCase):
+    @override_settings(JOB_HEARTBEAT_SECONDS=0.05, JOB_STALE_SECONDS=0.5)
+    def test_heartbeat_keeps_long_job_running(self):
+        def slow_handler(payload, report_progress):
+            # runs for longer than JOB_STALE_SECONDS, without reporting
+            # progress
+            for _ in range(10):
+                time.sleep(0.1)
+                self.assertEqual(requeue_stale_jobs(stale_seconds=0.5), 0)
+            return 'done'
+
+        with mock.patch.dict(JOB_HANDLERS, {'slow': slow_handler}):
+            enqueue_job('slow', {})
+            job = run_job(claim_next_job('worker'))
+
+        self.assertEqual(job.status, Job.STATUS_DONE)
+        self.assertEqual(job.attempts, 1)
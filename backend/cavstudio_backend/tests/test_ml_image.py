@@ -0,0 +1,177 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import PIL.Image
+import skimage.transform
+from django.conf import settings
+
+from cavstudio_backend import ml_image as ml_image_module
+from cavstudio_backend.cav import CAV
+from cavstudio_backend.crop_activation_store import CropActivationStore
+from cavstudio_backend.ml_image import TOP_CROP_SPECS, MLImage, MLImageCache, resize_crops
+
+from .utils import CAVContentTestCase
+
+# the activations of the fake model used in these tests, from 8x8 blocks of
+# the crop's pixels - the real models aren't available to tests
+FAKE_ACTIVATION_SHAPE = (28, 28, 3)
+
+
+def fake_calculate_activations(model_layers, images):
+    pooled = np.asarray(images).reshape(len(images), 28, 8, 28, 8, 3).mean(axis=(2, 4))
+    return [{model_layer: p.reshape(-1) for model_layer in model_layers} for p in pooled]
+
+
+def skimage_resize_crops(pixels, bboxes, size=224):
+    return np.stack([
+        skimage.transform.resize(pixels[top:bottom, left:right], (size, size), order=3)
+        for left, right, top, bottom in bboxes
+    ])
+
+
+TEST_IMAGE = Path(settings.BASE_DIR).parent / 'cavlib' / 'tests' / 'test_data' / '0a8d36f893911e09a257cfaea8a8543a.1x.224x224.png'
+
+
+class ResizeCropsTest(CAVContentTestCase):
+    def test_matches_skimage(self):
+        ml_image = MLImage.load(TEST_IMAGE)
+        bboxes = [ml_image.bbox(center, zoom_level) for center, zoom_level in ml_image.heatmap_crop_specs() + TOP_CROP_SPECS]
+
+        resized = resize_crops(ml_image.pixels, bboxes)
+        expected = skimage_resize_crops(ml_image.pixels, bboxes)
+
+        # Keys cubic interpolation, rather than skimage's cubic spline, so
+        # they differ a little, mostly at sharp edges
+        difference = np.abs(resized - expected)
+        self.assertLess(difference.mean(), 6e-3)
+        self.assertLess(difference.max(), 0.1)
+
+    def test_crop_rankings_match_skimage(self):
+        # crops were resized with skimage before, so heatmaps and top crops
+        # should rank crops the same way. With a fake model that averages
+        # pixels, this only checks the resizing, not the model's sensitivity.
+        rng = np.random.RandomState(0)
+        ml_image = MLImage.load(TEST_IMAGE)
+        specs = ml_image.heatmap_crop_specs() + TOP_CROP_SPECS
+
+        with mock.patch.object(ml_image_module.ml_engine, 'calculate_activations', fake_calculate_activations):
+            crops = ml_image.crops(specs, 'googlenet_4d')
+            with mock.patch.object(ml_image_module, 'resize_crops', skimage_resize_crops):
+                expected_crops = MLImage.load(TEST_IMAGE).crops(specs, 'googlenet_4d')
+
+        for i in range(5):
+            cav = CAV(id=i, vector=rng.randn(np.prod(FAKE_ACTIVATION_SHAPE)), model_layer='googlenet_4d')
+            scores = ml_image.crop_scores(crops, cav)
+            expected = ml_image.crop_scores(expected_crops, cav)
+
+            ranks = np.argsort(np.argsort(scores))
+            expected_ranks = np.argsort(np.argsort(expected))
+            self.assertGreater(np.corrcoef(ranks, expected_ranks)[0, 1], 0.99)
+            self.assertEqual(np.argmax(scores), np.argmax(expected))
+
+class MLImageCropsTest(CAVContentTestCase):
+    def test_inference_and_storage_outside_lock(self):
+        ml_image = MLImage.load(TEST_IMAGE, image_id='test')
+        store = CropActivationStore(self.root / 'crops', max_bytes=1024**3)
+
+        def calculate_activations(model_layers, images):
+            self.assertFalse(ml_image.crop_activations_lock.locked())
+            return fake_calculate_activations(model_layers, images)
+
+        def put(*args):
+            self.assertFalse(ml_image.crop_activations_lock.locked())
+            return CropActivationStore.put(store, *args)
+
+        with mock.patch.object(ml_image_module.ml_engine, 'calculate_activations', calculate_activations), \
+                mock.patch.object(ml_image_module, 'get_crop_activation_store', return_value=store), \
+                mock.patch.object(store, 'put', side_effect=put) as store_put:
+            crops = ml_image.crops(TOP_CROP_SPECS, 'googlenet_4d')
+            # already stored, so not written again
+            ml_image.crops(TOP_CROP_SPECS[:3], 'googlenet_4d')
+
+        self.assertEqual(store_put.call_count, 1)
+        self.assertEqual(len(store.get('test', 'googlenet_4d')), len(TOP_CROP_SPECS))
+        self.assertEqual(len(crops), len(TOP_CROP_SPECS))
+
+    def test_concurrent_crops(self):
+        ml_image = MLImage.load(TEST_IMAGE)
+        inference_started = threading.Event()
+        finish_inference = threading.Event()
+
+        def slow_calculate_activations(model_layers, images):
+            inference_started.set()
+            finish_inference.wait(5)
+            return fake_calculate_activations(model_layers, images)
+
+        with mock.patch.object(ml_image_module.ml_engine, 'calculate_activations', fake_calculate_activations):
+            ml_image.crops(TOP_CROP_SPECS[:1], 'googlenet_4d')
+
+        with mock.patch.object(ml_image_module.ml_engine, 'calculate_activations', slow_calculate_activations):
+            thread = threading.Thread(target=ml_image.crops, args=(TOP_CROP_SPECS, 'googlenet_4d'))
+            thread.start()
+            inference_started.wait(5)
+
+            # crops that are already calculated don't wait for the inference
+            crops = ml_image.crops(TOP_CROP_SPECS[:1], 'googlenet_4d')
+            self.assertTrue(thread.is_alive())
+            finish_inference.set()
+            thread.join()
+
+        self.assertEqual(len(crops), 1)
+        self.assertEqual(len(ml_image.crop_activations), len(TOP_CROP_SPECS))
+
+
+class MLImageCacheTest(CAVContentTestCase):
+    def write_image(self, name):
+        path = self.root / f'{name}.png'
+        pixels = np.random.RandomState(len(name)).randint(0, 255, (224, 224, 3), dtype=np.uint8)
+        PIL.Image.fromarray(pixels).save(path)
+        return path
+
+    def test_bounded_by_bytes(self):
+        paths = [self.write_image(f'image{i}') for i in range(4)]
+        pixels_nbytes = 224 * 224 * 3
+        activation = np.zeros(100000, dtype=np.float32)
+        # room for two images with one crop activation each
+        cache = MLImageCache(max_bytes=2 * (pixels_nbytes + activation.nbytes))
+
+        for path in paths:
+            ml_image = cache.get(path)
+            self.assertIs(cache.get(path), ml_image)
+            with ml_image.crop_activations_lock:
+                ml_image.add_crop_activation(((0.5, 0.5), 1, 'googlenet_4d'), activation)
+
+        cache.get(paths[-1])
+        self.assertEqual(list(cache.entries), [(str(paths[2]), None), (str(paths[3]), None)])
+        self.assertEqual(ml_image.nbytes, pixels_nbytes + activation.nbytes)
+        self.assertEqual(cache.total_bytes, sum(ml_image.nbytes for ml_image, _ in cache.entries.values()))
+
+    def test_loads_outside_lock(self):
+        path = self.write_image('image')
+        cache = MLImageCache(max_bytes=1024**3)
+
+        def load(*args, **kwargs):
+            self.assertFalse(cache.lock.locked())
+            return MLImage(PIL.Image.open(path))
+
+        with mock.patch.object(MLImage, 'load', side_effect=load) as mock_load:
+            ml_image = cache.get(path)
+            self.assertIs(cache.get(path), ml_image)
+
+        self.assertEqual(mock_load.call_count, 1)
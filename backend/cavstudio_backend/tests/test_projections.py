@@ -0,0 +1,69 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+
+import numpy as np
+
+from cavstudio_backend import projections, views
+from cavstudio_backend.cav import CAV
+from cavstudio_backend.image_set import get_builtin_image_set
+from cavstudio_backend.ml_engine import MODEL_LAYERS
+from cavstudio_backend.projections import build_projection, get_projection
+
+from .utils import CAVContentTestCase
+
+
+class ProjectionTest(CAVContentTestCase):
+    def build_projections(self, kind):
+        self.override_settings(ACTIVATION_PROJECTION_DIMENSIONS=16, ACTIVATION_PROJECTION_KIND=kind)
+        image_refs = get_builtin_image_set('v1').image_refs
+        for model_layer in MODEL_LAYERS:
+            build_projection(model_layer, image_refs)
+
+    def test_build_projection(self):
+        for kind in ['pca', 'random']:
+            with self.subTest(kind=kind):
+                self.build_projections(kind)
+                projection = get_projection('googlenet_4d')
+
+                self.assertEqual(projection.kind, kind)
+                self.assertEqual(projection.basis.shape, (16, self.DIMENSIONS))
+                np.testing.assert_allclose(projection.basis @ projection.basis.T, np.eye(16), atol=1e-5)
+
+    def test_build_projection_sample_is_bounded(self):
+        self.override_settings(ACTIVATION_PROJECTION_DIMENSIONS=16, ACTIVATION_PROJECTION_KIND='pca')
+        image_refs = get_builtin_image_set('v1').image_refs
+
+        with mock.patch.object(projections, 'load_activations', wraps=projections.load_activations) as load:
+            # room for 50 activations
+            projection = build_projection('googlenet_4d', image_refs, max_sample_bytes=50 * self.DIMENSIONS * 4)
+
+        self.assertEqual(sum(len(c.args[0]) for c in load.call_args_list), 50)
+        self.assertEqual(projection.basis.shape, (16, self.DIMENSIONS))
+
+    def test_generate_cav_with_projection(self):
+        self.build_projections('pca')
+        self.build_image_set()
+
+        response = self.post(views.generate_cav, self.generate_cav_request())
+        self.assertEqual(response.status_code, 200)
+
+        # CAVs are saved in the full activation space
+        cav = CAV.load(response.data['cav_id'])
+        self.assertEqual(cav.vector.shape, (self.DIMENSIONS,))
+
+        response = self.post(views.generate_cav_stream, self.generate_cav_request())
+        content = b''.join(response.streaming_content).decode('utf8')
+        self.assertIn('event: done', content)
@@ -0,0 +1,40 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from cavstudio_backend import views
+
+from .utils import CAVContentTestCase
+
+
+class RankedResultsTest(CAVContentTestCase):
+    def setUp(self):
+        super().setUp()
+        response = self.post(views.generate_cav, self.generate_cav_request())
+        self.cav_id = str(response.data['cav_id'])
+        self.result_images = response.data['result_images']
+
+    def test_pages(self):
+        response = self.post(views.ranked_results, {'cav_id': self.cav_id, 'search_set': 'v1', 'offset': '10', 'count': '20'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['result_images'], self.result_images[10:30])
+        self.assertEqual(response.data['total'], self.NUM_IMAGES)
+
+    def test_invalid_offset_or_count(self):
+        for offset, count in [('ten', 10), (0, 'ten'), (1.5, 10), (-1, 10), (0, 0), (0, -5)]:
+            with self.subTest(offset=offset, count=count):
+                response = self.post(views.ranked_results, {
+                    'cav_id': self.cav_id, 'search_set': 'v1', 'offset': offset, 'count': count,
+                })
+                self.assertEqual(response.status_code, 400)
@@ -0,0 +1,46 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from cavstudio_backend import views
+
+from .utils import CAVContentTestCase
+
+
+class ScoreCAVsTest(CAVContentTestCase):
+    def test_score_cavs(self):
+        cav_ids = [
+            self.post(views.generate_cav, self.generate_cav_request()).data['cav_id']
+            for _ in range(2)
+        ]
+
+        response = self.post(views.score_cavs, {'cav_ids': [str(i) for i in cav_ids], 'search_set': 'v1', 'count': 10})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['cav_id'] for r in response.data['results']], cav_ids)
+        self.assertEqual(len(response.data['results'][0]['result_images']), 10)
+
+    def test_unknown_cav_id(self):
+        response = self.post(views.score_cavs, {'cav_ids': ['not-a-cav'], 'search_set': 'v1'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_count(self):
+        cav_id = self.post(views.generate_cav, self.generate_cav_request()).data['cav_id']
+
+        for count in ['ten', 1.5, None, 0, -1]:
+            with self.subTest(count=count):
+                response = self.post(views.score_cavs, {'cav_ids': [str(cav_id)], 'search_set': 'v1', 'count': count})
+                self.assertEqual(response.status_code, 400)
+
+        response = self.post(views.score_cavs, {'cav_ids': [str(cav_id)], 'search_set': 'v1', 'count': '10'})
+        self.assertEqual(len(response.data['results'][0]['result_images']), 10)
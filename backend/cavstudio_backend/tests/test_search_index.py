@@ -0,0 +1,65 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+
+import numpy as np
+
+from cavstudio_backend import views
+from cavstudio_backend.cav import score_rows
+from cavstudio_backend.image_set import get_builtin_image_set
+
+from .utils import CAVContentTestCase
+
+
+class SearchIndexTest(CAVContentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.override_settings(SEARCH_INDEX_MIN_IMAGES=100)
+
+    def test_index_built_later_is_used(self):
+        image_set = get_builtin_image_set('v1')
+        self.assertIsNone(image_set.search_index('googlenet_4d'))
+
+        image_set.build_search_index('googlenet_4d', num_lists=8)
+        self.assertIsNotNone(image_set.search_index('googlenet_4d'))
+
+    def test_generate_cav_with_index(self):
+        get_builtin_image_set('v1').build_search_index('googlenet_4d', num_lists=8)
+
+        with mock.patch('cavstudio_backend.views.score_rows', wraps=score_rows) as score_rows_mock:
+            response = self.post(views.generate_cav, self.generate_cav_request())
+
+        self.assertEqual(response.status_code, 200)
+        score_rows_mock.assert_called_once()
+        self.assertEqual(len(response.data['result_images']), 100)
+
+    def test_generate_cav_exact(self):
+        get_builtin_image_set('v1').build_search_index('googlenet_4d', num_lists=8)
+
+        for value, uses_index in [('true', False), ('false', True), (True, False)]:
+            with self.subTest(exact=value):
+                with mock.patch('cavstudio_backend.views.score_rows', wraps=score_rows) as score_rows_mock:
+                    response = self.post(views.generate_cav, self.generate_cav_request(exact=value))
+
+                self.assertEqual(response.status_code, 200)
+                # the stats sample is only scored when the index is used
+                self.assertEqual(score_rows_mock.called, uses_index)
+
+    def test_score_rows(self):
+        activations = np.random.RandomState(0).rand(1000, 8).astype(np.float32)
+        vector = np.ones(8)
+        indexes = np.sort(np.random.RandomState(1).choice(1000, size=300, replace=False))
+
+        np.testing.assert_allclose(score_rows(activations, indexes, vector, chunk_size=64), activations[indexes].dot(vector))
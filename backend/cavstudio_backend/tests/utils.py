@@ -0,0 +1,124 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from django.test import TestCase, override_settings
+from rest_framework.test import APIRequestFactory
+
+from cavstudio_backend import activations_cache, content_index, gram_cache
+from cavstudio_backend.cav import get_cav
+from cavstudio_backend.image_reference import ImageReference
+from cavstudio_backend.image_set import get_builtin_image_set
+from cavstudio_backend.ml_engine import MODEL_LAYERS
+from cavstudio_backend.ml_image import ml_image_cache
+from cavstudio_backend.projections import get_projection
+
+
+class CAVContentTestCase(TestCase):
+    '''
+    A test case with its own content directories, holding a built-in image
+    set called 'v1' of NUM_IMAGES images with random activations of
+    DIMENSIONS dimensions, so the views can be tested without the models.
+    '''
+    NUM_IMAGES = 300
+    DIMENSIONS = 64
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.root = Path(temp_dir.name)
+
+        self.override_settings(
+            STATIC_CAV_CONTENT_ROOT=str(self.root / 'static'),
+            USER_DATA_DIR=str(self.root / 'user'),
+            MEDIA_ROOT=str(self.root / 'user' / 'media'),
+            CROP_ACTIVATION_CACHE_DIR=str(self.root / 'crop-activations'),
+        )
+        # paths that are computed when their modules are imported
+        for target, value in [
+            ('cavstudio_backend.cav.CAV_FOLDER', self.root / 'user' / 'media' / 'cavs'),
+            ('cavstudio_backend.projections.PROJECTIONS_DIR', self.root / 'static' / 'projections'),
+            ('cavstudio_backend.score_cache.SCORE_CACHE_DIR', self.root / 'user' / 'cav-scores'),
+        ]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        clear_caches()
+        self.addCleanup(clear_caches)
+
+        self.image_ids = [f'img{i:04d}' for i in range(self.NUM_IMAGES)]
+        self.write_activations(self.image_ids)
+
+        manifests_dir = self.root / 'static' / 'manifests'
+        manifests_dir.mkdir(parents=True)
+        with open(manifests_dir / 'v1.json', 'w') as f:
+            json.dump({'images': [{'id': image_id} for image_id in self.image_ids]}, f)
+        self.build_image_set()
+
+    def build_image_set(self):
+        '''
+        Builds the banks and indexes of 'v1' for the current settings, like
+        bin/download_data.py does.
+        '''
+        image_set = get_builtin_image_set('v1')
+        for model_layer in MODEL_LAYERS:
+            image_set.build(model_layer)
+
+    def override_settings(self, **kwargs):
+        overrides = override_settings(**kwargs)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # settings are read lazily, but some results are cached
+        clear_caches()
+
+    def write_activations(self, image_ids):
+        rng = np.random.RandomState(0)
+        for image_id in image_ids:
+            image_ref = ImageReference(id=image_id)
+            image_ref.activations_path(MODEL_LAYERS[0]).parent.mkdir(parents=True, exist_ok=True)
+            for model_layer in MODEL_LAYERS:
+                np.save(image_ref.activations_path(model_layer), rng.rand(self.DIMENSIONS).astype(np.float32))
+
+    def post(self, view, data, format='json'):
+        request = APIRequestFactory().post('/', data, format=format, REMOTE_ADDR='127.0.0.1')
+        return view(request)
+
+    def training_images(self, image_ids):
+        return [{'id': image_id, 'user_generated': False, 'weight': 1} for image_id in image_ids]
+
+    def generate_cav_request(self, **kwargs):
+        return {
+            'positive_images': self.training_images(self.image_ids[:10]),
+            'negative_images': self.training_images(self.image_ids[10:30]),
+            'model_layer': 'googlenet_4d',
+            'search_set': 'v1',
+            **kwargs,
+        }
+
+
+def clear_caches():
+    get_cav.cache_clear()
+    get_builtin_image_set.cache_clear()
+    get_projection.cache_clear()
+    ml_image_cache.clear()
+    activations_cache.normalized_activation_cache.clear()
+    activations_cache.projected_activation_cache.clear()
+    gram_cache.gram_caches.clear()
+    content_index._content_indexes.clear()
@@ -20,8 +20,15 @@ from cavstudio_backend import views
 
 urlpatterns = [
     path('api/ping_cav_server', views.ping),
+    path('api/cache_stats', views.cache_stats),
+    path('api/jobs', views.create_job),
+    path('api/jobs/<str:id>', views.job_status),
     path('api/upload_image', views.upload_image),
+    path('api/upload_images', views.upload_images),
     path('api/generate_cav', views.generate_cav),
+    path('api/generate_cav_stream', views.generate_cav_stream),
+    path('api/score_cavs', views.score_cavs),
+    path('api/ranked_results', views.ranked_results),
     path('api/inspect', views.inspect),
     path('api/crops', views.crops),
     path('api/heatmap', views.heatmap),
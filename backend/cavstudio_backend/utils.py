@@ -13,20 +13,22 @@
 # limitations under the License.
 
 import base64
+import json
 import re
+from pathlib import Path
 from typing import Type
 
 import numpy as np
 import PIL.Image
 import PIL.ImageColor
+from rest_framework.utils.encoders import JSONEncoder
 
 
-DATA_URI_REGEX = re.compile(
+DATA_URI_HEADER_REGEX = re.compile(
     r'''
     ^data: # header
     ([-\w.]+/[-\w.]+); # capture mime type
-    base64, # encoding (only base64 supported)
-    (.*) # capture the rest of the string
+    base64 # encoding (only base64 supported)
     $
     ''',
     re.VERBOSE
@@ -34,19 +36,39 @@ DATA_URI_REGEX = re.compile(
 
 
 def parse_data_uri(data_uri):
-    match = DATA_URI_REGEX.match(data_uri)
+    # only the header is matched, the data can be large
+    header, _, base64_data = data_uri.partition(',')
+    match = DATA_URI_HEADER_REGEX.match(header)
+    if match is None:
+        raise ValueError('invalid data URI')
 
     mime_type = match.group(1)
-    base64_data = match.group(2)
     data = base64.b64decode(base64_data)
 
     return data, mime_type
 
 
+def parse_bool(value):
+    '''
+    Parses a boolean request field, which is a string in multipart requests.
+    '''
+    if isinstance(value, str):
+        return value.lower() in ('true', '1', 'yes')
+    return bool(value)
+
+
 def serialize_data_uri(data, mime_type):
     return b'data:%b;base64,%b' % (bytes(mime_type, 'ascii'), base64.b64encode(data))
 
 
+def serialize_server_sent_event(event, data):
+    '''
+    Formats data as a text/event-stream message. data is JSON-encoded with
+    the same encoder as REST framework responses.
+    '''
+    return f'event: {event}\ndata: {json.dumps(data, cls=JSONEncoder)}\n\n'
+
+
 class ArrayShapeError(TypeError):
     pass
 
@@ -110,3 +132,28 @@ def parse_hex_color(hex_color):
     '''
     return [c/255.0 for c in PIL.ImageColor.getrgb(hex_color)]
 
+
+def evict_least_recently_used(directory, pattern, target_bytes):
+    '''
+    Deletes the least recently modified files in directory matching pattern
+    until they add up to no more than target_bytes. Returns their remaining
+    total size.
+    '''
+    files = []
+    for path in Path(directory).glob(pattern):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    files.sort()
+    total_bytes = sum(size for _, size, _ in files)
+
+    for _, size, path in files:
+        if total_bytes <= target_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total_bytes -= size
+
+    return total_bytes
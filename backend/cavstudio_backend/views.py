@@ -15,26 +15,58 @@
 import io
 import os
 
+import cavlib
 import numpy as np
-from django.http import Http404
+from cavlib.trainers import trainer_names
+from cavlib.utils import top_k_indices
+from cavstudio_db.models import Job
+from django.conf import settings
+from django.http import Http404, StreamingHttpResponse
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 
-from .cav import CAV
-from .image_reference import ImageReference, TrainingImageReference, injest_image
+from . import activations_cache
+from .cav import CAV, get_cav, score_progressively, score_rows
+from .image_reference import ImageReference, TrainingImageReference, injest_image, injest_images
 from .ml_engine import MODEL_LAYERS
-from .ml_image import MLImage
+from .ml_image import get_ml_image
 from .image_set import BuiltInImageSet, get_builtin_image_set, CustomImageSet
-from .utils import parse_data_uri, serialize_data_uri
+from .jobs import enqueue_job, job_to_json
+from .projections import project_vector
+from .score_cache import load_ranked_scores, save_ranked_scores
+from .utils import parse_bool, parse_data_uri, serialize_data_uri, serialize_server_sent_event
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 @api_view(['POST'])
 def upload_image(request):
-    data224, _ = parse_data_uri(request.data['data224'])
-    data1200, _ = parse_data_uri(request.data['data1200'])
+    '''
+    Takes the image either as a multipart request with 'data224' and
+    'data1200' files, which avoids base64 encoding and is streamed to disk,
+    or as JSON with base64 data URIs.
+    '''
+    if 'data224' in request.FILES:
+        if 'data1200' not in request.FILES:
+            raise ParseError('missing data1200 file')
+        data224 = request.FILES['data224'].read()
+        data1200 = request.FILES['data1200']
+    else:
+        try:
+            data224, _ = parse_data_uri(request.data['data224'])
+            data1200, _ = parse_data_uri(request.data['data1200'])
+        except ValueError:
+            raise ParseError('invalid data URI')
+
+    if parse_bool(request.data.get('background')):
+        # return straight away, and calculate activations in a job
+        [(image, status)] = injest_images([(data224, data1200)], user_generated=True, defer_activations=True)
+        if status == 'invalid':
+            raise ParseError('invalid image')
+
+        job = enqueue_job('calculate_activations', {'images': [image.to_json()]}, priority=10)
+        return Response({**image.to_json(), 'status': status, 'job_id': job.id})
 
     image = injest_image(
         image_data_224=data224, image_data_1200=data1200, user_generated=True
@@ -43,61 +75,324 @@ def upload_image(request):
     return Response(image.to_json())
 
 
+@api_view(['POST'])
+def upload_images(request):
+    '''
+    Bulk version of upload_image. Takes a multipart request with a 'data224'
+    and a 'data1200' file for each image, in the same order, and returns a
+    status for each image. Activations are calculated in batches, so this
+    is much faster than an upload_image request per image. If 'background'
+    is set, activations are calculated in a job instead, whose id is
+    returned as 'job_id'.
+    '''
+    background = parse_bool(request.data.get('background'))
+    files224 = request.FILES.getlist('data224')
+    files1200 = request.FILES.getlist('data1200')
+
+    if len(files224) != len(files1200):
+        raise ParseError('data224 and data1200 must have the same number of files')
+    if len(files224) > settings.UPLOAD_IMAGES_MAX_COUNT:
+        raise ParseError(f'at most {settings.UPLOAD_IMAGES_MAX_COUNT} images can be uploaded at once')
+
+    results = injest_images(
+        [(file224.read(), file1200) for file224, file1200 in zip(files224, files1200)],
+        user_generated=True,
+        batch_size=settings.UPLOAD_IMAGES_BATCH_SIZE,
+        defer_activations=background,
+    )
+
+    job = None
+    pending_images = [image.to_json() for image, status in results if status == 'pending']
+    if pending_images:
+        job = enqueue_job('calculate_activations', {'images': pending_images}, priority=10)
+
+    return Response({
+        'images': [
+            {'image': image.to_json() if image is not None else None, 'status': status}
+            for image, status in results
+        ],
+        'job_id': job.id if job is not None else None,
+    })
+
+
 @api_view(['POST'])
 def generate_cav(request):
+    search_set = search_set_from_request(request)
+    cav = learn_cav_from_request(request)
+    model_layer = cav.model_layer
+
+    # for built-in sets, find enough results to page through later
+    is_builtin = isinstance(search_set, BuiltInImageSet)
+    k = max(100, settings.RANKED_SCORES_CACHE_SIZE) if is_builtin else 100
+
+    search_set_activations = search_set.search_activations(model_layer)
+    search_index = None if parse_bool(request.data.get('exact')) else search_set.search_index(model_layer)
+    # if activations are projected, the CAV was trained in the projected
+    # space, so scoring the projected activations against the projected CAV
+    # gives the same scores as in the full space
+    search_vector = project_vector(cav.vector, model_layer)
+
+    if search_index is None:
+        # use dot product of prenormalised activations to improve performance
+        # (dot product of normalised vectors is the same as cosine similarity)
+        if len(search_set_activations):
+            search_set_scores = search_set_activations.dot(search_vector)
+        else:
+            # an empty custom set's activations don't have a second dimension
+            search_set_scores = np.zeros(0, dtype=np.float32)
+
+        # get top images, sorted descending
+        top_image_indexes = top_k_indices(search_set_scores, k)
+        top_image_scores = search_set_scores[top_image_indexes]
+
+        cav.update_stats_from_scores(search_set_scores)
+    else:
+        top_image_indexes, top_image_scores = search_index.search(
+            search_set_activations, search_vector, k=k, nprobe=settings.SEARCH_INDEX_NPROBE
+        )
+
+        # only part of the set was scored, so estimate the stats
+        sample_indexes = search_set.stats_sample_indexes
+        sample_scores = score_rows(search_set_activations, sample_indexes, search_vector)
+        cav.update_stats_from_sample(sample_scores, top_image_scores[:100])
+
+    cav.save()
+    if is_builtin:
+        save_ranked_scores(cav.id, search_set, top_image_indexes, top_image_scores)
+
+    return Response(generate_cav_result_json(cav, search_set, top_image_indexes[:100], top_image_scores[:100]))
+
+
+@api_view(['POST'])
+def generate_cav_stream(request):
+    '''
+    Streaming version of generate_cav, which responds with server-sent
+    events. A 'results' event is sent with the best results so far after
+    each partition of the search set is scored, then a 'done' event with the
+    same content as the generate_cav response. If the client disconnects,
+    scoring stops at the end of the current partition.
+    '''
+    search_set = search_set_from_request(request)
+    cav = learn_cav_from_request(request)
+
+    response = StreamingHttpResponse(generate_cav_events(cav, search_set), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # ask proxies not to buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def generate_cav_events(cav, search_set):
+    search_set_activations = search_set.search_activations(cav.model_layer)
+    search_vector = project_vector(cav.vector, cav.model_layer)
+    search_set_scores = np.empty(len(search_set_activations), dtype=np.float32)
+
+    progress = score_progressively(
+        search_set_activations,
+        search_vector,
+        k=100,
+        partition_size=settings.GENERATE_CAV_STREAM_PARTITION_SIZE,
+        scores_out=search_set_scores,
+        first_pass_indexes=search_set.stats_sample_indexes,
+    )
+
+    # an empty search set yields no results
+    top_image_indexes = np.zeros(0, dtype=np.intp)
+    top_image_scores = np.zeros(0, dtype=np.float32)
+
+    for top_image_indexes, top_image_scores, fraction_done in progress:
+        yield serialize_server_sent_event('results', {
+            'result_images': [search_set.image_refs[idx].to_json() for idx in top_image_indexes],
+            'result_scores': top_image_scores.tolist(),
+            'progress': fraction_done,
+        })
+
+    cav.update_stats_from_scores(search_set_scores)
+    cav.save()
+    if isinstance(search_set, BuiltInImageSet):
+        ranked_indexes = top_k_indices(search_set_scores, settings.RANKED_SCORES_CACHE_SIZE)
+        save_ranked_scores(cav.id, search_set, ranked_indexes, search_set_scores[ranked_indexes])
+
+    yield serialize_server_sent_event(
+        'done', generate_cav_result_json(cav, search_set, top_image_indexes, top_image_scores)
+    )
+
+
+def learn_cav_from_request(request):
     positive_image_refs = [TrainingImageReference.from_json(i) for i in request.data['positive_images']]
     negative_image_refs = [TrainingImageReference.from_json(i) for i in request.data['negative_images']]
     model_layer = request.data['model_layer']
-    search_set_name = request.data['search_set']
 
     if model_layer not in MODEL_LAYERS:
         raise ParseError('unknown model_layer')
-
-    if search_set_name == 'custom':
-        # the search_images uses a custom JSON structure - just a list of
-        # dicts with ids, to keep the request size down.
-        search_image_refs = [ImageReference(id=i['id'], user_generated=True)
-                             for i in request.data['search_images']]
-        search_set = CustomImageSet(search_image_refs)
-    else:
+    if not sum(i.weight for i in positive_image_refs) > 0 or not sum(i.weight for i in negative_image_refs) > 0:
+        raise ParseError('positive_images and negative_images must each have an image with nonzero weight')
+
+    # warm-start from the previous version of this CAV, if there is one
+    parent_cav = None
+    parent_cav_id = request.data.get('parent_cav_id')
+    incremental = parse_bool(request.data.get('incremental'))
+    if parent_cav_id:
         try:
-            search_set = get_builtin_image_set(search_set_name)
-        except BuiltInImageSet.VersionNotFound:
-            raise ParseError('unknown scout version name')
+            parent_cav = get_cav(parent_cav_id)
+        except FileNotFoundError:
+            raise ParseError('unknown parent_cav_id')
+
+        if parent_cav.model_layer != model_layer:
+            if incremental:
+                raise ParseError('parent_cav_id uses a different model_layer, so it can\'t be trained incrementally')
+            parent_cav = None
+
+    if incremental and parent_cav is None:
+        raise ParseError('incremental training requires a parent_cav_id')
 
-    cav = CAV.learn_from(
+    trainer = request.data.get('trainer') or settings.CAV_TRAINER
+    if trainer not in trainer_names():
+        raise ParseError('unknown trainer')
+
+    return CAV.learn_from(
         positive_image_refs=positive_image_refs,
         negative_image_refs=negative_image_refs,
         model_layer=model_layer,
+        parent_cav=parent_cav,
+        incremental=incremental,
+        trainer=trainer,
     )
 
-    search_set_activations = search_set.normalized_activations(model_layer=model_layer)
 
-    # use dot product of prenormalised activations to improve performance
-    # (dot product of normalised vectors is the same as cosine similarity)
-    search_set_scores = np.dot(search_set_activations, cav.vector)
+def generate_cav_result_json(cav, search_set, top_image_indexes, top_image_scores):
+    return {
+        'result_images': [search_set.image_refs[idx].to_json() for idx in top_image_indexes],
+        'result_scores': top_image_scores.tolist(),
+        'cav_string': cav.summary_string(max_length=500),
+        'cav_id': cav.id,
+        'cav_score_stats': cav.stats.to_dict() if cav.stats is not None else None,
+    }
+
+
+@api_view(['POST'])
+def score_cavs(request):
+    '''
+    Scores a search set against many saved CAVs at once, returning the top
+    results for each.
+    '''
+    cav_ids = request.data['cav_ids']
+    count = int_from_request(request, 'count', default=100, minimum=1)
 
-    # sort descending
-    search_sort_indexes = (-search_set_scores).argsort()
+    if len(cav_ids) == 0:
+        raise ParseError('no cav_ids given')
 
-    # get top images
-    top_image_indexes = search_sort_indexes[0:100]
+    try:
+        cavs = [get_cav(cav_id) for cav_id in cav_ids]
+    except FileNotFoundError:
+        raise ParseError('unknown cav_id in cav_ids')
 
-    top_image_refs = [search_set.image_refs[idx] for idx in top_image_indexes]
-    top_image_scores = [search_set_scores[idx] for idx in top_image_indexes]
+    model_layers = set(cav.model_layer for cav in cavs)
+    if len(model_layers) > 1:
+        raise ParseError('all CAVs must use the same model_layer')
 
-    cav.update_stats_from_scores(search_set_scores)
-    cav.save()
+    cav_bank = cavlib.CAVBank([
+        cavlib.CAV(id=cav.id, vector=project_vector(cav.vector, cav.model_layer), model_layer=cav.model_layer)
+        for cav in cavs
+    ])
+
+    search_set = search_set_from_request(request)
+    search_set_activations = search_set.search_activations(cav_bank.model_layer)
+
+    rankings = cav_bank.top_k(search_set_activations, k=count, normalized=True)
 
     return Response({
-        'result_images': [i.to_json() for i in top_image_refs],
-        'result_scores': top_image_scores,
-        'cav_string': cav.summary_string(max_length=500),
-        'cav_id': cav.id,
-        'cav_score_stats': cav.stats.to_dict()
+        'results': [
+            {
+                'cav_id': ranking.cav.id,
+                'result_images': [search_set.image_refs[idx].to_json() for idx in ranking.indexes],
+                'result_scores': ranking.scores.tolist(),
+            }
+            for ranking in rankings
+        ]
     })
 
 
+@api_view(['POST'])
+def ranked_results(request):
+    '''
+    Returns a page of a CAV's results on a built-in image set, sorted by
+    descending score. Pages within the results saved when the CAV was
+    generated are served without scoring anything.
+    '''
+    cav = load_cav_from_request(request)
+    search_set = search_set_from_request(request)
+    offset = int_from_request(request, 'offset', default=0, minimum=0)
+    count = int_from_request(request, 'count', default=100, minimum=1)
+
+    if not isinstance(search_set, BuiltInImageSet):
+        raise ParseError('ranked_results only supports built-in image sets')
+
+    ranked = load_ranked_scores(cav.id, search_set)
+    if ranked is None or (offset + count > len(ranked[0]) and len(ranked[0]) < len(search_set.image_refs)):
+        # not saved, or the page is deeper than what was saved
+        search_set_scores = search_set.search_activations(cav.model_layer).dot(
+            project_vector(cav.vector, cav.model_layer)
+        )
+        k = max(offset + count, settings.RANKED_SCORES_CACHE_SIZE)
+        ranked_indexes = top_k_indices(search_set_scores, k)
+        ranked = ranked_indexes, search_set_scores[ranked_indexes]
+        save_ranked_scores(cav.id, search_set, *ranked)
+
+    indexes, scores = ranked
+    page_indexes = indexes[offset:offset+count]
+
+    return Response({
+        'result_images': [search_set.image_refs[idx].to_json() for idx in page_indexes],
+        'result_scores': scores[offset:offset+count].tolist(),
+        'offset': offset,
+        'total': len(search_set.image_refs),
+        'cav_score_stats': cav.stats.to_dict() if cav.stats is not None else None,
+    })
+
+
+def int_from_request(request, name, default, minimum=None):
+    '''
+    Parses an integer request field, which is a string in multipart
+    requests, raising ParseError if it's invalid or less than minimum.
+    '''
+    value = request.data.get(name, default)
+
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ParseError(f'invalid {name}')
+    try:
+        value = int(value)
+    except ValueError:
+        raise ParseError(f'invalid {name}')
+
+    if minimum is not None and value < minimum:
+        raise ParseError(f'{name} must be at least {minimum}')
+    return value
+
+
+def load_cav_from_request(request):
+    try:
+        return get_cav(request.data['cav_id'])
+    except FileNotFoundError:
+        raise ParseError('unknown cav_id')
+
+
+def search_set_from_request(request):
+    search_set_name = request.data['search_set']
+
+    if search_set_name == 'custom':
+        # the search_images uses a custom JSON structure - just a list of
+        # dicts with ids, to keep the request size down.
+        search_image_refs = [ImageReference(id=i['id'], user_generated=True)
+                             for i in request.data['search_images']]
+        return CustomImageSet(search_image_refs)
+    else:
+        try:
+            return get_builtin_image_set(search_set_name)
+        except BuiltInImageSet.VersionNotFound:
+            raise ParseError('unknown scout version name')
+
+
 @api_view()
 def image_set(request, name):
     try:
@@ -111,10 +406,11 @@ def image_set(request, name):
 @api_view(['POST'])
 def inspect(request):
     image_ref = ImageReference.from_json(request.data['image'])
-    cav_id = request.data['cav_id']
-    cav = CAV.load(cav_id)
+    cav = load_cav_from_request(request)
 
-    ml_image = MLImage.load(image_ref.image_224_path)
+    ml_image = get_ml_image(image_ref.image_224_path, image_id=image_ref.id)
+    # calculate the crops for the heatmap and top crop in one batch
+    ml_image.precalculate_crops(cav.model_layer)
     heatmap_image = ml_image.get_crop_heatmap(cav)
 
     heatmap_image_png_io = io.BytesIO()
@@ -131,10 +427,9 @@ def inspect(request):
 @api_view(['POST'])
 def crops(request):
     image_ref = ImageReference.from_json(request.data['image'])
-    cav_id = request.data['cav_id']
-    cav = CAV.load(cav_id)
+    cav = load_cav_from_request(request)
 
-    ml_image = MLImage.load(image_ref.image_224_path)
+    ml_image = get_ml_image(image_ref.image_224_path, image_id=image_ref.id)
     crops, scores = ml_image.top_crops_and_scores(cav)
 
     return Response({
@@ -146,13 +441,25 @@ def crops(request):
 
 @api_view(['POST'])
 def heatmap(request):
-    ''' Version of inspect which only does heatmap '''
+    '''
+    Version of inspect which only does heatmap. Set 'mode' to 'fast' for a
+    quicker, lower-quality heatmap made from a single batch of 4 tiles.
+    '''
     image_ref = ImageReference.from_json(request.data['image'])
-    cav_id = request.data['cav_id']
-    cav = CAV.load(cav_id)
-
-    ml_image = MLImage.load(image_ref.image_224_path)
-    heatmap_image = ml_image.get_crop_heatmap(cav)
+    cav = load_cav_from_request(request)
+    mode = request.data.get('mode', 'crops')
+
+    ml_image = get_ml_image(image_ref.image_224_path, image_id=image_ref.id)
+
+    if mode == 'crops':
+        # the top crops are usually requested next, so calculate them in the
+        # same batch
+        ml_image.precalculate_crops(cav.model_layer)
+        heatmap_image = ml_image.get_crop_heatmap(cav)
+    elif mode == 'fast':
+        heatmap_image = ml_image.get_fast_heatmap(cav)
+    else:
+        raise ParseError('unknown heatmap mode')
 
     heatmap_image_png_io = io.BytesIO()
     heatmap_image.save(heatmap_image_png_io, format='png')
@@ -165,3 +472,36 @@ def heatmap(request):
 @api_view()
 def ping(request):
     return Response()
+
+
+@api_view(['POST'])
+def create_job(request):
+    '''
+    Queues a background job, e.g. {"kind": "build_image_set_indexes",
+    "payload": {"image_set": "v1"}}. Poll job_status for its progress.
+    '''
+    priority = int_from_request(request, 'priority', default=0)
+
+    try:
+        job = enqueue_job(request.data['kind'], request.data.get('payload', {}), priority=priority)
+    except ValueError:
+        raise ParseError('unknown job kind')
+
+    return Response(job_to_json(job))
+
+
+@api_view()
+def job_status(request, id):
+    try:
+        job = Job.objects.get(id=id)
+    except Job.DoesNotExist:
+        raise Http404
+
+    return Response(job_to_json(job))
+
+
+@api_view()
+def cache_stats(request):
+    return Response({
+        'activations': activations_cache.cache_stats(),
+    })
@@ -28,3 +28,44 @@ class Snapshot(models.Model):
 class SearchSet(models.Model):
     id = models.CharField(primary_key=True, max_length=100)
     data = models.JSONField()
+
+
+class Job(models.Model):
+    '''
+    A unit of background work, run by `manage.py run_job_worker`. See
+    cavstudio_backend.jobs.
+    '''
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.CharField(primary_key=True, max_length=100)
+    kind = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    # higher priority jobs run first
+    priority = models.IntegerField(default=0)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    progress = models.FloatField(default=0.0)
+    result = models.JSONField(null=True)
+    error = models.TextField(blank=True, default='')
+    worker = models.CharField(max_length=100, blank=True, default='')
+    # unix timestamps
+    created_at = models.FloatField()
+    # failed jobs are retried after a delay
+    run_after = models.FloatField()
+    heartbeat_at = models.FloatField(null=True)
+    finished_at = models.FloatField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'created_at']),
+        ]
@@ -12,15 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from cavlib.activations import compute_activations, CAVableImage
-from cavlib.cav import CAV
+from cavlib.activations import compute_activations, compute_batch_activations, configure_models, CAVableImage
+from cavlib.cav import CAV, CAVBank, CAVRanking
 from cavlib.train import train_cav, TrainingImage
 
 __all__ = [
     '__version__',
     'compute_activations',
+    'compute_batch_activations',
+    'configure_models',
     'CAVableImage',
     'CAV',
+    'CAVBank',
+    'CAVRanking',
     'train_cav',
     'TrainingImage',
 ]
@@ -14,9 +14,10 @@
 
 from __future__ import annotations
 
+import threading
 import typing
 from pathlib import Path
-from typing import IO, Any, Dict, Union
+from typing import IO, Any, Dict, Sequence, Union
 
 import numpy as np
 import PIL.Image
@@ -35,6 +36,8 @@ MODEL_LAYERS = [MODEL_LAYER_MOBILENET_12D, MODEL_LAYER_GOOGLENET_4D, MODEL_LAYER
 CAVableImage = Union[str, Path, IO[bytes], PIL.Image.Image, ArrayLike]
 ModelClassName = Literal['GooglenetModel', 'MobilenetModel']
 loaded_models: Dict[str, Model] = {}
+loaded_models_lock = threading.Lock()
+model_options: Dict[str, int] = {'num_interpreters': 1, 'num_threads': 4}
 
 
 def compute_activations(
@@ -63,6 +66,29 @@ def compute_activations(
     return model.get_activation_for_image(pixels, model_layer_info.layer_name)
 
 
+def compute_batch_activations(
+    images: Sequence[CAVableImage], *, model_layer: ModelLayer = MODEL_LAYER_GOOGLENET_4D
+) -> NDArray[np.float32]:
+    '''compute_batch_activations(images, model_layer='googlenet_4d')
+    Calculates activations for many images at once. This is much faster than
+    calling :func:`compute_activations` for each image, because the model
+    processes the images in batches.
+
+    :param images: A sequence of images, in any of the :ref:`supported image
+        formats <CAVableImage>`.
+    :param str model_layer: The :ref:`model layer <model-layers>` to extract.
+
+    :returns: The activation vectors, as a 2D numpy array with one row per
+        image.
+    '''
+    model_layer_info = get_model_layer_info(model_layer)
+    model = get_model_instance(model_layer_info.model_class_name)
+
+    pixels = [get_pixels(image) for image in images]
+
+    return model.get_activations_for_batch(pixels, [model_layer_info.layer_name])[model_layer_info.layer_name]
+
+
 def get_pixels(image: CAVableImage) -> NDArray[Any]:
     if isinstance(image, str) or hasattr(image, '__fspath__') or hasattr(image, 'read'):
         pil_image = PIL.Image.open(image)  # type: ignore
@@ -73,18 +99,32 @@ def get_pixels(image: CAVableImage) -> NDArray[Any]:
     return crop_to_square_and_resize(array, width=224)
 
 
-def get_model_instance(model_class_name: ModelClassName) -> Model:
-    if model_class_name not in loaded_models:
-        if model_class_name == 'GooglenetModel':
-            model: Model = GooglenetModel()
-        elif model_class_name == 'MobilenetModel':
-            model = MobilenetModel()
-        else:
-            raise ValueError('unknown model class')
+def configure_models(*, num_interpreters: int = 1, num_threads: int = 4) -> None:
+    '''
+    Sets how many interpreters each model uses, and how many threads each
+    interpreter runs inference on. Use more interpreters if you're computing
+    activations from several threads at once. Models that are already loaded
+    are discarded, so they'll be recreated with the new settings on next use.
+    '''
+    with loaded_models_lock:
+        model_options['num_interpreters'] = num_interpreters
+        model_options['num_threads'] = num_threads
+        loaded_models.clear()
 
-        loaded_models[model_class_name] = model
 
-    return loaded_models[model_class_name]
+def get_model_instance(model_class_name: ModelClassName) -> Model:
+    with loaded_models_lock:
+        if model_class_name not in loaded_models:
+            if model_class_name == 'GooglenetModel':
+                model: Model = GooglenetModel(**model_options)
+            elif model_class_name == 'MobilenetModel':
+                model = MobilenetModel(**model_options)
+            else:
+                raise ValueError('unknown model class')
+
+            loaded_models[model_class_name] = model
+
+        return loaded_models[model_class_name]
 
 
 class ModelLayerInfo(typing.NamedTuple):
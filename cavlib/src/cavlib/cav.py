@@ -13,19 +13,23 @@
 # limitations under the License.
 
 from __future__ import annotations
-from typing import Any, Dict, List, Optional, Sequence, TypeVar
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, TypeVar, Union
 import uuid
 from pathlib import Path
 
 import msgpack
 import numpy as np
 
-from cavlib.activations import CAVableImage, ModelLayer, compute_activations
-from cavlib.utils import cosine_similarity
+from cavlib.activations import CAVableImage, ModelLayer, compute_activations, compute_batch_activations
+from cavlib.quantization import QuantizedActivations, row_norms
+from cavlib.utils import cosine_similarity, top_k_indices
 from cavlib.typing import NDArray
 
 
 T_CAVableImage = TypeVar('T_CAVableImage', bound=CAVableImage)
+ActivationsInput = Union[
+    Sequence[CAVableImage], Sequence[NDArray[np.float32]], NDArray[np.float32], QuantizedActivations
+]
 
 class CAV:
     def __init__(
@@ -118,5 +122,188 @@ class CAV:
 
         return cosine_similarity(self.vector, image_activations)
 
-    def sort(self, images: Sequence[T_CAVableImage], reverse: bool = False) -> List[T_CAVableImage]:
-        return sorted(images, key=lambda im: self.score(im), reverse=reverse)
+    def score_many(
+        self,
+        images_or_activations: ActivationsInput,
+        normalized: bool = False,
+    ) -> NDArray[np.float32]:
+        '''
+        Calculates the CAV scores for many images at once. This is much
+        faster than calling :func:`score` for each image.
+
+        :param images_or_activations: Either a 2D array of precomputed
+            activations, with one row per image, a
+            :class:`~cavlib.quantization.QuantizedActivations`, a sequence of
+            1D activations, or a sequence of images in any of the
+            :ref:`supported image formats <CAVableImage>`.
+        :param normalized: Set this to True if the activation rows are
+            already normalized to unit length, to skip normalizing them
+            again.
+
+        :return: A 1D array of scores, one for each image.
+        '''
+        activations = activations_matrix(
+            images_or_activations, model_layer=self.model_layer, dimensions=len(self.vector)
+        )
+
+        scores = activations.dot(self.vector) / np.linalg.norm(self.vector)
+
+        if not normalized:
+            scores /= row_norms(activations)
+
+        return scores
+
+    def sort(
+        self,
+        images: Sequence[T_CAVableImage],
+        reverse: bool = False,
+        limit: Optional[int] = None,
+    ) -> List[T_CAVableImage]:
+        '''
+        Sorts images by their CAV score, lowest first, or highest first if
+        ``reverse`` is set.
+
+        :param images: The images to sort.
+        :param reverse: If True, sort the highest-scoring images first.
+        :param limit: If set, only return this many images from the start of
+            the sorted list.
+        '''
+        scores = self.score_many(images)
+
+        if limit is None:
+            limit = len(images)
+
+        indexes = top_k_indices(scores, limit, largest=reverse)
+        return [images[i] for i in indexes]
+
+
+class CAVRanking(NamedTuple):
+    '''
+    The top results for one CAV. ``indexes`` are the positions of the top
+    images in the input, best first, and ``scores`` are their scores.
+    '''
+    cav: CAV
+    indexes: NDArray[np.intp]
+    scores: NDArray[np.float32]
+
+
+class CAVBank:
+    def __init__(self, cavs: Sequence[CAV]) -> None:
+        '''
+        A collection of CAVs that share a model layer, stacked into a single
+        matrix so that a set of images can be scored against all of them with
+        one matrix product.
+
+        :param cavs: The CAVs to include. They must all have the same
+            ``model_layer``.
+        '''
+        if len(cavs) == 0:
+            raise ValueError('a CAVBank needs at least one CAV')
+
+        model_layers = set(cav.model_layer for cav in cavs)
+        if len(model_layers) > 1:
+            raise ValueError(f'all CAVs in a CAVBank must use the same model_layer, got {sorted(model_layers)}')
+
+        self.cavs = list(cavs)
+        self.model_layer: ModelLayer = self.cavs[0].model_layer
+
+        matrix = np.stack([cav.vector for cav in self.cavs]).astype(np.float32)
+        # normalize each CAV, so the product with normalized activations is
+        # the cosine similarity
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix = matrix
+
+    @classmethod
+    def load(cls, paths: Sequence[str | Path]) -> CAVBank:
+        '''
+        Load CAVs from files into a new bank.
+
+        :param paths: The paths of the CAV files to load.
+        '''
+        return cls([CAV.load(path) for path in paths])
+
+    def __len__(self) -> int:
+        return len(self.cavs)
+
+    def score_many(
+        self,
+        images_or_activations: ActivationsInput,
+        normalized: bool = False,
+    ) -> NDArray[np.float32]:
+        '''
+        Calculates the score of each image for every CAV in the bank.
+
+        :param images_or_activations: Accepts the same inputs as
+            :func:`CAV.score_many`.
+        :param normalized: Set this to True if the activation rows are
+            already normalized to unit length.
+
+        :return: A 2D array of scores, with one row per image and one column
+            per CAV.
+        '''
+        activations = activations_matrix(
+            images_or_activations, model_layer=self.model_layer, dimensions=self.matrix.shape[1]
+        )
+
+        scores = activations.dot(self.matrix.T)
+
+        if not normalized:
+            scores /= row_norms(activations)[:, np.newaxis]
+
+        return scores
+
+    def top_k(
+        self,
+        images_or_activations: ActivationsInput,
+        k: int,
+        normalized: bool = False,
+    ) -> List[CAVRanking]:
+        '''
+        Finds the top ``k`` images for each CAV in the bank.
+
+        :param images_or_activations: Accepts the same inputs as
+            :func:`CAV.score_many`.
+        :param k: The number of results to return for each CAV.
+        :param normalized: Set this to True if the activation rows are
+            already normalized to unit length.
+
+        :return: A list of :class:`CAVRanking`, in the same order as the CAVs
+            in the bank.
+        '''
+        scores = self.score_many(images_or_activations, normalized=normalized)
+
+        results = []
+        for i, cav in enumerate(self.cavs):
+            cav_scores = scores[:, i]
+            indexes = top_k_indices(cav_scores, k)
+            results.append(CAVRanking(cav=cav, indexes=indexes, scores=cav_scores[indexes]))
+
+        return results
+
+
+def activations_matrix(
+    images_or_activations: ActivationsInput,
+    model_layer: ModelLayer,
+    dimensions: int,
+) -> NDArray[np.float32] | QuantizedActivations:
+    '''
+    Returns a 2D matrix of activations, one row per image, computing the
+    activations from the images if necessary.
+    '''
+    if isinstance(images_or_activations, QuantizedActivations):
+        return images_or_activations
+
+    if isinstance(images_or_activations, np.ndarray) and len(images_or_activations.shape) == 2:
+        return images_or_activations
+
+    if len(images_or_activations) == 0:
+        return np.zeros((0, dimensions), dtype=np.float32)
+
+    if all(isinstance(i, np.ndarray) and len(i.shape) == 1 for i in images_or_activations):
+        # a sequence of 1D vectors is a sequence of activations
+        return np.stack(images_or_activations)  # type: ignore
+
+    return compute_batch_activations(
+        images_or_activations,  # type: ignore
+        model_layer=model_layer,
+    )
@@ -0,0 +1,165 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import math
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+import numpy as np
+import sklearn.cluster
+
+from cavlib.typing import NDArray
+from cavlib.utils import top_k_indices
+
+
+class IVFIndex:
+    def __init__(
+        self,
+        centroids: NDArray[np.float32],
+        order: NDArray[np.intp],
+        list_offsets: NDArray[np.intp],
+    ) -> None:
+        '''
+        An inverted-file index for approximate maximum inner product search
+        over a matrix of normalized activations. The rows are clustered, and
+        a search only scores the rows in the ``nprobe`` clusters whose
+        centroids best match the query.
+
+        The index doesn't hold the activations themselves - pass the same
+        matrix that it was built from to :func:`search`. Indexes are normally
+        created with :func:`IVFIndex.build` or :func:`IVFIndex.load`.
+
+        :param centroids: The (C, D) matrix of normalized cluster centroids.
+        :param order: Row indexes of the activations, grouped by cluster.
+        :param list_offsets: Array of C + 1 offsets into ``order``. Cluster
+            ``c`` contains ``order[list_offsets[c]:list_offsets[c+1]]``.
+        '''
+        self.centroids = centroids
+        self.order = order
+        self.list_offsets = list_offsets
+
+    @property
+    def num_lists(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.order)
+
+    @classmethod
+    def build(
+        cls,
+        activations: NDArray[np.float32],
+        num_lists: Optional[int] = None,
+        chunk_size: int = 4096,
+        random_state: Optional[np.random.RandomState] = None,
+    ) -> IVFIndex:
+        '''
+        Clusters the rows of ``activations`` to create a new index. The
+        activations are read in chunks, so they can be a memory-mapped array
+        that's larger than RAM.
+
+        :param activations: A (N, D) matrix of normalized activations.
+        :param num_lists: The number of clusters. Defaults to roughly
+            ``sqrt(N)``.
+        :param chunk_size: The number of rows to process at a time.
+        :param random_state: Seed for the clustering.
+        '''
+        num_rows = len(activations)
+        if num_lists is None:
+            num_lists = max(1, int(math.sqrt(num_rows)))
+        num_lists = min(num_lists, num_rows)
+        chunk_size = max(chunk_size, num_lists)
+
+        kmeans = sklearn.cluster.MiniBatchKMeans(
+            n_clusters=num_lists, random_state=random_state, n_init=1,
+        )
+        for start in range(0, num_rows, chunk_size):
+            chunk = np.asarray(activations[start:start+chunk_size])
+            if len(chunk) < num_lists:
+                # partial_fit needs at least as many rows as clusters
+                chunk = np.asarray(activations[max(0, num_rows - chunk_size):num_rows])
+            kmeans.partial_fit(chunk)
+
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        assignments = np.empty(num_rows, dtype=np.intp)
+        for start in range(0, num_rows, chunk_size):
+            chunk = np.asarray(activations[start:start+chunk_size])
+            assignments[start:start+len(chunk)] = np.argmax(np.dot(chunk, centroids.T), axis=1)
+
+        order = np.argsort(assignments, kind='stable')
+        list_offsets = np.searchsorted(assignments[order], np.arange(num_lists + 1))
+
+        return cls(centroids=centroids, order=order, list_offsets=list_offsets)
+
+    @classmethod
+    def load(cls, path: str | Path) -> IVFIndex:
+        '''
+        Load an index from a file written by :func:`save`.
+        '''
+        with np.load(path) as data:
+            return cls(
+                centroids=data['centroids'],
+                order=data['order'],
+                list_offsets=data['list_offsets'],
+            )
+
+    def save(self, path: str | Path) -> None:
+        '''
+        Save the index to a ``.npz`` file.
+        '''
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, order=self.order, list_offsets=self.list_offsets)
+
+    def search(
+        self,
+        activations: NDArray[np.float32],
+        query: NDArray[Any],
+        k: int,
+        nprobe: int = 8,
+    ) -> Tuple[NDArray[np.intp], NDArray[np.float32]]:
+        '''
+        Finds the rows of ``activations`` with the highest inner product with
+        ``query``.
+
+        :param activations: The matrix this index was built from. Can also
+            be a :class:`~cavlib.quantization.QuantizedActivations`.
+        :param query: The query vector, e.g. a CAV vector.
+        :param k: The number of results to return.
+        :param nprobe: The number of clusters to search. Higher values give
+            better recall, at the cost of latency. Setting this to
+            ``num_lists`` gives exact results.
+
+        :return: a tuple of (row indexes, scores), best first.
+        '''
+        if len(activations) != self.num_rows:
+            raise ValueError(f'index was built for {self.num_rows} rows, got {len(activations)}')
+
+        probe_lists = top_k_indices(np.dot(self.centroids, query), nprobe)
+
+        candidates = np.concatenate(
+            [self.order[self.list_offsets[c]:self.list_offsets[c+1]] for c in probe_lists]
+        )
+        # read rows in file order, which is much faster for memory-mapped
+        # activations
+        candidates.sort()
+
+        scores = activations[candidates].dot(query)
+        top = top_k_indices(scores, k)
+
+        return candidates[top], scores[top]
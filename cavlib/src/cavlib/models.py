@@ -14,9 +14,10 @@
 
 from __future__ import annotations
 
-import threading
+import queue
+from contextlib import contextmanager
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Type, Union
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Sequence, Tuple, Type, Union
 
 import numpy as np
 from tflite_runtime.interpreter import Interpreter as TFLiteInterpreter
@@ -31,20 +32,101 @@ MODEL_LAYER_GOOGLENET_5B = 'googlenet_5b'
 RESOURCES_DIR = Path(__file__).parent / 'resources'
 
 
-class Model:
+class InterpreterPoolTimeout(Exception):
+    pass
+
+
+class PooledInterpreter:
     '''
-    Base class for models that can produce activations for CAVs.
+    A TFLite interpreter, along with its tensor details. Instances are owned
+    by an :class:`InterpreterPool`, and must only be used while checked out.
     '''
-    def __init__(self, model_path: Union[str, Path], input_value_range: Tuple[float, float]):
-        self.interpreter = TFLiteInterpreter(model_path=str(model_path), num_threads=4)
-        self.input_value_range = input_value_range
+    def __init__(self, model_path: Union[str, Path], num_threads: int):
+        self.interpreter = TFLiteInterpreter(model_path=str(model_path), num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+
+    def resize_input(self, batch_size: int) -> None:
+        # Reallocating tensors is expensive, so this is a no-op when the batch
+        # dimension already matches.
+        if self.input_details[0]['shape'][0] == batch_size:
+            return
 
+        self.interpreter.resize_tensor_input(
+            self.input_details[0]['index'], [batch_size, 224, 224, 3]
+        )
         self.interpreter.allocate_tensors()
 
         self.input_details = self.interpreter.get_input_details()
         self.output_details = self.interpreter.get_output_details()
 
-        self.lock = threading.Lock()
+
+class InterpreterPool:
+    '''
+    A fixed-size pool of interpreters for a single model file. Each
+    interpreter can run one invocation at a time, so the pool size is the
+    number of invocations that can run concurrently. When all interpreters
+    are checked out, :func:`checkout` blocks until one is returned.
+    '''
+    def __init__(
+        self,
+        model_path: Union[str, Path],
+        size: int = 1,
+        num_threads: int = 4,
+        timeout: Optional[float] = None,
+    ):
+        if size < 1:
+            raise ValueError('pool size must be at least 1')
+
+        self.size = size
+        self.timeout = timeout
+        self.interpreters = [PooledInterpreter(model_path, num_threads=num_threads) for _ in range(size)]
+
+        self._available: queue.Queue[PooledInterpreter] = queue.Queue(maxsize=size)
+        for interpreter in self.interpreters:
+            self._available.put(interpreter)
+
+    @contextmanager
+    def checkout(self) -> Iterator[PooledInterpreter]:
+        '''
+        Context manager that borrows an interpreter from the pool, returning
+        it on exit. Raises :class:`InterpreterPoolTimeout` if none became
+        available within the pool's ``timeout``.
+        '''
+        try:
+            interpreter = self._available.get(timeout=self.timeout)
+        except queue.Empty:
+            raise InterpreterPoolTimeout(f'no interpreter available after {self.timeout}s')
+
+        try:
+            yield interpreter
+        finally:
+            self._available.put(interpreter)
+
+
+class Model:
+    '''
+    Base class for models that can produce activations for CAVs.
+
+    A model holds a pool of ``num_interpreters`` interpreters, each using
+    ``num_threads`` threads, so that several threads can compute activations
+    at the same time.
+    '''
+    def __init__(
+        self,
+        model_path: Union[str, Path],
+        input_value_range: Tuple[float, float],
+        batch_size: int = 16,
+        num_interpreters: int = 1,
+        num_threads: int = 4,
+    ):
+        self.pool = InterpreterPool(model_path, size=num_interpreters, num_threads=num_threads)
+        self.input_value_range = input_value_range
+        self.batch_size = batch_size
+
+        self.output_details = self.pool.interpreters[0].output_details
 
     @property
     def output_layer_names(self) -> List[str]:
@@ -55,11 +137,24 @@ class Model:
         '''
         return [layer['name'] for layer in self.output_details]
 
+    def activation_shape(self, layer_name: str) -> Tuple[int, ...]:
+        '''
+        The shape of a single activation for ``layer_name`` before it's
+        flattened, e.g. ``(14, 14, 528)`` for a (height, width, channels)
+        feature map.
+        '''
+        try:
+            layer = next(l for l in self.output_details if l['name'] == layer_name)
+        except StopIteration:
+            raise ValueError(f'Unknown layer name: {layer_name}')
+
+        return tuple(int(d) for d in layer['shape'][1:])
+
     def get_activation_for_image(self, image: NDArray[Any], layer_name: str) -> NDArray[np.float32]:
         '''
         Returns an activation vector for a single image.
 
-        :param numpy.ndarray image: a numpy array of shape (224, 244, 3), either in uint8
+        :param numpy.ndarray image: a numpy array of shape (224, 224, 3), either in uint8
             type, in the range 0-255, or in floating point, from 0.0-1.0.
         :param layer_name: Layer name to return activations for.
 
@@ -74,7 +169,7 @@ class Model:
         Returns multiple layer activations for a single image. Faster than
         get_activations_for_image because the model is only run once.
 
-        :param numpy.ndarray image: a numpy array of shape (224, 244, 3), either in uint8
+        :param numpy.ndarray image: a numpy array of shape (224, 224, 3), either in uint8
             type, in the range 0-255, or in floating point, from 0.0-1.0.
         :param layer_names: Layer names to return activations for.
 
@@ -82,6 +177,80 @@ class Model:
         :rtype: Dict[str, numpy.ndarray]
         '''
 
+        batch_result = self.get_activations_for_batch([image], layer_names=layer_names)
+
+        return {
+            layer_name: activations[0]
+            for layer_name, activations in batch_result.items()
+        }
+
+    def get_activations_for_batch(
+        self,
+        images: Union[Sequence[NDArray[Any]], NDArray[Any]],
+        layer_names: List[str],
+        batch_size: Optional[int] = None,
+    ) -> Dict[str, NDArray[np.float32]]:
+        '''
+        Returns layer activations for many images. The model is run on up to
+        ``batch_size`` images at a time, which is much faster than calling
+        :func:`get_multiple_activations_for_image` for each image.
+
+        :param images: a sequence of numpy arrays of shape (224, 224, 3), or a
+            single array of shape (N, 224, 224, 3). Same dtype rules as
+            :func:`get_activation_for_image`.
+        :param layer_names: Layer names to return activations for.
+        :param batch_size: The number of images to run through the model in
+            each invocation. Defaults to the model's ``batch_size``.
+
+        :return: Dict of {layer_name: activations}, where activations is an
+            array of shape (N, D), row-aligned with ``images``.
+        :rtype: Dict[str, numpy.ndarray]
+        '''
+        if batch_size is None:
+            batch_size = self.batch_size
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+
+        output_layer_infos = []
+        for layer_name in layer_names:
+            try:
+                output_layer_infos.append(next(l for l in self.output_details if l['name'] == layer_name))
+            except StopIteration:
+                raise ValueError(f'Unknown layer name: {layer_name}')
+
+        results: Dict[str, List[NDArray[np.float32]]] = {layer_name: [] for layer_name in layer_names}
+
+        for start in range(0, len(images), batch_size):
+            batch = np.stack([self.preprocess_image(image) for image in images[start:start+batch_size]])
+
+            with self.pool.checkout() as pooled:
+                pooled.resize_input(batch_size=len(batch))
+
+                assert_shape(batch, pooled.input_details[0]['shape'])
+
+                pooled.interpreter.set_tensor(pooled.input_details[0]['index'], batch)
+
+                pooled.interpreter.invoke()
+
+                for layer_name, output_layer_info in zip(layer_names, output_layer_infos):
+                    output_data = pooled.interpreter.get_tensor(output_layer_info['index'])
+
+                    # flatten each activation to a single vector
+                    results[layer_name].append(output_data.reshape((len(batch), -1)))
+
+        return {
+            layer_name: (
+                np.concatenate(batches) if batches
+                else np.zeros((0, 0), dtype=np.float32)
+            )
+            for layer_name, batches in results.items()
+        }
+
+    def preprocess_image(self, image: NDArray[Any]) -> NDArray[Any]:
+        '''
+        Converts an image to the dtype and value range expected by the model
+        input tensor.
+        '''
         if image.dtype == np.uint8:
             image = image.astype(np.float32) / 255
         elif image.dtype in [np.float16, np.float64]:
@@ -91,40 +260,12 @@ class Model:
         else:
             raise TypeError('image is an unsupported dtype.')
 
-        # print('min', image.min(), 'max', image.max())
-
         # scale input
         low, high = self.input_value_range
         image = (image * (high - low)) + low  # type: ignore
 
         # reshape image to fit the input tensor
-        image = image.reshape((1, 224, 224, 3))
-
-        with self.lock:
-            input_shape = self.input_details[0]['shape']
-
-            assert_shape(image, input_shape)
-
-            self.interpreter.set_tensor(self.input_details[0]['index'], image)
-
-            self.interpreter.invoke()
-
-            result = {}
-
-            for layer_name in layer_names:
-                try:
-                    output_layer_info = next(l for l in self.output_details if l['name'] == layer_name)
-                except StopIteration:
-                    raise ValueError(f'Unknown layer name: {layer_name}')
-
-                output_data = self.interpreter.get_tensor(output_layer_info['index'])
-
-                # flatten the activation to a single vector
-                output_data = output_data.reshape(-1)
-
-                result[layer_name] = output_data
-
-        return result
+        return image.reshape((224, 224, 3))
 
 
 class GooglenetModel(Model):
@@ -133,10 +274,13 @@ class GooglenetModel(Model):
     particular model was pretrained on ImageNet, and was released by Google
     under the name 'inception5h'.
     '''
-    def __init__(self) -> None:
+    def __init__(self, batch_size: int = 16, num_interpreters: int = 1, num_threads: int = 4) -> None:
         super().__init__(
             model_path=RESOURCES_DIR / 'google_net_inception_v1.tflite',
             input_value_range=(-117, 255 - 117),
+            batch_size=batch_size,
+            num_interpreters=num_interpreters,
+            num_threads=num_threads,
         )
 
 
@@ -144,8 +288,11 @@ class MobilenetModel(Model):
     '''
     Mobilenet v1, pretrained on ImageNet.
     '''
-    def __init__(self) -> None:
+    def __init__(self, batch_size: int = 16, num_interpreters: int = 1, num_threads: int = 4) -> None:
         super().__init__(
             model_path=RESOURCES_DIR / 'mobilenet_v1_1.0_224.tflite',
             input_value_range=(0, 1),
+            batch_size=batch_size,
+            num_interpreters=num_interpreters,
+            num_threads=num_threads,
         )
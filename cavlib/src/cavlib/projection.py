@@ -0,0 +1,147 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+import sklearn.utils.extmath
+from typing_extensions import Literal
+
+from cavlib.activations import ModelLayer
+from cavlib.typing import NDArray
+
+ProjectionKind = Literal['pca', 'random']
+
+
+class Projection:
+    def __init__(self, basis: NDArray[np.float32], model_layer: ModelLayer, kind: ProjectionKind) -> None:
+        '''
+        A linear projection of activations into a lower-dimensional space,
+        used to make training and scoring faster.
+
+        The basis has orthonormal rows, so a vector ``w`` in the projected
+        space maps back to ``unproject(w)`` in the full space, and for any
+        activation ``x``, ``project(x) · w == x · unproject(w)``. This means a
+        CAV trained on projected activations can be mapped back to the full
+        space, and scoring projected activations against it gives the same
+        result as scoring full activations against the mapped-back CAV.
+
+        Projections are normally created with :func:`Projection.fit_pca`,
+        :func:`Projection.random` or :func:`Projection.load`.
+
+        :param basis: A (K, D) matrix with orthonormal rows.
+        :param model_layer: The model layer of the activations.
+        :param kind: How the basis was created.
+        '''
+        self.basis = basis
+        self.model_layer: ModelLayer = model_layer
+        self.kind: ProjectionKind = kind
+
+    @property
+    def dimensions(self) -> int:
+        '''
+        The number of dimensions in the projected space.
+        '''
+        return int(self.basis.shape[0])
+
+    @property
+    def input_dimensions(self) -> int:
+        return int(self.basis.shape[1])
+
+    @classmethod
+    def fit_pca(
+        cls,
+        activations: NDArray[Any],
+        dimensions: int,
+        model_layer: ModelLayer,
+        random_state: Optional[np.random.RandomState] = None,
+    ) -> Projection:
+        '''
+        Creates a projection onto the top principal directions of a sample of
+        activations. The activations aren't centered, so the projection
+        keeps as much of each activation's length as possible, which is
+        what matters for dot products.
+
+        :param activations: A (N, D) sample of activations, ideally
+            normalized. N should be larger than ``dimensions``.
+        :param dimensions: The number of dimensions to project to.
+        :param model_layer: The model layer of the activations.
+        :param random_state: Seed for the randomized SVD.
+        '''
+        _, _, basis = sklearn.utils.extmath.randomized_svd(
+            np.asarray(activations, dtype=np.float32), n_components=dimensions, random_state=random_state,
+        )
+        return cls(basis.astype(np.float32), model_layer=model_layer, kind='pca')
+
+    @classmethod
+    def random(
+        cls,
+        input_dimensions: int,
+        dimensions: int,
+        model_layer: ModelLayer,
+        random_state: Optional[np.random.RandomState] = None,
+    ) -> Projection:
+        '''
+        Creates a random orthonormal projection. This needs no data, but
+        keeps less information than :func:`fit_pca` for the same number of
+        dimensions.
+        '''
+        rng = random_state or np.random.RandomState()
+        gaussian = rng.standard_normal((input_dimensions, dimensions)).astype(np.float32)
+        q, _ = np.linalg.qr(gaussian)
+        return cls(np.ascontiguousarray(q.T), model_layer=model_layer, kind='random')
+
+    @classmethod
+    def load(cls, path: str | Path) -> Projection:
+        '''
+        Load a projection from a file written by :func:`save`.
+        '''
+        with np.load(path) as data:
+            return cls(
+                basis=data['basis'],
+                model_layer=str(data['model_layer']),  # type: ignore
+                kind=str(data['kind']),  # type: ignore
+            )
+
+    def save(self, path: str | Path) -> None:
+        '''
+        Save the projection to a ``.npz`` file.
+        '''
+        with open(path, 'wb') as f:
+            np.savez(f, basis=self.basis, model_layer=self.model_layer, kind=self.kind)
+
+    def project(self, activations: NDArray[Any], chunk_size: int = 4096) -> NDArray[np.float32]:
+        '''
+        Projects an activation vector, or a (N, D) matrix of activations,
+        into the lower-dimensional space. Matrices are processed a chunk of
+        rows at a time, so they can be memory-mapped.
+        '''
+        if len(np.shape(activations)) == 1:
+            return np.dot(self.basis, activations).astype(np.float32)  # type: ignore
+
+        result = np.empty((len(activations), self.dimensions), dtype=np.float32)
+        for start in range(0, len(activations), chunk_size):
+            chunk = np.asarray(activations[start:start+chunk_size])
+            result[start:start+len(chunk)] = np.dot(chunk, self.basis.T)
+        return result
+
+    def unproject(self, vector: NDArray[Any]) -> NDArray[np.float32]:
+        '''
+        Maps a vector in the projected space, such as a CAV trained on
+        projected activations, back to the full activation space.
+        '''
+        return np.dot(vector, self.basis).astype(np.float32)  # type: ignore
@@ -0,0 +1,166 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+from typing import Any, Optional, Tuple
+
+import numpy as np
+from typing_extensions import Literal
+
+from cavlib.typing import NDArray
+
+ActivationFormat = Literal['float32', 'float16', 'int8']
+ACTIVATION_FORMATS = ['float32', 'float16', 'int8']
+
+
+class QuantizedActivations:
+    def __init__(self, values: NDArray[Any], scales: Optional[NDArray[np.float32]] = None) -> None:
+        '''
+        A matrix of activations stored in reduced precision, one row per
+        image. ``float16`` values are stored as-is. ``int8`` values are
+        stored with a per-row scale factor, so that row ``i`` is
+        approximately ``values[i] * scales[i]``.
+
+        Scoring with :func:`dot` dequantizes the matrix a chunk at a time, so
+        the full-precision matrix is never held in memory. Objects are
+        normally created with :func:`QuantizedActivations.quantize`.
+        '''
+        if values.dtype == np.int8 and scales is None:
+            raise ValueError('int8 activations require scales')
+
+        self.values = values
+        self.scales = scales
+
+    @classmethod
+    def quantize(cls, activations: NDArray[Any], format: ActivationFormat) -> QuantizedActivations:
+        '''
+        Converts a (N, D) matrix of activations to a reduced-precision
+        format.
+
+        :param activations: The activations to convert.
+        :param format: One of ``'float32'``, ``'float16'`` or ``'int8'``.
+        '''
+        activations = np.asarray(activations)
+
+        if format == 'float32':
+            return cls(activations.astype(np.float32, copy=False))
+        elif format == 'float16':
+            return cls(activations.astype(np.float16))
+        elif format == 'int8':
+            values, scales = quantize_int8(activations)
+            return cls(values, scales)
+        else:
+            raise ValueError(f'unknown activation format: {format}')
+
+    @property
+    def format(self) -> ActivationFormat:
+        if self.values.dtype == np.int8:
+            return 'int8'
+        elif self.values.dtype == np.float16:
+            return 'float16'
+        else:
+            return 'float32'
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.values.shape  # type: ignore
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.values.nbytes + (self.scales.nbytes if self.scales is not None else 0))
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, rows: Any) -> QuantizedActivations:
+        '''
+        Selects rows, returning a new QuantizedActivations.
+        '''
+        return QuantizedActivations(
+            self.values[rows],
+            self.scales[rows] if self.scales is not None else None,
+        )
+
+    def __array__(self, dtype: Any = None, copy: Any = None) -> NDArray[Any]:
+        result = self.dequantize()
+        return result.astype(dtype) if dtype is not None else result
+
+    def dequantize(self) -> NDArray[np.float32]:
+        '''
+        Returns the activations as a float32 array.
+        '''
+        result = self.values.astype(np.float32)
+        if self.scales is not None:
+            result *= self.scales[..., np.newaxis]
+        return result
+
+    def dot(self, other: NDArray[Any], chunk_size: int = 4096) -> NDArray[np.float32]:
+        '''
+        Matrix product of the activations with a vector of shape (D,) or a
+        matrix of shape (D, K), computed a chunk of rows at a time.
+        '''
+        other = np.asarray(other, dtype=np.float32)
+
+        if len(self.values.shape) == 1:
+            return self.dequantize().dot(other)  # type: ignore
+
+        result = np.empty((len(self),) + other.shape[1:], dtype=np.float32)
+
+        for start in range(0, len(self), chunk_size):
+            chunk = self.values[start:start+chunk_size].astype(np.float32)
+            chunk_result = chunk.dot(other)
+            if self.scales is not None:
+                scales = self.scales[start:start+chunk_size]
+                chunk_result *= scales.reshape((-1,) + (1,) * (chunk_result.ndim - 1))
+            result[start:start+len(chunk)] = chunk_result
+
+        return result
+
+    def row_norms(self, chunk_size: int = 4096) -> NDArray[np.float32]:
+        '''
+        Returns the L2 norm of each row.
+        '''
+        result = np.empty(len(self), dtype=np.float32)
+
+        for start in range(0, len(self), chunk_size):
+            chunk = self[start:start+chunk_size].dequantize()
+            result[start:start+len(chunk)] = np.sqrt(np.einsum('ij,ij->i', chunk, chunk))
+
+        return result
+
+
+def quantize_int8(activations: NDArray[Any]) -> Tuple[NDArray[np.int8], NDArray[np.float32]]:
+    '''
+    Quantizes each row (or a single vector) to int8, with a per-row scale
+    chosen so that the largest magnitude value in the row maps to 127.
+    '''
+    activations = np.asarray(activations, dtype=np.float32)
+
+    max_abs = np.max(np.abs(activations), axis=-1)
+    scales = (np.maximum(max_abs, np.finfo(np.float32).tiny) / 127).astype(np.float32)
+
+    values = np.round(activations / scales[..., np.newaxis]).astype(np.int8)
+    return values, scales
+
+
+def row_norms(activations: NDArray[Any] | QuantizedActivations) -> NDArray[np.float32]:
+    '''
+    Returns the L2 norm of each row of an activation matrix, without
+    allocating a temporary the size of the matrix.
+    '''
+    if isinstance(activations, QuantizedActivations):
+        return activations.row_norms()
+
+    return np.sqrt(np.einsum('ij,ij->i', activations, activations))  # type: ignore
@@ -18,10 +18,11 @@ import uuid
 from typing import Dict, List, Optional, Sequence, Union
 
 import numpy as np
-import sklearn.linear_model
 
 from cavlib.activations import MODEL_LAYER_GOOGLENET_4D, CAVableImage, ModelLayer, compute_activations
 from cavlib.cav import CAV
+from cavlib.projection import Projection
+from cavlib.trainers import LinearModel, get_trainer
 from cavlib.typing import NDArray
 
 
@@ -75,7 +76,11 @@ def train_cav(
     positive_images: Sequence[CAVableImage | TrainingImage],
     negative_images: Sequence[CAVableImage | TrainingImage],
     model_layer: ModelLayer = MODEL_LAYER_GOOGLENET_4D,
-    random_state: Optional[np.random.RandomState] = None
+    random_state: Optional[np.random.RandomState] = None,
+    projection: Optional[Projection] = None,
+    initial_cav: Optional[CAV] = None,
+    incremental: bool = False,
+    trainer: str = 'sgd',
 ) -> CAV:
     '''
     Create a new CAV by training it on the given positive and negative samples.
@@ -92,6 +97,25 @@ def train_cav(
         a fresh instance of ``numpy.random.RandomState`` that has been seeded
         to a constant, and ensure that your training images are always in the
         same order.
+    :param projection: If set, the classifier is trained on activations
+        projected with this :class:`~cavlib.projection.Projection`, which is
+        much faster, and the result is mapped back to the full activation
+        space. The projection must be for ``model_layer``.
+    :param initial_cav: A CAV to start training from, such as the previous
+        version of the concept being trained. Training converges faster when
+        the result is similar to the initial CAV. It must use
+        ``model_layer``.
+    :param incremental: If True, only make a few passes over the training
+        images, starting from ``initial_cav``, instead of training to
+        convergence. This is much faster when only a few images have been
+        added to a large training set. Only the ``'sgd'`` trainer supports
+        this; the others are fast enough to retrain from scratch.
+    :param trainer: The name of the linear model trainer to use. ``'sgd'``
+        (the default) is a linear SVM trained with stochastic gradient
+        descent. ``'ridge'`` and ``'lda'`` are solved in closed form, which
+        is deterministic and much faster for small training sets, and
+        ``'mean_difference'`` is a simple baseline. See
+        :mod:`cavlib.trainers`.
 
     The image arguments can either be :ref:`images <CAVableImage>` (e.g. a
     path, a PIL.Image or numpy array of pixels), or :class:`TrainingImage`
@@ -99,6 +123,9 @@ def train_cav(
     weights, or, if you have a precalculated activation, this can be used via
     a TrainingImage.
     '''
+    if len(positive_images) == 0 or len(negative_images) == 0:
+        raise ValueError('training requires at least one positive and one negative image')
+
     positive_training_images = [
         im if isinstance(im, TrainingImage) else TrainingImage(im)
         for im in positive_images
@@ -121,21 +148,60 @@ def train_cav(
         positive_activations,
         negative_activations,
     ])
-    labels = np.concatenate([
-        np.repeat(0, len(positive_activations)),
-        np.repeat(1, len(negative_activations)),
+    if projection is not None:
+        if projection.model_layer != model_layer:
+            raise ValueError(f'projection is for {projection.model_layer}, not {model_layer}')
+        x = projection.project(x)
+    is_positive = np.concatenate([
+        np.repeat(True, len(positive_activations)),
+        np.repeat(False, len(negative_activations)),
     ])
     weights = np.concatenate([
         [i.weight for i in positive_training_images],
         [i.weight for i in negative_training_images],
     ])
 
-    lm = sklearn.linear_model.SGDClassifier(
-        alpha=0.01, max_iter=1000, tol=1e-3, random_state=random_state
+    initial = None
+    if initial_cav is not None:
+        if initial_cav.model_layer != model_layer:
+            raise ValueError(f'initial_cav uses {initial_cav.model_layer}, not {model_layer}')
+
+        initial = initial_model(initial_cav)
+        if projection is not None:
+            initial = initial._replace(coef=projection.project(initial.coef))
+    elif incremental:
+        raise ValueError('incremental training requires an initial_cav')
+
+    model = get_trainer(trainer)(
+        x, is_positive, weights,
+        random_state=random_state, initial=initial, incremental=incremental,
     )
 
-    lm.fit(x, labels, sample_weight=weights)
+    cav_vector = model.coef
+    if projection is not None:
+        cav_vector = projection.unproject(cav_vector)
+    coef_norm = np.linalg.norm(cav_vector)
+    cav_vector = cav_vector / coef_norm
+
+    cav = CAV(id=uuid.uuid4(), vector=cav_vector, model_layer=model_layer)
+    # the CAV vector is normalized, so keep what's needed to warm-start from it
+    cav._extra['training_state'] = {
+        **model.training_state,
+        'coef_norm': float(coef_norm),
+        'intercept': model.intercept,
+    }
+    return cav
+
+
+def initial_model(cav: CAV) -> LinearModel:
+    '''
+    Returns the linear model to warm-start training from ``cav``. CAVs that
+    weren't created by :func:`train_cav` start from their unit vector and a
+    zero intercept.
+    '''
+    training_state = dict(cav._extra.get('training_state') or {})
+    coef_norm = training_state.pop('coef_norm', 1.0)
+    intercept = training_state.pop('intercept', 0.0)
 
-    cav_vector = -1 * lm.coef_[0]  # type: ignore
-    cav_vector /= np.linalg.norm(cav_vector)
-    return CAV(id=uuid.uuid4(), vector=cav_vector, model_layer=model_layer)
+    coef = cav.vector / np.linalg.norm(cav.vector) * coef_norm
+    return LinearModel(coef=coef.astype(np.float32), intercept=float(intercept), training_state=training_state)
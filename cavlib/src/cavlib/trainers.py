@@ -0,0 +1,288 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Linear model trainers for CAVs. Each trainer takes a (N, D) matrix of
+activations, a boolean array marking the positive rows, and per-row weights,
+and returns a :class:`LinearModel` whose ``coef`` points towards the positive
+images.
+
+The ``'ridge'`` and ``'lda'`` trainers are solved in closed form through the
+(N, N) Gram matrix of the activations, which is fast when there are far fewer
+training images than activation dimensions. They're deterministic, and can
+be given a precomputed Gram matrix.
+'''
+
+from __future__ import annotations
+
+import functools
+import warnings
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set
+
+import numpy as np
+import sklearn.exceptions
+import sklearn.linear_model
+
+from cavlib.typing import NDArray
+
+# the number of passes over the training data for incremental training
+INCREMENTAL_EPOCHS = 5
+
+RIDGE_ALPHA = 1.0
+LDA_SHRINKAGE = 0.5
+
+
+class LinearModel(NamedTuple):
+    '''
+    A trained linear model. ``coef · x + intercept`` is positive for
+    activations on the positive side. ``training_state`` holds anything else
+    needed to warm-start training from this model.
+    '''
+    coef: NDArray[np.float32]
+    intercept: float
+    training_state: Dict[str, float]
+
+
+Trainer = Callable[..., LinearModel]
+
+TRAINERS: Dict[str, Trainer] = {}
+GRAM_TRAINERS: Set[str] = set()
+
+
+def register_trainer(name: str, uses_gram: bool = False) -> Callable[[Trainer], Trainer]:
+    '''
+    Decorator that makes a trainer available to :func:`get_trainer`, and so
+    to :func:`~cavlib.train_cav`, by name. A trainer is called as
+    ``trainer(x, is_positive, weights, *, gram=None, random_state=None,
+    initial=None, incremental=False)``.
+
+    :param uses_gram: Set if the trainer can use a precomputed Gram matrix of
+        ``x``, passed as ``gram``, which callers can cache between calls.
+    '''
+    def decorator(trainer: Trainer) -> Trainer:
+        @functools.wraps(trainer)
+        def checked_trainer(
+            x: NDArray[Any], is_positive: NDArray[np.bool_], weights: NDArray[Any], **kwargs: Any
+        ) -> LinearModel:
+            check_classes(is_positive, weights)
+            return trainer(x, is_positive, weights, **kwargs)
+
+        TRAINERS[name] = checked_trainer
+        if uses_gram:
+            GRAM_TRAINERS.add(name)
+        return checked_trainer
+    return decorator
+
+
+def check_classes(is_positive: NDArray[np.bool_], weights: NDArray[Any]) -> None:
+    '''
+    Raises ValueError unless both the positive and negative images have some
+    weight. Otherwise there's nothing to separate, and the trainers that
+    average each class would divide by zero.
+    '''
+    is_positive = np.asarray(is_positive, dtype=bool)
+    weights = np.asarray(weights, dtype=np.float64)
+    if not weights[is_positive].sum() > 0:
+        raise ValueError('training requires at least one positive image with nonzero weight')
+    if not weights[~is_positive].sum() > 0:
+        raise ValueError('training requires at least one negative image with nonzero weight')
+
+
+def get_trainer(name: str) -> Trainer:
+    try:
+        return TRAINERS[name]
+    except KeyError:
+        raise ValueError(f'unknown trainer: {name}. Options are {trainer_names()}')
+
+
+def trainer_names() -> List[str]:
+    return sorted(TRAINERS)
+
+
+def trainer_uses_gram(name: str) -> bool:
+    return name in GRAM_TRAINERS
+
+
+@register_trainer('sgd')
+def train_sgd(
+    x: NDArray[Any],
+    is_positive: NDArray[np.bool_],
+    weights: NDArray[Any],
+    *,
+    gram: Optional[NDArray[Any]] = None,
+    random_state: Optional[np.random.RandomState] = None,
+    initial: Optional[LinearModel] = None,
+    incremental: bool = False,
+) -> LinearModel:
+    '''
+    A linear SVM trained with stochastic gradient descent. This is the
+    original CAV trainer. It's iterative and nondeterministic unless
+    ``random_state`` is seeded, but supports warm-starting from ``initial``
+    and ``incremental`` training.
+    '''
+    if incremental and initial is None:
+        raise ValueError('incremental training requires an initial model')
+
+    # positive images are class 0, so the sklearn coefficients point away
+    # from them
+    labels = np.where(is_positive, 0, 1)
+
+    fit_params = {}
+    if initial is not None:
+        fit_params = {
+            'coef_init': -1 * initial.coef,
+            'intercept_init': np.array([-1 * initial.intercept]),
+        }
+
+    if initial is not None and incremental:
+        # carry on from where the initial model's training finished, at the
+        # learning rate it had reached, rather than restarting the schedule
+        num_updates = initial.training_state.get('num_updates', len(x))
+        lm = sklearn.linear_model.SGDClassifier(
+            alpha=0.01, max_iter=INCREMENTAL_EPOCHS, tol=None, random_state=random_state,
+            learning_rate='constant', eta0=1 / (0.01 * num_updates),
+        )
+    else:
+        lm = sklearn.linear_model.SGDClassifier(
+            alpha=0.01, max_iter=1000, tol=1e-3, random_state=random_state
+        )
+
+    with warnings.catch_warnings():
+        if incremental:
+            # stopping before convergence is the point of incremental training
+            warnings.simplefilter('ignore', sklearn.exceptions.ConvergenceWarning)
+        lm.fit(x, labels, sample_weight=weights, **fit_params)
+
+    return LinearModel(
+        coef=-1 * lm.coef_[0],  # type: ignore
+        intercept=-1 * float(lm.intercept_[0]),  # type: ignore
+        training_state={'num_updates': float(lm.t_)},  # type: ignore
+    )
+
+
+@register_trainer('ridge', uses_gram=True)
+def train_dual_ridge(
+    x: NDArray[Any],
+    is_positive: NDArray[np.bool_],
+    weights: NDArray[Any],
+    *,
+    gram: Optional[NDArray[Any]] = None,
+    random_state: Optional[np.random.RandomState] = None,
+    initial: Optional[LinearModel] = None,
+    incremental: bool = False,
+    alpha: float = RIDGE_ALPHA,
+) -> LinearModel:
+    '''
+    Weighted ridge regression onto +1/-1 targets, solved in the dual:
+    ``coef = Xcᵀ (Kc + alpha W⁻¹)⁻¹ yc``, where ``Kc`` is the Gram matrix of
+    the weighted-mean-centered activations. Costs one (N, N) solve.
+    '''
+    weights = np.asarray(weights, dtype=np.float64)
+    gram = x_gram(x, gram)
+    n = len(x)
+
+    a = weights / weights.sum()
+    y = np.where(is_positive, 1.0, -1.0)
+    y_centered = y - a.dot(y)
+
+    # center the Gram matrix on the weighted mean activation
+    centering = np.eye(n) - np.outer(np.ones(n), a)
+    gram_centered = centering @ gram @ centering.T
+
+    dual = np.linalg.solve(gram_centered + np.diag(alpha / weights), y_centered)
+
+    # Xcᵀ dual = Xᵀ (dual - a sum(dual))
+    coef = np.dot(dual - a * dual.sum(), x)
+    mean_activation = np.dot(a, x)
+    intercept = a.dot(y) - mean_activation.dot(coef)
+
+    return LinearModel(coef=coef.astype(np.float32), intercept=float(intercept), training_state={})
+
+
+@register_trainer('lda', uses_gram=True)
+def train_dual_lda(
+    x: NDArray[Any],
+    is_positive: NDArray[np.bool_],
+    weights: NDArray[Any],
+    *,
+    gram: Optional[NDArray[Any]] = None,
+    random_state: Optional[np.random.RandomState] = None,
+    initial: Optional[LinearModel] = None,
+    incremental: bool = False,
+    shrinkage: float = LDA_SHRINKAGE,
+) -> LinearModel:
+    '''
+    Fisher's linear discriminant with a shrunk within-class covariance,
+    ``coef = (Sw + gamma I)⁻¹ (mean_pos - mean_neg)``, solved through the
+    Gram matrix with the Woodbury identity. gamma is ``shrinkage`` times the
+    mean nonzero eigenvalue of ``Sw``.
+    '''
+    weights = np.asarray(weights, dtype=np.float64)
+    gram = x_gram(x, gram)
+    n = len(x)
+
+    # a_pos and a_neg take weighted means of each class
+    a_pos = np.where(is_positive, weights, 0) / weights[is_positive].sum()
+    a_neg = np.where(is_positive, 0, weights) / weights[~is_positive].sum()
+    mean_difference = a_pos - a_neg
+
+    # Z = (I - P) X is each row minus its class mean
+    class_means = np.where(is_positive[:, np.newaxis], a_pos, a_neg)
+    residual = np.eye(n) - class_means
+    z_gram = residual @ gram @ residual.T
+
+    # Sw = Zᵀ A Z
+    a = weights / weights.sum()
+    gamma = shrinkage * max(a.dot(np.diag(z_gram)) / min(n, x.shape[1]), 1e-12)
+
+    # Woodbury: (gamma I + Zᵀ A Z)⁻¹ d = (d - Zᵀ (gamma A⁻¹ + Z Zᵀ)⁻¹ Z d) / gamma
+    z_d = residual @ gram @ mean_difference
+    beta = np.linalg.solve(z_gram + np.diag(gamma / a), z_d)
+    coef = np.dot(mean_difference - residual.T @ beta, x) / gamma
+
+    # put the boundary halfway between the class means
+    intercept = -np.dot((a_pos + a_neg) / 2, x).dot(coef)
+
+    return LinearModel(coef=coef.astype(np.float32), intercept=float(intercept), training_state={})
+
+
+@register_trainer('mean_difference')
+def train_mean_difference(
+    x: NDArray[Any],
+    is_positive: NDArray[np.bool_],
+    weights: NDArray[Any],
+    *,
+    gram: Optional[NDArray[Any]] = None,
+    random_state: Optional[np.random.RandomState] = None,
+    initial: Optional[LinearModel] = None,
+    incremental: bool = False,
+) -> LinearModel:
+    '''
+    The difference between the weighted means of the positive and negative
+    activations. A fast, simple baseline.
+    '''
+    weights = np.asarray(weights, dtype=np.float64)
+    a_pos = np.where(is_positive, weights, 0) / weights[is_positive].sum()
+    a_neg = np.where(is_positive, 0, weights) / weights[~is_positive].sum()
+
+    coef = np.dot(a_pos - a_neg, x)
+    intercept = -np.dot((a_pos + a_neg) / 2, x).dot(coef)
+
+    return LinearModel(coef=coef.astype(np.float32), intercept=float(intercept), training_state={})
+
+
+def x_gram(x: NDArray[Any], gram: Optional[NDArray[Any]]) -> NDArray[np.float64]:
+    if gram is None:
+        gram = np.dot(x, x.T)
+    return np.asarray(gram, dtype=np.float64)
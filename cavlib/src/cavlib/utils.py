@@ -44,3 +44,32 @@ def shape_equal(x: NDArray[Any], shape: Tuple[int, ...]) -> bool:
 
 def cosine_similarity(vector1: NDArray[Any], vector2: NDArray[Any]) -> float:
     return np.dot(vector1, vector2) / (np.linalg.norm(vector1) * np.linalg.norm(vector2))
+
+
+def top_k_indices(scores: NDArray[Any], k: int, *, offset: int = 0, largest: bool = True) -> NDArray[np.intp]:
+    '''
+    Returns the indices of the top ``k`` scores, ordered from best to worst,
+    skipping the first ``offset`` of them (for pagination). Only the winning
+    ``offset + k`` elements are sorted, so this is much faster than a full
+    argsort when ``k`` is small.
+
+    :param scores: 1D array of scores.
+    :param k: The maximum number of indices to return.
+    :param offset: The number of top indices to skip.
+    :param largest: If True, the highest scores are the best. If False, the
+        lowest scores are.
+    '''
+    scores = np.asarray(scores)
+    keys = -scores if largest else scores
+    end = min(offset + k, len(keys))
+
+    if end <= offset:
+        return np.zeros(0, dtype=np.intp)
+
+    if end < len(keys):
+        candidates = np.argpartition(keys, end - 1)[:end]
+    else:
+        candidates = np.arange(len(keys))
+
+    ordered = candidates[np.argsort(keys[candidates], kind='stable')]
+    return ordered[offset:end]
@@ -16,7 +16,7 @@ import uuid
 
 import pytest
 import numpy as np
-from cavlib import CAV, compute_activations
+from cavlib import CAV, CAVBank, compute_activations
 from .utils import TEST_DATA_DIR, TEST_IMAGE
 
 CAVSTUDIO_CAV_FILE = TEST_DATA_DIR / 'cavstudio_sample.cav'
@@ -62,3 +62,58 @@ def test_cav_score():
     score = cav.score(activations)
 
     assert score == expected_score
+
+
+def test_cav_score_many():
+    rng = np.random.RandomState(0)
+    cav = CAV(id=uuid.uuid4(), vector=rng.rand(100).astype(np.float32) - 0.5, model_layer='googlenet_4d')
+    activations = rng.rand(50, 100).astype(np.float32)
+
+    expected_scores = [cav.score(a) for a in activations]
+
+    assert cav.score_many(activations) == pytest.approx(expected_scores, abs=1e-5)
+    assert cav.score_many(list(activations)) == pytest.approx(expected_scores, abs=1e-5)
+
+    normalized_activations = activations / np.linalg.norm(activations, axis=1, keepdims=True)
+    assert cav.score_many(normalized_activations, normalized=True) == pytest.approx(expected_scores, abs=1e-5)
+
+
+def test_cav_score_many_images():
+    cav = CAV.load(CAVSTUDIO_CAV_FILE)
+
+    scores = cav.score_many([TEST_IMAGE, TEST_IMAGE])
+
+    assert scores == pytest.approx([-0.125, -0.125], abs=0.001)
+
+
+def test_cav_bank():
+    rng = np.random.RandomState(0)
+    cavs = [
+        CAV(id=uuid.uuid4(), vector=rng.rand(100).astype(np.float32) - 0.5, model_layer='googlenet_4d')
+        for _ in range(5)
+    ]
+    activations = rng.rand(200, 100).astype(np.float32)
+
+    bank = CAVBank(cavs)
+    scores = bank.score_many(activations)
+
+    assert scores.shape == (200, 5)
+    for i, cav in enumerate(cavs):
+        assert scores[:, i] == pytest.approx(cav.score_many(activations), abs=1e-5)
+
+    rankings = bank.top_k(activations, k=10)
+
+    assert [r.cav for r in rankings] == cavs
+    for ranking in rankings:
+        expected_indexes = np.argsort(-ranking.cav.score_many(activations))[:10]
+        assert list(ranking.indexes) == list(expected_indexes)
+
+
+def test_cav_bank_model_layers_must_match():
+    cavs = [
+        CAV(id=uuid.uuid4(), vector=np.ones(10, dtype=np.float32), model_layer='googlenet_4d'),
+        CAV(id=uuid.uuid4(), vector=np.ones(10, dtype=np.float32), model_layer='googlenet_5b'),
+    ]
+
+    with pytest.raises(ValueError):
+        CAVBank(cavs)
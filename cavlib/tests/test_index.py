@@ -0,0 +1,71 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+from cavlib.index import IVFIndex
+
+
+def clustered_activations(rng, num_rows=2000, dimensions=32, num_clusters=20):
+    centers = rng.randn(num_clusters, dimensions)
+    activations = centers[rng.randint(num_clusters, size=num_rows)] + 0.3 * rng.randn(num_rows, dimensions)
+    activations /= np.linalg.norm(activations, axis=1, keepdims=True)
+    return activations.astype(np.float32)
+
+
+def test_exhaustive_probe_matches_brute_force():
+    rng = np.random.RandomState(0)
+    activations = clustered_activations(rng)
+    index = IVFIndex.build(activations, num_lists=16, chunk_size=500, random_state=rng)
+
+    assert sorted(index.order) == list(range(len(activations)))
+
+    query = rng.randn(activations.shape[1])
+    indexes, scores = index.search(activations, query, k=50, nprobe=index.num_lists)
+
+    expected = np.argsort(-np.dot(activations, query))[:50]
+    assert list(indexes) == list(expected)
+    assert scores == pytest.approx(np.dot(activations[expected], query), abs=1e-5)
+
+
+def test_recall():
+    rng = np.random.RandomState(1)
+    activations = clustered_activations(rng)
+    index = IVFIndex.build(activations, num_lists=32, random_state=rng)
+
+    recalls = []
+    for _ in range(20):
+        # queries that look like CAVs - the direction between two groups of rows
+        positive = activations[rng.randint(len(activations), size=10)].mean(axis=0)
+        negative = activations[rng.randint(len(activations), size=10)].mean(axis=0)
+        query = positive - negative
+
+        indexes, _ = index.search(activations, query, k=20, nprobe=8)
+        expected = np.argsort(-np.dot(activations, query))[:20]
+        recalls.append(len(set(indexes) & set(expected)) / 20)
+
+    assert np.mean(recalls) > 0.9
+
+
+def test_save_load_roundtrip(tmp_path):
+    rng = np.random.RandomState(2)
+    activations = clustered_activations(rng, num_rows=300)
+    index = IVFIndex.build(activations, random_state=rng)
+
+    index.save(tmp_path / 'index.npz')
+    index2 = IVFIndex.load(tmp_path / 'index.npz')
+
+    query = rng.randn(activations.shape[1])
+    assert list(index.search(activations, query, k=10)[0]) == list(index2.search(activations, query, k=10)[0])
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from cavlib import models
 import pytest
@@ -40,6 +41,19 @@ def test_layer_names():
     )
 
 
+def test_activation_shape():
+    model = models.GooglenetModel()
+    image = np.zeros((224, 224, 3), dtype=np.uint8)
+
+    for layer_name in ['mixed4d', 'mixed5b']:
+        shape = model.activation_shape(layer_name)
+        assert len(shape) == 3
+        assert np.prod(shape) == len(model.get_activation_for_image(image, layer_name))
+
+    with pytest.raises(ValueError):
+        model.activation_shape('not_a_layer')
+
+
 def test_consistent_activations():
     model = models.GooglenetModel()
 
@@ -50,6 +64,50 @@ def test_consistent_activations():
     assert activations1 == pytest.approx(activations2)
 
 
+def test_batch_activations_match_single():
+    model = models.GooglenetModel(batch_size=2)
+
+    input_image = np.array(PIL.Image.open(TEST_IMAGE))
+    flipped_image = input_image[:, ::-1, :].copy()
+    images = [input_image, flipped_image, input_image]
+
+    batch_activations = model.get_activations_for_batch(images, layer_names=["mixed4d", "mixed5b"])
+
+    for layer_name in ["mixed4d", "mixed5b"]:
+        assert batch_activations[layer_name].shape[0] == len(images)
+
+        for image, activation in zip(images, batch_activations[layer_name]):
+            single_activation = model.get_activation_for_image(image, layer_name=layer_name)
+            assert activation == pytest.approx(single_activation, abs=1e-4)
+
+
+def test_concurrent_activations_with_interpreter_pool():
+    model = models.GooglenetModel(num_interpreters=2, num_threads=1)
+    assert model.pool.size == 2
+
+    input_image = np.array(PIL.Image.open(TEST_IMAGE))
+    expected = model.get_activation_for_image(input_image, layer_name="mixed4d")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(
+            lambda _: model.get_activation_for_image(input_image, layer_name="mixed4d"),
+            range(8),
+        ))
+
+    for result in results:
+        assert result == pytest.approx(expected)
+
+
+def test_interpreter_pool_timeout():
+    model = models.GooglenetModel(num_interpreters=1, num_threads=1)
+    model.pool.timeout = 0.01
+
+    with model.pool.checkout():
+        with pytest.raises(models.InterpreterPoolTimeout):
+            with model.pool.checkout():
+                pass
+
+
 @pytest.mark.parametrize("model_cls,layer_name,precomputed_activation", [
         (models.GooglenetModel, "mixed4d", TEST_IMAGE_ACTIVATIONS_GOOGLENET_4D),
         (models.GooglenetModel, "mixed5b", TEST_IMAGE_ACTIVATIONS_GOOGLENET_5B),
@@ -0,0 +1,103 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+
+import numpy as np
+import pytest
+
+from cavlib import CAV, TrainingImage, train_cav
+from cavlib.projection import Projection
+
+
+def low_rank_activations(rng, num_rows=1000, dimensions=512, rank=32):
+    factors = np.maximum(rng.randn(num_rows, rank), 0)
+    activations = factors.dot(rng.randn(rank, dimensions)) + 0.01 * rng.randn(num_rows, dimensions)
+    activations /= np.linalg.norm(activations, axis=1, keepdims=True)
+    return activations.astype(np.float32)
+
+
+@pytest.mark.parametrize('kind', ['pca', 'random'])
+def test_projected_scores_match_unprojected_cav(kind):
+    rng = np.random.RandomState(0)
+    activations = low_rank_activations(rng)
+
+    if kind == 'pca':
+        projection = Projection.fit_pca(activations, 64, model_layer='googlenet_4d', random_state=rng)
+    else:
+        projection = Projection.random(activations.shape[1], 64, model_layer='googlenet_4d', random_state=rng)
+
+    assert projection.basis.shape == (64, 512)
+    assert projection.basis.dot(projection.basis.T) == pytest.approx(np.eye(64), abs=1e-5)
+
+    projected_vector = rng.randn(64).astype(np.float32)
+    cav = CAV(id=uuid.uuid4(), vector=projection.unproject(projected_vector), model_layer='googlenet_4d')
+
+    projected = projection.project(activations, chunk_size=100)
+    assert projected.shape == (1000, 64)
+    assert projection.project(cav.vector) == pytest.approx(projected_vector, abs=1e-4)
+
+    expected = cav.score_many(activations, normalized=True)
+    result = projected.dot(projected_vector) / np.linalg.norm(projected_vector)
+    assert result == pytest.approx(expected, abs=1e-4)
+
+
+def test_pca_keeps_most_of_low_rank_activations():
+    rng = np.random.RandomState(1)
+    activations = low_rank_activations(rng)
+
+    projection = Projection.fit_pca(activations, 64, model_layer='googlenet_4d', random_state=rng)
+    projected_norms = np.linalg.norm(projection.project(activations), axis=1)
+
+    assert np.min(projected_norms) > 0.99
+
+
+def test_save_and_load(tmp_path):
+    projection = Projection.random(128, 16, model_layer='mobilenet_12d', random_state=np.random.RandomState(2))
+    projection.save(tmp_path / 'projection.npz')
+
+    loaded = Projection.load(tmp_path / 'projection.npz')
+
+    assert loaded.model_layer == 'mobilenet_12d'
+    assert loaded.kind == 'random'
+    assert np.array_equal(loaded.basis, projection.basis)
+
+
+def test_train_cav_with_projection():
+    rng = np.random.RandomState(3)
+    activations = low_rank_activations(rng, num_rows=200)
+    direction = activations[:100].mean(axis=0) - activations[100:].mean(axis=0)
+    order = np.argsort(-activations.dot(direction))
+    positive, negative = activations[order[:50]], activations[order[-50:]]
+
+    projection = Projection.fit_pca(activations, 48, model_layer='googlenet_4d', random_state=rng)
+
+    cav = train_cav(
+        positive_images=[TrainingImage(activations={'googlenet_4d': a}) for a in positive],
+        negative_images=[TrainingImage(activations={'googlenet_4d': a}) for a in negative],
+        model_layer='googlenet_4d',
+        random_state=np.random.RandomState(4),
+        projection=projection,
+    )
+
+    assert cav.vector.shape == (512,)
+    assert np.min(cav.score_many(positive)) > np.max(cav.score_many(negative))
+
+    with pytest.raises(ValueError):
+        train_cav(
+            positive_images=[TrainingImage(activations={'googlenet_5b': positive[0]})],
+            negative_images=[TrainingImage(activations={'googlenet_5b': negative[0]})],
+            model_layer='googlenet_5b',
+            projection=projection,
+        )
@@ -0,0 +1,62 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+
+import numpy as np
+import pytest
+
+from cavlib import CAV
+from cavlib.quantization import QuantizedActivations
+
+
+def random_activations(rng, num_rows=500, dimensions=256):
+    # activations are post-ReLU, so mostly small positive values
+    return np.maximum(rng.randn(num_rows, dimensions), 0).astype(np.float32)
+
+
+@pytest.mark.parametrize('format,nbytes_ratio,tolerance', [
+    ('float32', 1, 1e-6),
+    ('float16', 2, 1e-3),
+    ('int8', 4, 2e-2),
+])
+def test_quantized_dot(format, nbytes_ratio, tolerance):
+    rng = np.random.RandomState(0)
+    activations = random_activations(rng)
+    vector = rng.randn(activations.shape[1]).astype(np.float32)
+
+    quantized = QuantizedActivations.quantize(activations, format)
+
+    assert quantized.format == format
+    assert quantized.nbytes <= activations.nbytes / nbytes_ratio + 4 * len(activations)
+
+    expected = activations.dot(vector)
+    result = quantized.dot(vector, chunk_size=64)
+    relative_error = np.abs(result - expected) / np.linalg.norm(activations, axis=1) / np.linalg.norm(vector)
+
+    assert np.max(relative_error) < tolerance
+    assert quantized.row_norms() == pytest.approx(np.linalg.norm(activations, axis=1), rel=tolerance)
+    assert np.asarray(quantized[10:20]) == pytest.approx(activations[10:20], abs=tolerance * 10)
+
+
+@pytest.mark.parametrize('format', ['float16', 'int8'])
+def test_quantized_ranking(format):
+    rng = np.random.RandomState(1)
+    activations = random_activations(rng, num_rows=2000)
+    cav = CAV(id=uuid.uuid4(), vector=rng.randn(activations.shape[1]).astype(np.float32), model_layer='googlenet_4d')
+
+    expected_top = set(np.argsort(-cav.score_many(activations))[:50])
+    top = set(np.argsort(-cav.score_many(QuantizedActivations.quantize(activations, format)))[:50])
+
+    assert len(expected_top & top) / 50 >= 0.9
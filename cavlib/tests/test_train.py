@@ -17,7 +17,7 @@ import numpy as np
 
 import pytest
 
-from cavlib import train_cav
+from cavlib import CAV, TrainingImage, train_cav
 
 from .utils import TEST_DATA_DIR
 
@@ -64,3 +64,40 @@ def test_train_and_sort(model_layer):
         assert sorted_image_names == ['1.png', '2.png', '3.png', '5.png', '4.png']
     else:
         assert False
+
+
+def random_training_images(rng, count, offset):
+    return [
+        TrainingImage(activations={'googlenet_4d': np.maximum(rng.randn(64) + offset, 0).astype(np.float32)})
+        for _ in range(count)
+    ]
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_warm_start(incremental, tmp_path):
+    rng = np.random.RandomState(0)
+    offset = np.where(np.arange(64) < 8, 1.0, 0.0)
+    positive_images = random_training_images(rng, 50, offset)
+    negative_images = random_training_images(rng, 50, -offset)
+
+    parent_cav = train_cav(
+        positive_images=positive_images,
+        negative_images=negative_images,
+        random_state=np.random.RandomState(1),
+    )
+    parent_cav.save(tmp_path / 'parent.cav')
+    parent_cav = CAV.load(tmp_path / 'parent.cav')
+
+    cav = train_cav(
+        positive_images=positive_images + random_training_images(rng, 2, offset),
+        negative_images=negative_images,
+        random_state=np.random.RandomState(2),
+        initial_cav=parent_cav,
+        incremental=incremental,
+    )
+
+    assert np.dot(cav.vector, parent_cav.vector) > 0.9
+    assert np.dot(cav.vector, offset) > 0
+
+    with pytest.raises(ValueError):
+        train_cav(positive_images=positive_images, negative_images=negative_images, incremental=True)
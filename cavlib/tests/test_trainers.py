@@ -0,0 +1,112 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+import sklearn.linear_model
+
+from cavlib import TrainingImage, train_cav
+from cavlib.trainers import get_trainer, train_dual_lda, train_dual_ridge, trainer_names, trainer_uses_gram
+
+
+def separable_data(rng, num_rows=40, dimensions=256):
+    offset = np.where(np.arange(dimensions) < 16, 0.5, 0.0)
+    is_positive = np.arange(num_rows) < num_rows // 2
+    x = np.maximum(rng.randn(num_rows, dimensions) + np.where(is_positive[:, np.newaxis], offset, -offset), 0)
+    weights = rng.uniform(0.5, 2.0, size=num_rows)
+    return x, is_positive, weights, offset
+
+
+@pytest.mark.parametrize('name', trainer_names())
+def test_trainer_separates_classes(name):
+    rng = np.random.RandomState(0)
+    x, is_positive, weights, offset = separable_data(rng)
+
+    model = get_trainer(name)(x, is_positive, weights, random_state=np.random.RandomState(1))
+
+    scores = x.dot(model.coef) + model.intercept
+    assert np.mean((scores > 0) == is_positive) > 0.9
+    assert np.dot(model.coef, offset) > 0
+
+    positive_images = [TrainingImage(activations={'googlenet_4d': a}) for a in x[is_positive]]
+    negative_images = [TrainingImage(activations={'googlenet_4d': a}) for a in x[~is_positive]]
+    cav = train_cav(positive_images=positive_images, negative_images=negative_images, trainer=name)
+    assert np.dot(cav.vector, offset) > 0
+
+
+def test_dual_ridge_matches_primal():
+    rng = np.random.RandomState(0)
+    x, is_positive, weights, _ = separable_data(rng)
+
+    model = train_dual_ridge(x, is_positive, weights, alpha=2.0)
+
+    primal = sklearn.linear_model.Ridge(alpha=2.0)
+    primal.fit(x, np.where(is_positive, 1.0, -1.0), sample_weight=weights)
+    np.testing.assert_allclose(model.coef, primal.coef_, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(model.intercept, primal.intercept_, rtol=1e-4, atol=1e-6)
+
+
+def test_dual_lda_matches_primal():
+    rng = np.random.RandomState(0)
+    x, is_positive, weights, _ = separable_data(rng, dimensions=64)
+
+    model = train_dual_lda(x, is_positive, weights, shrinkage=0.5)
+
+    a = weights / weights.sum()
+    means = {c: np.average(x[is_positive == c], axis=0, weights=weights[is_positive == c]) for c in (True, False)}
+    z = x - np.where(is_positive[:, np.newaxis], means[True], means[False])
+    within_class = (z * a[:, np.newaxis]).T.dot(z)
+    gamma = 0.5 * np.trace(within_class) / len(x)
+    expected = np.linalg.solve(within_class + gamma * np.eye(x.shape[1]), means[True] - means[False])
+    np.testing.assert_allclose(model.coef, expected, rtol=1e-3, atol=1e-5)
+
+
+@pytest.mark.parametrize('name', ['ridge', 'lda'])
+def test_precomputed_gram(name):
+    rng = np.random.RandomState(0)
+    x, is_positive, weights, _ = separable_data(rng)
+
+    assert trainer_uses_gram(name)
+    model = get_trainer(name)(x, is_positive, weights)
+    model_with_gram = get_trainer(name)(x, is_positive, weights, gram=x.dot(x.T))
+    np.testing.assert_allclose(model.coef, model_with_gram.coef, rtol=1e-5)
+
+
+def test_unknown_trainer():
+    with pytest.raises(ValueError):
+        get_trainer('nonexistent')
+
+
+@pytest.mark.parametrize('name', trainer_names())
+def test_trainer_requires_both_classes(name):
+    rng = np.random.RandomState(0)
+    x, _, weights, _ = separable_data(rng)
+
+    with pytest.raises(ValueError):
+        get_trainer(name)(x, np.ones(len(x), dtype=bool), weights)
+    with pytest.raises(ValueError):
+        get_trainer(name)(x, np.zeros(len(x), dtype=bool), weights)
+
+    # a class whose images all have zero weight is as good as empty
+    is_positive = np.arange(len(x)) < len(x) // 2
+    with pytest.raises(ValueError):
+        get_trainer(name)(x, is_positive, np.where(is_positive, 0.0, weights))
+
+
+def test_train_cav_requires_both_classes():
+    images = [TrainingImage(activations={'googlenet_4d': np.ones(16)})]
+    with pytest.raises(ValueError):
+        train_cav(positive_images=images, negative_images=[])
+    with pytest.raises(ValueError):
+        train_cav(positive_images=[], negative_images=images)
@@ -0,0 +1,39 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+from cavlib.utils import top_k_indices
+
+
+@pytest.mark.parametrize('largest', [True, False])
+def test_top_k_indices_matches_argsort(largest):
+    rng = np.random.RandomState(0)
+    scores = rng.rand(1000)
+    expected = np.argsort(-scores if largest else scores)
+
+    assert list(top_k_indices(scores, 10, largest=largest)) == list(expected[:10])
+    assert list(top_k_indices(scores, 10, offset=25, largest=largest)) == list(expected[25:35])
+    assert list(top_k_indices(scores, 2000, largest=largest)) == list(expected)
+
+
+def test_top_k_indices_bounds():
+    scores = np.array([0.1, 0.5, 0.3])
+
+    assert list(top_k_indices(scores, 2)) == [1, 2]
+    assert list(top_k_indices(scores, 5, offset=2)) == [0]
+    assert len(top_k_indices(scores, 5, offset=3)) == 0
+    assert len(top_k_indices(scores, 0)) == 0
+    assert len(top_k_indices(np.zeros(0), 5)) == 0
@@ -63,12 +63,14 @@ export class CAVServer {
                                                              exifOrientation,
                                                              size: {width: 1200, height: 1200}})
 
-            const data224 = canvas224.toDataURL("image/png");
-            const data1200 = canvas1200.toDataURL("image/jpeg", 0.8);
+            // send the images as binary files, rather than base64 data URIs
+            const formBody = new FormData()
+            formBody.append('data224', await imageUtils.canvasToBlob(canvas224, "image/png"), 'image224.png')
+            formBody.append('data1200', await imageUtils.canvasToBlob(canvas1200, "image/jpeg", 0.8), 'image1200.jpg')
 
             const responseJSON = await this.request('/api/upload_image', {
                 method: 'post',
-                jsonBody: {data224, data1200},
+                formBody,
             })
 
             return CAVServerImage.fromJSON(responseJSON)
@@ -133,16 +135,19 @@ export class CAVServer {
         return responseJSON as CropsResponse
     }
 
-    private async request(path: string, options: {method?: string, jsonBody?: any} = {}): Promise<any> {
-        const {method='get', jsonBody=null} = options
+    private async request(path: string, options: {method?: string, jsonBody?: any, formBody?: FormData} = {}): Promise<any> {
+        const {method='get', jsonBody=null, formBody=null} = options
+
+        const headers: Record<string, string> = {'accept': 'application/json'}
+        if (!formBody) {
+            // for form bodies, fetch sets the multipart content-type
+            headers['content-type'] = 'application/json'
+        }
 
         const response = await fetch(`${SERVER_URL}${path}`, {
              method,
-             body: jsonBody ? JSON.stringify(jsonBody) : null,
-             headers: {
-                 'accept': 'application/json',
-                 'content-type': 'application/json',
-             },
+             body: formBody ?? (jsonBody ? JSON.stringify(jsonBody) : null),
+             headers,
         })
 
         if (!response.ok) {
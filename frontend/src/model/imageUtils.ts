@@ -113,3 +113,18 @@ export function drawImageToCanvas(options: {image: HTMLImageElement, exifOrienta
                   /*dh:*/ size.height)
     return canvas
 }
+
+/**
+ * Encodes the contents of a canvas as an image file.
+ */
+export function canvasToBlob(canvas: HTMLCanvasElement, type: string, quality?: number): Promise<Blob> {
+    return new Promise((resolve, reject) => {
+        canvas.toBlob(blob => {
+            if (blob) {
+                resolve(blob)
+            } else {
+                reject(new Error('failed to encode canvas'))
+            }
+        }, type, quality)
+    })
+}